@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+"""Load test server.py against local mock DeepSeek, DeepAI, Razorpay and Firebase upstreams.
+
+Starts a mock upstream with configurable latency, jitter, error rate and
+streaming speed, launches server.py pointed at it (``*_API_URL``) with
+throwaway stores, and drives a weighted mix of routes from a pool of client
+threads.  Prints req/s and p50/p95/p99 per route and writes everything to a
+JSON file so runs can be compared across serving modes and commits.
+
+    python3 bench.py --modes threaded,async --duration 20 --concurrency 32
+    python3 bench.py --mix generate=1 --latency 800 --error-rate 0.05 --output before.json
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BENCH_RAZORPAY_SECRET = 'bench_secret'
+DEFAULT_MIX = 'generate=2,config=2,static=4,order=1,verify=1,stream=0,batch=0'
+STATIC_PATHS = ('/', '/styles.css', '/script.js', '/payment.js', '/robots.txt')
+
+
+def mock_id_token(uid, expires_in=3600, valid=True):
+    """A Firebase-shaped ID token for ``uid`` that the mock's accounts:lookup accepts unless ``valid`` is False"""
+    def part(data):
+        return base64.urlsafe_b64encode(json.dumps(data).encode('utf-8')).rstrip(b'=').decode('ascii')
+    claims = {'user_id': uid, 'exp': int(time.time() + expires_in)}
+    return f"{part({'alg': 'RS256'})}.{part(claims)}.{'mock' if valid else 'forged'}"
+
+
+class MockUpstream(BaseHTTPRequestHandler):
+    """Stands in for every provider; behaviour comes from ``server.settings``"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def delay(self, base_ms):
+        settings = self.server.settings
+        jitter = settings['jitter'] / 1000
+        time.sleep(max(0.0, base_ms / 1000 + random.uniform(-jitter, jitter)))
+
+    def send_body(self, status, body, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        settings = self.server.settings
+        request = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+        if self.path.endswith('/chat/completions'):
+            if json.loads(request or b'{}').get('stream'):
+                return self.stream_completion()
+            self.delay(settings['copy_latency'])
+            if random.random() < settings['error_rate']:
+                return self.send_body(500, b'{"error": "mock failure"}')
+            body = {'choices': [{'message': {'content': 'Mock headline. Mock body copy. Buy now!'}}]}
+        elif self.path.endswith('/text2img'):
+            self.delay(settings['image_latency'])
+            if random.random() < settings['error_rate']:
+                return self.send_body(500, b'{"error": "mock failure"}')
+            body = {'output_url': f'http://127.0.0.1:{self.server.server_port}/img/{uuid.uuid4().hex}.jpg'}
+        elif self.path.endswith('/orders'):
+            self.delay(settings['order_latency'])
+            if random.random() < settings['error_rate']:
+                return self.send_body(503, b'{"error": "mock failure"}')
+            payload = json.loads(request or b'{}')
+            body = {'id': f'order_{uuid.uuid4().hex[:14]}', 'amount': payload.get('amount', 0),
+                    'currency': payload.get('currency', 'INR')}
+        elif self.path.startswith('/v1/accounts:lookup'):
+            token = json.loads(request or b'{}').get('idToken', '')
+            header, _, rest = token.partition('.')
+            payload, _, signature = rest.partition('.')
+            if signature != 'mock':
+                return self.send_body(400, b'{"error": {"message": "INVALID_ID_TOKEN"}}')
+            claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+            body = {'users': [{'localId': claims['user_id']}]}
+        else:
+            return self.send_body(404, b'{}')
+        self.send_body(200, json.dumps(body).encode('utf-8'))
+
+    def stream_completion(self):
+        settings = self.server.settings
+        self.delay(settings['copy_latency'] / 4)  # time to first token
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for i in range(settings['stream_tokens']):
+                time.sleep(settings['token_delay'] / 1000)
+                event = 'data: ' + json.dumps({'choices': [{'delta': {'content': f'tok{i} '}}]}) + '\n\n'
+                self.write_chunk(event.encode('utf-8'))
+            self.write_chunk(b'data: [DONE]\n\n')
+            self.wfile.write(b'0\r\n\r\n')
+        except OSError:
+            pass
+
+    def write_chunk(self, data):
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.startswith('/img/'):
+            settings = self.server.settings
+            self.delay(settings['image_latency'] / 10)
+            # Same bytes per name, so the server's content-addressed store can dedupe
+            seed = hashlib.sha256(self.path.encode('utf-8')).digest()
+            body = b'\xff\xd8\xff\xe0' + seed * 2048
+            if not settings.get('image_chunk_delay'):
+                return self.send_body(200, body, 'image/jpeg')
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            try:
+                for start in range(0, len(body), 4096):
+                    self.wfile.write(body[start:start + 4096])
+                    self.wfile.flush()
+                    time.sleep(settings['image_chunk_delay'] / 1000)
+            except OSError:
+                pass
+            return
+        self.send_body(404, b'{}')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        pass  # server.py hanging up mid-response (timeouts, cancelled streams) is expected
+
+
+def start_mock(settings):
+    mock = MockServer(('127.0.0.1', 0), MockUpstream)
+    mock.settings = settings
+    threading.Thread(target=mock.serve_forever, daemon=True).start()
+    return mock
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(mode, port, upstream_url, workdir, extra_env):
+    env = dict(os.environ)
+    env.update({
+        'PORT': str(port),
+        'SERVER_MODE': mode,
+        'DEEPSEEK_API_URL': upstream_url,
+        'DEEPAI_API_URL': upstream_url,
+        'RAZORPAY_API_URL': upstream_url,
+        'FIREBASE_API_URL': upstream_url,
+        'FIREBASE_API_KEY': 'bench_firebase_key',
+        'DEEPSEEK_API_KEY': 'bench_deepseek_key',
+        'DEEPAI_API_KEY': 'bench_deepai_key',
+        'RAZORPAY_KEY_ID': 'rzp_bench',
+        'RAZORPAY_KEY_SECRET': BENCH_RAZORPAY_SECRET,
+        'AD_CACHE_FILE': os.path.join(workdir, 'ad_cache.json'),
+        'JOB_DB': os.path.join(workdir, 'jobs.db'),
+        'HISTORY_DB': os.path.join(workdir, 'history.db'),
+        'PAYMENTS_DB': os.path.join(workdir, 'payments.db'),
+        'IMAGE_STORE_DIR': os.path.join(workdir, 'images'),
+        'LOG_LEVEL': 'WARNING',
+    })
+    env.update(extra_env)
+    server_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+    process = subprocess.Popen([sys.executable, server_py], env=env, cwd=os.path.dirname(server_py),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server.py exited with {process.returncode} during startup")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("server.py did not start listening within 15s")
+
+
+class Driver:
+    """Issues one request per call for a named route and records its latency"""
+
+    def __init__(self, port, unique_ratio, keep_alive=False):
+        self.port = port
+        self.unique_ratio = unique_ratio
+        self.keep_alive = keep_alive
+        self.local = threading.local()  # one persistent connection per client thread
+
+    def product(self):
+        # A share of generate requests repeat earlier products so the result cache sees hits
+        if random.random() < self.unique_ratio:
+            return f'Bench product {uuid.uuid4().hex[:12]}'
+        return f'Bench product {random.randint(1, 20)}'
+
+    def request(self, method, path, body=None, headers=None):
+        connection = getattr(self.local, 'connection', None) if self.keep_alive else None
+        if connection is None:
+            connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=120)
+        payload = json.dumps(body).encode('utf-8') if body is not None else None
+        headers = dict(headers or {})
+        if payload is not None:
+            headers['Content-Type'] = 'application/json'
+        try:
+            connection.request(method, path, payload, headers)
+            response = connection.getresponse()
+            data = response.read()
+        except OSError:
+            connection.close()
+            self.local.connection = None
+            raise
+        # http.client reconnects by itself after a response that closed the connection
+        if self.keep_alive:
+            self.local.connection = connection
+        else:
+            connection.close()
+        return response.status, data
+
+    def generate(self):
+        return self.request('POST', '/generate-ad', {
+            'productName': self.product(), 'productDescription': 'Benchmark run',
+            'targetAudience': 'Everyone', 'tone': 'professional', 'adFormat': 'facebook-feed'
+        })
+
+    def stream(self):
+        return self.request('POST', '/generate-ad/stream', {'productName': self.product(),
+                                                            'productDescription': 'Benchmark run'})
+
+    def batch(self):
+        return self.request('POST', '/generate-ad/batch', {
+            'productName': self.product(), 'productDescription': 'Benchmark run',
+            'variants': [{'tone': 'professional'}, {'tone': 'playful'}, {'adFormat': 'instagram-story'}]
+        })
+
+    def config(self):
+        return self.request('GET', '/config.js')
+
+    def static(self):
+        return self.request('GET', random.choice(STATIC_PATHS), headers={'Accept-Encoding': 'gzip'})
+
+    def order(self):
+        return self.request('POST', '/api/create-razorpay-order', {
+            'amount': 49900, 'currency': 'INR', 'planKey': 'pro', 'userId': f'bench_{uuid.uuid4().hex[:8]}'
+        })
+
+    def verify(self):
+        order_id, payment_id = f'order_{uuid.uuid4().hex[:14]}', f'pay_{uuid.uuid4().hex[:14]}'
+        signature = hmac.new(BENCH_RAZORPAY_SECRET.encode('utf-8'), f'{order_id}|{payment_id}'.encode('utf-8'),
+                             hashlib.sha256).hexdigest()
+        return self.request('POST', '/api/verify-payment', {
+            'razorpay_order_id': order_id, 'razorpay_payment_id': payment_id,
+            'razorpay_signature': signature, 'planKey': 'pro'
+        })
+
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip():
+            mix[name.strip()] = float(weight or 1)
+    unknown = [name for name in mix if not hasattr(Driver, name) or name in ('request', 'product')]
+    if unknown:
+        raise SystemExit(f"Unknown route(s) in --mix: {', '.join(unknown)}")
+    return {name: weight for name, weight in mix.items() if weight > 0}
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+
+def run_load(driver, mix, concurrency, duration, warmup):
+    """Run the mix for ``duration`` seconds; returns ({route: [(latency, status), ...]}, {route: first failure})"""
+    names, weights = list(mix), list(mix.values())
+    samples = {name: [] for name in names}
+    failures = {}
+    lock = threading.Lock()
+    started = time.monotonic()
+    stop_at = started + warmup + duration
+
+    def client():
+        while True:
+            now = time.monotonic()
+            if now >= stop_at:
+                return
+            name = random.choices(names, weights)[0]
+            t0 = time.perf_counter()
+            try:
+                status, body = getattr(driver, name)()
+            except OSError as e:
+                status, body = 'error', str(e).encode('utf-8')
+            elapsed = time.perf_counter() - t0
+            if now - started >= warmup:
+                with lock:
+                    samples[name].append((elapsed, status))
+                    if (status == 'error' or status >= 400) and name not in failures:
+                        failures[name] = f"{status}: {body[:200].decode('utf-8', 'replace')}"
+
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, failures
+
+
+def is_rejection(status):
+    return status in (429, 503)
+
+
+def summarize(samples, failures, duration):
+    routes = {}
+    everything = []
+    for name, results in samples.items():
+        latencies = sorted(elapsed for elapsed, _ in results)
+        everything += latencies
+        errors = sum(1 for _, status in results
+                     if status == 'error' or (status >= 500 and not is_rejection(status)))
+        rejected = sum(1 for _, status in results if is_rejection(status))
+        routes[name] = summary(latencies, duration, errors=errors, rejected=rejected)
+        if name in failures:
+            routes[name]['first_failure'] = failures[name]
+    routes['all'] = summary(sorted(everything), duration,
+                            errors=sum(route['errors'] for route in routes.values()),
+                            rejected=sum(route['rejected'] for route in routes.values()))
+    return routes
+
+
+def summary(latencies, duration, errors, rejected):
+    to_ms = lambda value: round(value * 1000, 2) if value is not None else None
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rejected': rejected,
+        'rps': round(len(latencies) / duration, 2),
+        'p50_ms': to_ms(percentile(latencies, 0.50)),
+        'p95_ms': to_ms(percentile(latencies, 0.95)),
+        'p99_ms': to_ms(percentile(latencies, 0.99)),
+        'max_ms': to_ms(latencies[-1] if latencies else None),
+    }
+
+
+def print_report(mode, routes):
+    print(f"\n📊 {mode}")
+    print(f"{'route':<10} {'reqs':>7} {'err':>5} {'rej':>5} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, route in routes.items():
+        print(f"{name:<10} {route['requests']:>7} {route['errors']:>5} {route['rejected']:>5} {route['rps']:>9} "
+              f"{route['p50_ms'] or '-':>9} {route['p95_ms'] or '-':>9} {route['p99_ms'] or '-':>9}")
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark server.py against mock upstreams')
+    parser.add_argument('--modes', default='threaded', help='comma-separated serving modes to run (threaded,async)')
+    parser.add_argument('--duration', type=float, default=15, help='measured seconds per mode')
+    parser.add_argument('--warmup', type=float, default=2, help='seconds of load before measuring')
+    parser.add_argument('--concurrency', type=int, default=16, help='client threads')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'route weights (default: {DEFAULT_MIX})')
+    parser.add_argument('--unique', type=float, default=0.8,
+                        help='share of generate/stream/batch requests with a never-seen product (rest hit the cache)')
+    parser.add_argument('--latency', type=float, default=400, help='mock upstream latency in ms')
+    parser.add_argument('--image-latency', type=float, help='mock DeepAI latency in ms (default: --latency)')
+    parser.add_argument('--order-latency', type=float, help='mock Razorpay latency in ms (default: --latency / 2)')
+    parser.add_argument('--jitter', type=float, default=100, help='+/- ms added to every mock delay')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of mock calls answering 5xx')
+    parser.add_argument('--stream-tokens', type=int, default=20, help='tokens per streamed completion')
+    parser.add_argument('--token-delay', type=float, default=20, help='ms between streamed tokens')
+    parser.add_argument('--image-chunk-delay', type=float, default=0,
+                        help='ms between 4 KiB chunks of a mock image download (default: send at once)')
+    parser.add_argument('--keep-alive', action='store_true', help='reuse one connection per client thread')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='extra environment for server.py, e.g. --env SERVER_WORKERS=64')
+    parser.add_argument('--output', default='bench_results.json', help='where to write the JSON results')
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    settings = {
+        'copy_latency': args.latency,
+        'image_latency': args.image_latency if args.image_latency is not None else args.latency,
+        'order_latency': args.order_latency if args.order_latency is not None else args.latency / 2,
+        'jitter': args.jitter,
+        'error_rate': args.error_rate,
+        'stream_tokens': args.stream_tokens,
+        'token_delay': args.token_delay,
+        'image_chunk_delay': args.image_chunk_delay,
+    }
+    extra_env = dict(item.split('=', 1) for item in args.env)
+    mock = start_mock(settings)
+    upstream_url = f'http://127.0.0.1:{mock.server_port}'
+
+    results = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': sys.version.split()[0],
+        'config': dict(vars(args), mix=mix, mock=settings),
+        'modes': {},
+    }
+    for mode in [mode.strip() for mode in args.modes.split(',') if mode.strip()]:
+        port = free_port()
+        with tempfile.TemporaryDirectory(prefix='adgen-bench-') as workdir:
+            print(f"🚀 {mode}: server on port {port}, mock upstreams on {upstream_url}, "
+                  f"{args.concurrency} clients for {args.duration:g}s")
+            process = start_server(mode, port, upstream_url, workdir, extra_env)
+            try:
+                samples, failures = run_load(Driver(port, args.unique, args.keep_alive), mix, args.concurrency, args.duration, args.warmup)
+            finally:
+                process.terminate()
+                try:
+                    process.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+        routes = summarize(samples, failures, args.duration)
+        results['modes'][mode] = routes
+        print_report(mode, routes)
+
+    mock.shutdown()
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\n💾 Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
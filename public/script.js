@@ -282,6 +282,11 @@ if (window.adGeneratorLoaded || window.scriptInitialized) {
             return;
         }
 
+        // Regenerate asks the server for a fresh variation instead of a cached result
+        if (event.newVariation) {
+            formData.newVariation = true;
+        }
+
         // Show loading state
         showLoading();
         document.getElementById('resultSection').style.display = 'block';
@@ -305,17 +310,13 @@ if (window.adGeneratorLoaded || window.scriptInitialized) {
                 // Display results first
                 displayResults(result);
 
-                // Save ad to Firebase
-                if (user && typeof window.saveAd === 'function') {
+                // Save ad to the user's history
+                if (user) {
                     try {
-                        const adData = {
-                            ...formData,
-                            adCopy: result.ad_copy
-                        };
-                        await window.saveAd(adData, result.image_url);
-                        console.log('✅ Ad saved to Firebase successfully');
+                        await saveAdToHistory(formData, result);
+                        console.log('✅ Ad saved to history');
                     } catch (saveError) {
-                        console.error('Failed to save ad to Firebase:', saveError);
+                        console.error('Failed to save ad to history:', saveError);
                     }
                 }
 
@@ -564,6 +565,32 @@ if (window.adGeneratorLoaded || window.scriptInitialized) {
         }
     }
 
+    async function saveAdToHistory(formData, result) {
+        const firebaseUser = typeof firebase !== 'undefined' && firebase.auth ? firebase.auth().currentUser : null;
+        if (!firebaseUser) {
+            return;
+        }
+
+        // The server takes the user from the verified ID token, not from the body
+        const idToken = await firebaseUser.getIdToken();
+        const response = await fetch('/api/history', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'Authorization': `Bearer ${idToken}`
+            },
+            body: JSON.stringify({
+                formData: formData,
+                textContent: result.ad_copy,
+                imageUrl: result.image_url
+            })
+        });
+
+        if (!response.ok) {
+            throw new Error(`History save failed: ${response.status}`);
+        }
+    }
+
     async function displayResults(result) {
         console.log('🖼️ Displaying results with:', {result});
 
@@ -704,7 +731,7 @@ if (window.adGeneratorLoaded || window.scriptInitialized) {
     function regenerateAd() {
         const formData = collectFormData();
         if (validateFormData(formData)) {
-            handleFormSubmission({ preventDefault: () => {} });
+            handleFormSubmission({ preventDefault: () => {}, newVariation: true });
         }
     }
 
@@ -994,7 +1021,7 @@ if (window.adGeneratorLoaded || window.scriptInitialized) {
         console.log('🧪 Form data:', formData);
         if (validateFormData(formData)) {
             console.log('✅ Form data is valid');
-            handleFormSubmission({ preventDefault: () => {} });
+            handleFormSubmission({ preventDefault: () => {}, newVariation: true });
         } else {
             console.log('❌ Form data is invalid');
         }
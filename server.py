@@ -3,497 +3,4813 @@ import os
 import json
 from http.server import HTTPServer, SimpleHTTPRequestHandler
 import requests
+from requests.adapters import HTTPAdapter
+import urllib3
 import logging
-from urllib.parse import urlparse, parse_qs
+import logging.handlers
+import copy
+from datetime import datetime, timezone
+import random
+from urllib.parse import urlparse, parse_qs, urlencode, unquote
 import socketserver
+import asyncio
+import ssl
+import io
+import sys
+import argparse
+from email.utils import formatdate
+from http import HTTPStatus
 import threading
+import queue
+import signal
 import time
 import hmac
 import hashlib
+import base64
 import uuid
+import bisect
+import gzip
+import mimetypes
+import shutil
+import tempfile
+import sqlite3
+import contextvars
+import select
+import socket
+import subprocess
+from contextlib import aclosing
+from collections import OrderedDict, deque
+try:
+    import brotli  # optional: adds br variants to the static asset cache
+except ImportError:
+    brotli = None
+try:
+    from PIL import Image  # optional: thumbnails for stored images
+except ImportError:
+    Image = None
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait, FIRST_COMPLETED
 
-class AdGeneratorHandler(SimpleHTTPRequestHandler):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, directory="public", **kwargs)
+# Shared pool for outbound DeepSeek/DeepAI calls so one request can fan out
+UPSTREAM_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.getenv('UPSTREAM_THREADS', 32)),
+    thread_name_prefix='upstream'
+)
 
-    def end_headers(self):
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        super().end_headers()
+# Overall budget for copy + image generation, in seconds
+GENERATION_DEADLINE = float(os.getenv('GENERATION_DEADLINE', 45))
 
-    def do_OPTIONS(self):
-        self.send_response(200)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        self.end_headers()
+# Limits for /generate-ad/batch
+BATCH_MAX_VARIANTS = int(os.getenv('BATCH_MAX_VARIANTS', 12))
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', 4))
 
-    def do_GET(self):
-        parsed_path = urlparse(self.path)
+# HTTP/1.1 keep-alive: seconds a connection may sit idle between requests, and requests per connection
+KEEPALIVE_TIMEOUT = float(os.getenv('KEEPALIVE_TIMEOUT', 5))
+KEEPALIVE_MAX_REQUESTS = int(os.getenv('KEEPALIVE_MAX_REQUESTS', 100))
+# Seconds a client may stall while sending a request, so a stuck one can't hold a worker
+REQUEST_TIMEOUT = float(os.getenv('REQUEST_TIMEOUT', 30))
+# How often an idle kept-alive connection checks whether others are queued for its thread
+KEEPALIVE_POLL_INTERVAL = 0.1
 
-        if parsed_path.path == '/config.js' or parsed_path.path == '/api/config.js':
-            self.serve_config()
-        elif parsed_path.path == '/sitemap.xml':
-            self.serve_sitemap()
-        elif parsed_path.path == '/robots.txt':
-            self.serve_robots()
-        elif parsed_path.path.startswith('/api/'):
-            self.handle_api_request()
+# JSON responses at least this large are gzipped for clients that accept it
+JSON_GZIP_MIN_BYTES = int(os.getenv('JSON_GZIP_MIN_BYTES', 1024))
+
+
+class MetricsRegistry:
+    """Thread-safe counters, gauges and histograms rendered in Prometheus text format.
+
+    Metrics are declared once with ``describe()`` and then updated by name
+    with keyword labels.  Values that live elsewhere (queue depth, cache
+    counters) are pulled at render time from functions passed to
+    ``register_collector()``, each returning ``(name, labels, value)`` samples.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.meta = {}  # name -> (type, help, buckets)
+        self.values = {}  # (name, labels) -> value, for counters and gauges
+        self.histograms = {}  # (name, labels) -> [per-bucket counts..., sum, count]
+        self.collectors = []
+
+    def describe(self, name, kind, help_text, buckets=None):
+        self.meta[name] = (kind, help_text, tuple(buckets) if buckets else None)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, tuple(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        buckets = self.meta[name][2]
+        key = (name, tuple(labels.items()))
+        index = bisect.bisect_left(buckets, value)
+        with self.lock:
+            series = self.histograms.get(key)
+            if series is None:
+                series = self.histograms[key] = [0] * (len(buckets) + 3)
+            series[index] += 1  # index == len(buckets) is the +Inf bucket
+            series[-2] += value
+            series[-1] += 1
+
+    def register_collector(self, collector):
+        self.collectors.append(collector)
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+        return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+    def snapshot(self):
+        """Copy of every series, including collector samples, as plain dicts"""
+        with self.lock:
+            values = dict(self.values)
+            histograms = {key: list(series) for key, series in self.histograms.items()}
+        for collector in self.collectors:
+            try:
+                for name, labels, value in collector():
+                    values[(name, tuple(labels.items()))] = value
+            except Exception as e:
+                log.warning(f"⚠️ Metrics collector failed: {e}")
+        return values, histograms
+
+    def render(self, values=None, histograms=None):
+        if values is None:
+            values, histograms = self.snapshot()
+        by_name = {}
+        for (name, labels), value in values.items():
+            by_name.setdefault(name, []).append((labels, value))
+        for (name, labels), series in histograms.items():
+            by_name.setdefault(name, []).append((labels, series))
+
+        lines = []
+        for name in sorted(by_name):
+            kind, help_text, buckets = self.meta.get(name, ('untyped', '', None))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(by_name[name], key=lambda item: item[0]):
+                if kind != 'histogram':
+                    lines.append(f"{name}{self.format_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(buckets) + ['+Inf'], value[:-2]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self.format_labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_sum{self.format_labels(labels)} {value[-2]}")
+                lines.append(f"{name}_count{self.format_labels(labels)} {value[-1]}")
+        return '\n'.join(lines) + '\n'
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+METRICS = MetricsRegistry()
+METRICS.describe('http_requests_total', 'counter', 'HTTP requests served, by route, method and status')
+METRICS.describe('http_request_duration_seconds', 'histogram', 'Time to serve an HTTP request', LATENCY_BUCKETS)
+METRICS.describe('http_requests_in_flight', 'gauge', 'HTTP requests currently being served')
+METRICS.describe('upstream_requests_total', 'counter', 'Calls to upstream APIs, by provider and status')
+METRICS.describe('upstream_request_duration_seconds', 'histogram', 'Upstream call latency up to response headers', LATENCY_BUCKETS)
+METRICS.describe('upstream_requests_in_flight', 'gauge', 'Upstream calls currently waiting on a response')
+METRICS.describe('upstream_sent_bytes_total', 'counter', 'Request body bytes sent upstream')
+METRICS.describe('upstream_received_bytes_total', 'counter', 'Response body bytes received from upstream')
+METRICS.describe('server_queue_depth', 'gauge', 'Accepted connections waiting for a worker')
+METRICS.describe('server_workers', 'gauge', 'Worker threads in the pool')
+METRICS.describe('server_generation_slots_in_use', 'gauge', 'Worker threads busy with a generation request')
+METRICS.describe('ad_cache_entries', 'gauge', 'Entries in the generation result cache')
+METRICS.describe('ad_cache_hits_total', 'counter', 'Generation result cache hits')
+METRICS.describe('ad_cache_misses_total', 'counter', 'Generation result cache misses')
+METRICS.describe('ad_cache_coalesced_total', 'counter', 'Generation calls that joined an identical in-flight call')
+METRICS.describe('log_records_dropped_total', 'counter', 'Log records dropped because the log queue was full')
+METRICS.describe('upstream_admission_rejected_total', 'counter', 'Upstream calls refused before being sent, by provider and reason')
+METRICS.describe('upstream_admission_active', 'gauge', 'Admission slots in use, by provider')
+METRICS.describe('upstream_admission_waiting', 'gauge', 'Calls queued for an admission slot, by provider')
+METRICS.describe('upstream_circuit_state', 'gauge', 'Circuit breaker state by provider: 0 closed, 1 half-open, 2 open')
+METRICS.describe('upstream_read_timeout_seconds', 'gauge', 'Current adaptive read timeout, by provider')
+METRICS.describe('jobs', 'gauge', 'Generation jobs in the job store, by status')
+
+# Routes reported by name; anything else is folded into "static" or "other"
+METRIC_ROUTES = {
+    '/generate-ad', '/generate-ad/stream', '/generate-ad/batch', '/config.js', '/api/config.js',
+    '/api/create-razorpay-order', '/api/verify-payment', '/api/metrics', '/api/cache-stats', '/api/upstreams',
+    '/api/jobs', '/api/history', '/save-ad',
+    '/sitemap.xml', '/robots.txt',
+}
+
+
+def route_label(path):
+    """Bounded-cardinality route name for request metrics"""
+    if path in METRIC_ROUTES:
+        return path
+    if path.startswith('/api/jobs/'):
+        return '/api/jobs/:id'
+    return 'other' if path.startswith('/api/') else 'static'
+
+
+def record_request(path, method, status, started):
+    route = route_label(path)
+    METRICS.inc('http_requests_total', route=route, method=method, status=str(status))
+    METRICS.observe('http_request_duration_seconds', time.perf_counter() - started, route=route, method=method)
+
+
+def record_upstream(provider, status, started, sent=0, received=0):
+    METRICS.inc('upstream_requests_total', provider=provider, status=str(status))
+    METRICS.observe('upstream_request_duration_seconds', time.perf_counter() - started, provider=provider)
+    METRICS.inc('upstream_sent_bytes_total', sent, provider=provider)
+    METRICS.inc('upstream_received_bytes_total', received, provider=provider)
+
+
+log = logging.getLogger('adgen')
+
+
+class JsonLineFormatter(logging.Formatter):
+    """One JSON object per record; ``extra={'fields': {...}}`` adds structured fields"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a record carrying ``sample_rate`` with that probability"""
+
+    def filter(self, record):
+        rate = getattr(record, 'sample_rate', 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of blocking when the queue is full"""
+
+    def prepare(self, record):
+        # Resolve the message and traceback now; args and frames may change once we return
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            METRICS.inc('log_records_dropped_total')
+
+
+def setup_logging():
+    """Route the adgen logger through a bounded queue to a background writer thread.
+
+    Request threads only format the message and enqueue it; JSON encoding and
+    the stdout/file writes happen on the listener thread.  Returns the
+    started QueueListener so the caller can flush it on shutdown.
+    """
+    if os.getenv('LOG_FORMAT', 'json') == 'text':
+        formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+    else:
+        formatter = JsonLineFormatter()
+
+    outputs = [logging.StreamHandler(sys.stdout)]
+    if os.getenv('LOG_FILE'):
+        outputs.append(logging.FileHandler(os.getenv('LOG_FILE')))
+    for output in outputs:
+        output.setFormatter(formatter)
+
+    records = queue.Queue(maxsize=int(os.getenv('LOG_QUEUE_SIZE', 10000)))
+    handler = DroppingQueueHandler(records)
+    handler.addFilter(SamplingFilter())
+    log.handlers[:] = [handler]
+    log.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+    log.propagate = False
+
+    listener = logging.handlers.QueueListener(records, *outputs, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+# Access-log routes that are hit on every page load; only a sample of their successes is logged
+LOG_SAMPLED_ROUTES = {'static', '/config.js', '/api/config.js', '/api/metrics'}
+LOG_ACCESS_SAMPLE_RATE = float(os.getenv('LOG_ACCESS_SAMPLE_RATE', 0.1))
+
+
+def log_access(client, method, path, status, started):
+    route = route_label(path)
+    sample_rate = 1.0
+    if route in LOG_SAMPLED_ROUTES and str(status).isdigit() and int(status) < 400:
+        sample_rate = LOG_ACCESS_SAMPLE_RATE
+    log.info(f"{method} {path} {status}", extra={
+        'sample_rate': sample_rate,
+        'fields': {
+            'type': 'access',
+            'client': client,
+            'method': method,
+            'path': path,
+            'route': route,
+            'status': status,
+            'duration_ms': round((time.perf_counter() - started) * 1000, 2),
+        }
+    })
+
+
+class UpstreamRejected(Exception):
+    """Raised instead of calling a provider that is saturated or whose breaker is open.
+
+    ``status`` is what the client should see (429 when the wait queue is full,
+    503 otherwise) and ``retry_after`` the suggested delay in seconds.
+    """
+
+    def __init__(self, provider, reason, status, retry_after):
+        super().__init__(f"{provider} is unavailable ({reason}), retry in {retry_after}s")
+        self.provider = provider
+        self.reason = reason
+        self.status = status
+        self.retry_after = retry_after
+
+    def body(self):
+        return {
+            'success': False,
+            'error': f'{self.provider} is busy, please try again shortly',
+            'retry_after': self.retry_after
+        }
+
+
+class AdmissionGate:
+    """Caps concurrent calls to one provider, with a bounded queue of waiters.
+
+    A caller that finds all ``limit`` slots taken waits up to ``queue_timeout``
+    seconds; once ``max_waiting`` callers are already waiting, further ones
+    are turned away immediately.  Threads wait on a condition; coroutines
+    wait on a future that ``release()`` resolves through its event loop.
+    """
+
+    def __init__(self, name, limit, max_waiting, queue_timeout):
+        self.name = name
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self.cond = threading.Condition()
+        self.async_waiters = deque()  # (loop, future) per waiting coroutine
+
+    def _take_slot(self):
+        if self.active < self.limit:
+            self.active += 1
+            return True
+        return False
+
+    def _reject(self, reason, status):
+        METRICS.inc('upstream_admission_rejected_total', provider=self.name, reason=reason)
+        raise UpstreamRejected(self.name, reason, status, max(1, round(self.queue_timeout)))
+
+    def acquire(self):
+        with self.cond:
+            if self._take_slot():
+                return
+            if self.waiting >= self.max_waiting:
+                self._reject('queue_full', 429)
+            self.waiting += 1
+            try:
+                if not self.cond.wait_for(self._take_slot, self.queue_timeout):
+                    self._reject('queue_timeout', 503)
+            finally:
+                self.waiting -= 1
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        with self.cond:
+            if self._take_slot():
+                return
+            if self.waiting >= self.max_waiting:
+                self._reject('queue_full', 429)
+            self.waiting += 1
+        deadline = loop.time() + self.queue_timeout
+        try:
+            while True:
+                waiter = loop.create_future()
+                with self.cond:
+                    if self._take_slot():
+                        return
+                    self.async_waiters.append((loop, waiter))
+                try:
+                    await asyncio.wait_for(waiter, max(0, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    with self.cond:
+                        if self._take_slot():
+                            return
+                    self._reject('queue_timeout', 503)
+                finally:
+                    with self.cond:
+                        if (loop, waiter) in self.async_waiters:
+                            self.async_waiters.remove((loop, waiter))
+        except BaseException:
+            # Pass on a wakeup this waiter may have swallowed on its way out
+            with self.cond:
+                if self.active < self.limit:
+                    self._wake_one()
+            raise
+        finally:
+            with self.cond:
+                self.waiting -= 1
+
+    def _wake_one(self):
+        self.cond.notify()
+        if self.async_waiters:
+            loop, waiter = self.async_waiters.popleft()
+            loop.call_soon_threadsafe(self._resolve, waiter)
+
+    @staticmethod
+    def _resolve(waiter):
+        if not waiter.done():
+            waiter.set_result(None)
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self._wake_one()
+
+    def state(self):
+        with self.cond:
+            return {'active': self.active, 'waiting': self.waiting, 'limit': self.limit,
+                    'max_waiting': self.max_waiting}
+
+
+class CircuitBreaker:
+    """Closed/open/half-open breaker over a sliding window of recent calls.
+
+    A call counts as failed when it errors, answers 429/5xx or takes longer
+    than ``slow_call`` seconds.  Once ``min_calls`` are in the window and the
+    failed share reaches ``failure_rate`` the breaker opens and rejects calls
+    for ``cooldown`` seconds; then a single probe is let through and its
+    outcome decides between closing again and another cooldown.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, name, failure_rate=0.5, slow_call=20, window=20, min_calls=10, cooldown=30):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.slow_call = slow_call
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.outcomes = deque(maxlen=window)
+        self.status = self.CLOSED
+        self.opened_at = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        with self.lock:
+            if self.status == self.CLOSED:
+                return
+            remaining = self.opened_at + self.cooldown - time.monotonic()
+            if self.status == self.OPEN and remaining <= 0:
+                self.status = self.HALF_OPEN
+            if self.status == self.HALF_OPEN and not self.probing:
+                self.probing = True
+                return
+        METRICS.inc('upstream_admission_rejected_total', provider=self.name, reason='circuit_open')
+        raise UpstreamRejected(self.name, 'circuit open', 503, max(1, round(remaining)))
+
+    def record(self, ok, elapsed):
+        failed = not ok or elapsed > self.slow_call
+        with self.lock:
+            if self.status == self.HALF_OPEN:
+                self.probing = False
+                if failed:
+                    self._open()
+                else:
+                    self.status = self.CLOSED
+                    self.outcomes.clear()
+                    log.info(f"✅ {self.name} circuit closed again")
+                return
+            self.outcomes.append(failed)
+            if (self.status == self.CLOSED and len(self.outcomes) >= self.min_calls
+                    and sum(self.outcomes) >= self.failure_rate * len(self.outcomes)):
+                self._open()
+
+    def abandon(self):
+        """Forget a call that was cancelled before it had an outcome"""
+        with self.lock:
+            self.probing = False
+
+    def _open(self):
+        self.status = self.OPEN
+        self.opened_at = time.monotonic()
+        self.outcomes.clear()
+        log.warning(f"⚠️ {self.name} circuit opened, failing fast for {self.cooldown}s")
+
+    def state(self):
+        with self.lock:
+            return {'state': self.status, 'recent_calls': len(self.outcomes),
+                    'recent_failures': sum(self.outcomes)}
+
+
+class LatencyTracker:
+    """Recent successful call latencies, used to tighten a provider's read timeout.
+
+    Until ``min_samples`` calls have been seen the configured timeout is used;
+    after that it is ``multiplier`` times the recent p99, kept between
+    ``floor`` and the configured value.
+    """
+
+    def __init__(self, ceiling, floor=5, multiplier=3, window=200, min_samples=20):
+        self.ceiling = ceiling
+        self.floor = min(floor, ceiling)
+        self.multiplier = multiplier
+        self.min_samples = min_samples
+        self.samples = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def observe(self, elapsed):
+        with self.lock:
+            self.samples.append(elapsed)
+
+    def timeout(self):
+        with self.lock:
+            if len(self.samples) < self.min_samples:
+                return self.ceiling
+            ordered = sorted(self.samples)
+        p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+        return min(self.ceiling, max(self.floor, p99 * self.multiplier))
+
+
+# Methods that may be sent again after the upstream could already have acted on them
+RETRY_SAFE_METHODS = frozenset({'GET', 'HEAD', 'OPTIONS'})
+
+
+def request_was_sent(error):
+    """Whether a requests ConnectionError happened after the request went out, rather than while connecting"""
+    if isinstance(error, requests.ConnectTimeout):
+        return False
+    reason = error.args[0] if error.args else None
+    # Connect failures arrive wrapped in urllib3's MaxRetryError; NewConnectionError subclasses ConnectTimeoutError
+    return not isinstance(getattr(reason, 'reason', reason), urllib3.exceptions.ConnectTimeoutError)
+
+
+class UpstreamClient:
+    """Keep-alive HTTP client for one upstream provider.
+
+    Each provider gets its own ``requests.Session`` with a sized connection
+    pool, so repeated calls reuse TCP+TLS connections.  Connection errors and
+    retryable status codes are retried with jittered exponential backoff,
+    honouring ``Retry-After`` when the upstream sends one.  A POST whose
+    connection dropped after it was sent is not retried, since the upstream
+    may have processed it.
+
+    Every attempt passes an AdmissionGate (``max_concurrency`` calls at once,
+    ``max_waiting`` queued for up to ``queue_timeout`` seconds) and a
+    CircuitBreaker, and its read timeout adapts to recent latencies up to
+    ``timeout``.  Both raise UpstreamRejected rather than calling out.
+    Calls made through AsyncUpstreamClient pass a separate gate allowing
+    ``async_max_concurrency`` at once, since they don't tie up a thread or
+    a pooled connection.
+    """
+
+    def __init__(self, name, base_url, timeout=30, connect_timeout=5, pool_size=10,
+                 retries=2, backoff=0.5, backoff_max=8, retry_statuses=(429, 500, 502, 503, 504),
+                 max_concurrency=None, max_waiting=50, queue_timeout=5,
+                 failure_rate=0.5, slow_call=20, cooldown=30, min_timeout=5, async_max_concurrency=100):
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.retry_statuses = frozenset(retry_statuses)
+        self.pool_size = pool_size
+
+        self.gate = AdmissionGate(name, max_concurrency or pool_size, max_waiting, queue_timeout)
+        self.async_gate = AdmissionGate(name, async_max_concurrency, max_waiting, queue_timeout)
+        self.breaker = CircuitBreaker(name, failure_rate, slow_call, cooldown=cooldown)
+        self.latency = LatencyTracker(timeout, floor=min_timeout)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @classmethod
+    def from_env(cls, name, base_url, **defaults):
+        """Build a client, letting <NAME>_API_URL, <NAME>_TIMEOUT etc. override the defaults"""
+        prefix = name.upper()
+        settings = {
+            'timeout': float, 'connect_timeout': float, 'pool_size': int,
+            'retries': int, 'backoff': float, 'backoff_max': float,
+            'max_concurrency': int, 'max_waiting': int, 'queue_timeout': float,
+            'failure_rate': float, 'slow_call': float, 'cooldown': float, 'min_timeout': float,
+            'async_max_concurrency': int,
+        }
+        for key, cast in settings.items():
+            value = os.getenv(f'{prefix}_{key.upper()}')
+            if value:
+                defaults[key] = cast(value)
+        return cls(name, os.getenv(f'{prefix}_API_URL', base_url), **defaults)
+
+    def read_timeout(self):
+        return self.latency.timeout()
+
+    def admit(self):
+        """Take an admission slot and pass the breaker, or raise UpstreamRejected"""
+        self.gate.acquire()
+        try:
+            self.breaker.before_call()
+        except UpstreamRejected:
+            self.gate.release()
+            raise
+
+    async def admit_async(self):
+        """admit() for the asyncio engine, through ``async_gate``"""
+        await self.async_gate.acquire_async()
+        try:
+            self.breaker.before_call()
+        except UpstreamRejected:
+            self.async_gate.release()
+            raise
+
+    def record_outcome(self, status, started):
+        """Feed one call's status ('error' if it raised) and latency to the breaker and timeout"""
+        elapsed = time.perf_counter() - started
+        ok = status != 'error' and status != 429 and status < 500
+        self.breaker.record(ok, elapsed)
+        if ok:
+            self.latency.observe(elapsed)
+
+    def state(self):
+        return dict(self.breaker.state(), admission=self.gate.state(), async_admission=self.async_gate.state(),
+                    read_timeout=round(self.read_timeout(), 2))
+
+    def backoff_delay(self, attempt, response=None):
+        """Seconds to sleep before retry number ``attempt`` (0-based)"""
+        if response is not None:
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                return min(float(retry_after), self.backoff_max)
+        delay = min(self.backoff * (2 ** attempt), self.backoff_max)
+        return random.uniform(delay / 2, delay)  # jitter so retries don't arrive in lockstep
+
+    def request(self, method, path, **kwargs):
+        url = self.base_url + path
+
+        for attempt in range(self.retries + 1):
+            self.admit()
+            started = time.perf_counter()
+            METRICS.inc('upstream_requests_in_flight', provider=self.name)
+            response = error = None
+            try:
+                response = self.session.request(method, url, **dict(
+                    {'timeout': (self.timeout[0], self.read_timeout())}, **kwargs))
+            except requests.RequestException as e:
+                error = e
+            finally:
+                METRICS.inc('upstream_requests_in_flight', -1, provider=self.name)
+                self.gate.release()
+                self.record_outcome(response.status_code if response is not None else 'error', started)
+
+            if error is not None:
+                record_upstream(self.name, 'error', started)
+                if (attempt >= self.retries or not isinstance(error, requests.ConnectionError)
+                        or (method not in RETRY_SAFE_METHODS and request_was_sent(error))):
+                    raise error
+                delay = self.backoff_delay(attempt)
+                log.warning(f"🔁 {self.name} connection error ({error}), retrying in {delay:.2f}s")
+                time.sleep(delay)
+                continue
+
+            # Streamed bodies are not read yet; count what the upstream announced
+            received = int(response.headers.get('Content-Length') or 0) if kwargs.get('stream') else len(response.content)
+            record_upstream(self.name, response.status_code, started, len(response.request.body or b''), received)
+
+            if response.status_code in self.retry_statuses and attempt < self.retries:
+                delay = self.backoff_delay(attempt, response)
+                log.warning(f"🔁 {self.name} returned {response.status_code}, retrying in {delay:.2f}s")
+                response.close()
+                time.sleep(delay)
+                continue
+            return response
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+
+DEEPSEEK = UpstreamClient.from_env('deepseek', 'https://api.deepseek.com', timeout=30)
+DEEPAI = UpstreamClient.from_env('deepai', 'https://api.deepai.org', timeout=30)
+# Order creation is not idempotent upstream, so only retry answers that mean "not processed"
+RAZORPAY = UpstreamClient.from_env('razorpay', 'https://api.razorpay.com', timeout=30,
+                                   retries=1, retry_statuses=(429, 503))
+# Checks Firebase ID tokens for the history routes
+FIREBASE_AUTH = UpstreamClient.from_env('firebase', 'https://identitytoolkit.googleapis.com', timeout=10)
+UPSTREAMS = (DEEPSEEK, DEEPAI, RAZORPAY, FIREBASE_AUTH)
+CIRCUIT_STATE_VALUES = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+
+
+def collect_upstream_metrics():
+    samples = []
+    for client in UPSTREAMS:
+        state = client.state()
+        admissions = (state['admission'], state['async_admission'])
+        samples += [
+            ('upstream_admission_active', {'provider': client.name}, sum(gate['active'] for gate in admissions)),
+            ('upstream_admission_waiting', {'provider': client.name}, sum(gate['waiting'] for gate in admissions)),
+            ('upstream_circuit_state', {'provider': client.name}, CIRCUIT_STATE_VALUES[state['state']]),
+            ('upstream_read_timeout_seconds', {'provider': client.name}, state['read_timeout']),
+        ]
+    return samples
+
+
+METRICS.register_collector(collect_upstream_metrics)
+
+
+class AsyncResponse:
+    """Just enough of requests.Response for the asyncio code paths"""
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class ResponseLost(ConnectionError):
+    """A request reached the upstream but no complete answer came back, so it may have been processed"""
+
+
+class AsyncUpstreamClient:
+    """asyncio counterpart of UpstreamClient, sharing its settings and retry policy.
+
+    Speaks plain HTTP/1.1 over asyncio streams and keeps idle connections
+    around for reuse, so an in-flight call costs a coroutine and a socket
+    rather than a thread.  ``max_connections`` caps concurrent sockets per
+    provider.
+    """
+
+    def __init__(self, client, max_connections=100):
+        self.client = client
+        parsed = urlparse(client.base_url)
+        self.https = parsed.scheme == 'https'
+        self.host = parsed.hostname
+        self.port = parsed.port or (443 if self.https else 80)
+        self.netloc = parsed.netloc
+        self.base_path = parsed.path
+        self.max_idle = client.pool_size
+        self.connections = asyncio.Semaphore(max_connections)
+        self._ssl = None
+        self._idle = []
+
+    async def _connect(self):
+        while self._idle:
+            reader, writer = self._idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        if self.https and self._ssl is None:
+            self._ssl = ssl.create_default_context()
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port, ssl=self._ssl),
+                self.client.timeout[0]
+            )
+        except asyncio.TimeoutError:
+            # Nothing was sent yet, so unlike a read timeout this one may be retried
+            raise ConnectionError(f"Timed out connecting to {self.netloc}") from None
+        return reader, writer, False
+
+    def _release(self, reader, writer, reusable):
+        if reusable and len(self._idle) < self.max_idle:
+            self._idle.append((reader, writer))
         else:
-            super().do_GET()
+            writer.close()
 
-    def serve_sitemap(self):
-        """Serve sitemap.xml"""
+    @staticmethod
+    async def _read_head(reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError("Connection closed before response")
+        parts = status_line.decode('latin-1').split(None, 2)
+        version, status = parts[0], int(parts[1])
+
+        headers = requests.structures.CaseInsensitiveDict()
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip()] = value.strip()
+        reusable = version == 'HTTP/1.1' and headers.get('Connection', '').lower() != 'close'
+        return status, headers, reusable
+
+    @staticmethod
+    async def _iter_body(reader, headers, timeout=None):
+        """Yield the raw response body in chunks, undoing chunked transfer encoding"""
+        if headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size_line = await asyncio.wait_for(reader.readline(), timeout)
+                size = int(size_line.split(b';')[0].strip(), 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    return
+                yield await asyncio.wait_for(reader.readexactly(size), timeout)
+                await reader.readline()
+        elif 'Content-Length' in headers:
+            remaining = int(headers['Content-Length'])
+            while remaining:
+                chunk = await asyncio.wait_for(reader.read(min(remaining, 65536)), timeout)
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b'', remaining)
+                remaining -= len(chunk)
+                yield chunk
+        else:
+            while True:
+                chunk = await asyncio.wait_for(reader.read(65536), timeout)
+                if not chunk:
+                    return
+                yield chunk
+
+    @staticmethod
+    def _framed(headers):
+        """Whether the body length is known, so the connection can be reused afterwards"""
+        return headers.get('Transfer-Encoding', '').lower() == 'chunked' or 'Content-Length' in headers
+
+    def _request_bytes(self, method, path, headers, body):
+        head = [f"{method} {self.base_path}{path} HTTP/1.1", f"Host: {self.netloc}",
+                f"Content-Length: {len(body)}", "Connection: keep-alive"]
+        head += [f"{name}: {value}" for name, value in headers.items()]
+        return ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body
+
+    async def _send(self, method, path, headers, body):
+        """Send one request and read its answer.
+
+        Failures once the request has been written raise ResponseLost for
+        methods outside RETRY_SAFE_METHODS, since the upstream may have acted
+        on it.
+        """
+        async with self.connections:
+            for fresh_retry in (False, True):
+                reader, writer, reused = await self._connect()
+                try:
+                    writer.write(self._request_bytes(method, path, headers, body))
+                    await writer.drain()
+                except BaseException:
+                    writer.close()
+                    raise
+
+                async def read_response():
+                    status, response_headers, reusable = await self._read_head(reader)
+                    content = b''.join([chunk async for chunk in self._iter_body(reader, response_headers)])
+                    return status, response_headers, content, reusable and self._framed(response_headers)
+
+                try:
+                    status, response_headers, content, reusable = await asyncio.wait_for(
+                        read_response(), self.client.read_timeout()
+                    )
+                except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                    writer.close()
+                    if method not in RETRY_SAFE_METHODS:
+                        raise ResponseLost(f"{self.client.name} {method} {path} sent but not answered: {e!r}") from e
+                    # An idle keep-alive socket may have been closed by the upstream meanwhile
+                    if reused and not fresh_retry and not isinstance(e, asyncio.TimeoutError):
+                        continue
+                    raise
+                except BaseException:
+                    writer.close()
+                    raise
+                self._release(reader, writer, reusable)
+                return AsyncResponse(status, response_headers, content)
+
+    async def stream_lines(self, path, headers=None, json_body=None):
+        """POST ``json_body`` and yield the response body line by line as it arrives.
+
+        Each read gets the provider's read timeout.  A non-200 answer raises
+        instead of yielding.  Closing the generator early drops the connection.
+        """
+        headers = dict(headers or {})
+        headers.setdefault('Content-Type', 'application/json')
+        body = json.dumps(json_body).encode('utf-8')
+        client = self.client
+        read_timeout = client.read_timeout()
+
+        # The admission slot is held for the whole stream; the breaker only sees time to first byte
+        await client.admit_async()
+        started = time.perf_counter()
+        recorded = False
         try:
-            with open('public/sitemap.xml', 'r') as f:
-                sitemap_content = f.read()
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/xml')
-            self.send_header('Cache-Control', 'max-age=86400')  # Cache for 1 day
-            self.end_headers()
-            self.wfile.write(sitemap_content.encode())
+            async with self.connections:
+                reader, writer, _ = await self._connect()
+                completed = reusable = False
+                try:
+                    writer.write(self._request_bytes('POST', path, headers, body))
+                    await writer.drain()
+                    status, response_headers, reusable = await asyncio.wait_for(self._read_head(reader), read_timeout)
+                    reusable = reusable and self._framed(response_headers)
+                    record_upstream(self.client.name, status, started, len(body),
+                                    int(response_headers.get('Content-Length') or 0))
+                    client.record_outcome(status, started)
+                    recorded = True
+
+                    if status != 200:
+                        content = b''.join([chunk async for chunk in self._iter_body(reader, response_headers, read_timeout)])
+                        completed = True
+                        raise Exception(f"{self.client.name} API error: {status} - {content[:200].decode('utf-8', 'replace')}")
+
+                    buffer = b''
+                    async for chunk in self._iter_body(reader, response_headers, read_timeout):
+                        buffer += chunk
+                        *lines, buffer = buffer.split(b'\n')
+                        for line in lines:
+                            yield line.rstrip(b'\r').decode('utf-8')
+                    if buffer:
+                        yield buffer.rstrip(b'\r').decode('utf-8')
+                    completed = True
+                finally:
+                    if completed:
+                        self._release(reader, writer, reusable)
+                    else:
+                        writer.close()
+        except (GeneratorExit, asyncio.CancelledError):
+            # The browser went away before the upstream answered; that says nothing about the provider
+            if not recorded:
+                client.breaker.abandon()
+                recorded = True
+            raise
+        finally:
+            client.async_gate.release()
+            if not recorded:
+                client.record_outcome('error', started)
+
+    async def request(self, method, path, headers=None, json_body=None, form=None):
+        headers = dict(headers or {})
+        if json_body is not None:
+            body = json.dumps(json_body).encode('utf-8')
+            headers.setdefault('Content-Type', 'application/json')
+        elif form is not None:
+            body = urlencode(form).encode('utf-8')
+            headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+        else:
+            body = b''
+
+        client = self.client
+        for attempt in range(client.retries + 1):
+            await client.admit_async()
+            started = time.perf_counter()
+            METRICS.inc('upstream_requests_in_flight', provider=client.name)
+            response = error = None
+            try:
+                response = await self._send(method, path, headers, body)
+            except (OSError, asyncio.IncompleteReadError) as e:
+                error = e
+            finally:
+                METRICS.inc('upstream_requests_in_flight', -1, provider=client.name)
+                client.async_gate.release()
+                client.record_outcome(response.status_code if response is not None else 'error', started)
+
+            if error is not None:
+                record_upstream(client.name, 'error', started)
+                # A read timeout or a request that got through unanswered is not sent twice
+                if attempt >= client.retries or isinstance(error, (ResponseLost, asyncio.TimeoutError)):
+                    raise error
+                delay = client.backoff_delay(attempt)
+                log.warning(f"🔁 {client.name} connection error ({error}), retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+                continue
+            record_upstream(client.name, response.status_code, started, len(body), len(response.content))
+
+            if response.status_code in client.retry_statuses and attempt < client.retries:
+                delay = client.backoff_delay(attempt, response)
+                log.warning(f"🔁 {client.name} returned {response.status_code}, retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+                continue
+            return response
+
+    async def post(self, path, **kwargs):
+        return await self.request('POST', path, **kwargs)
+
+
+ASYNC_UPSTREAM_CONNECTIONS = int(os.getenv('ASYNC_UPSTREAM_CONNECTIONS', 100))
+ASYNC_DEEPSEEK = AsyncUpstreamClient(DEEPSEEK, ASYNC_UPSTREAM_CONNECTIONS)
+ASYNC_DEEPAI = AsyncUpstreamClient(DEEPAI, ASYNC_UPSTREAM_CONNECTIONS)
+
+# How each adFormat value from the form is described to the model
+AD_FORMAT_LABELS = {
+    'facebook-feed': 'Facebook feed',
+    'instagram-story': 'Instagram story',
+    'google-search': 'Google search',
+    'whatsapp-status': 'WhatsApp status',
+}
+
+
+def build_ad_copy_payload(data):
+    """DeepSeek chat-completion payload for the ad copy described by a request body"""
+    ad_format = data.get('adFormat')
+    format_label = AD_FORMAT_LABELS.get(str(ad_format).lower(), ad_format) if ad_format else 'Facebook'
+    language = data.get('language', 'English')
+    product_name = data.get('productName', '')
+    product_description = data.get('productDescription', '')
+    target_audience = data.get('targetAudience', '')
+    special_offer = data.get('specialOffer', '')
+    tone = data.get('tone', 'professional')
+
+    prompt = f"""Create a compelling {format_label} ad copy in {language} for:
+Product: {product_name}
+Description: {product_description}
+Target Audience: {target_audience}
+Special Offer: {special_offer}
+Tone: {tone}
+
+Create engaging ad copy that includes:
+1. An attention-grabbing headline
+2. Clear benefits and value proposition
+3. Call to action
+4. Keep it concise and persuasive
+
+Write in {language} language only."""
+
+    return {
+        'model': 'deepseek-chat',
+        'messages': [{'role': 'user', 'content': prompt}],
+        'max_tokens': 300,
+        'temperature': 0.7
+    }
+
+
+def build_image_prompt(data):
+    """DeepAI text2img prompt; only the product name and description matter"""
+    product_name = data.get('productName', '')
+    product_description = data.get('productDescription', '')
+    return f"Professional advertisement image for {product_name}: {product_description}, high quality, modern design, marketing photo"
+
+
+def assemble_ad_response(ad_copy, image_url, image_error=None):
+    """Response body for /generate-ad, flagging a missing image as pending"""
+    response = {
+        'success': True,
+        'ad_copy': ad_copy,
+        'image_url': image_url
+    }
+    if not image_url:
+        log.warning(f"⚠️ Returning ad copy without image: {image_error}")
+        response['image_pending'] = True
+        response['image_error'] = image_error
+    return response
+
+
+# Seconds between SSE comments sent while waiting on the image, to keep proxies from idling out
+SSE_HEARTBEAT_INTERVAL = 10
+
+
+def parse_copy_stream_line(line):
+    """Text carried by one line of a streamed DeepSeek completion; None once it says [DONE]"""
+    if not line.startswith('data:'):
+        return ''
+    payload = line[5:].strip()
+    if payload == '[DONE]':
+        return None
+    choices = json.loads(payload).get('choices') or [{}]
+    return choices[0].get('delta', {}).get('content') or ''
+
+
+def format_sse(event, data):
+    """One Server-Sent Events frame with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode('utf-8')
+
+
+def encode_json_body(data, accept_encoding=None):
+    """JSON response body plus extra headers; gzipped when large and the client accepts it"""
+    body = json.dumps(data).encode('utf-8')
+    if len(body) < JSON_GZIP_MIN_BYTES:
+        return body, []
+    headers = [('Vary', 'Accept-Encoding')]
+    if 'gzip' in StaticAssetCache.accepted_encodings(accept_encoding):
+        body = gzip.compress(body, compresslevel=6)
+        headers.append(('Content-Encoding', 'gzip'))
+    return body, headers
+
+
+def client_wants_keep_alive(version, connection_header):
+    """Whether a request's HTTP version and Connection header allow reusing the connection"""
+    tokens = {token.strip().lower() for token in (connection_header or '').split(',')}
+    if version == 'HTTP/1.1':
+        return 'close' not in tokens
+    return 'keep-alive' in tokens
+
+
+def image_event(image_url, image_error=None):
+    event = {'image_url': image_url}
+    if not image_url:
+        event['image_pending'] = True
+        event['image_error'] = image_error
+    return event
+
+
+# Form fields a batch variant may override
+BATCH_VARIANT_FIELDS = ('adFormat', 'tone', 'language')
+
+
+def expand_batch_request(data):
+    """One /generate-ad body per variant of a batch request; raises ValueError if malformed"""
+    variants = data.get('variants')
+    if not isinstance(variants, list) or not variants:
+        raise ValueError("variants must be a non-empty list")
+    if len(variants) > BATCH_MAX_VARIANTS:
+        raise ValueError(f"At most {BATCH_MAX_VARIANTS} variants per batch")
+
+    product = {key: value for key, value in data.items() if key not in ('variants', 'stream')}
+    bodies = []
+    for variant in variants:
+        if not isinstance(variant, dict):
+            raise ValueError("Each variant must be an object")
+        bodies.append(dict(product, **{key: variant[key] for key in BATCH_VARIANT_FIELDS if key in variant}))
+    return bodies
+
+
+def batch_result(index, body, ad_copy, image_url=None, image_error=None, copy_error=None):
+    """Entry of a batch response, tagged with the variant it answers"""
+    result = {'index': index, 'variant': {key: body.get(key) for key in BATCH_VARIANT_FIELDS}}
+    if not ad_copy:
+        result.update(success=False, error=copy_error or 'Failed to generate ad copy')
+    else:
+        result.update(assemble_ad_response(ad_copy, image_url, image_error))
+    return result
+
+
+class ResultCache:
+    """Thread-safe LRU cache with per-entry TTL and a memory bound.
+
+    Values must be JSON-serialisable.  When ``path`` is set the cache is
+    loaded from that file at startup and written back by ``save()``; expired
+    entries are dropped on load.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=16 * 1024 * 1024, ttl=21600, path=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.path = path
+        self.entries = OrderedDict()  # key -> (expires_at, size, value)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.dirty = False
+        self.lock = threading.Lock()
+        if path:
+            self.load()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, value, expires_at=None):
+        size = len(key) + len(json.dumps(value))
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (expires_at or time.time() + self.ttl, size, value)
+            self.bytes += size
+            self.dirty = True
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.bytes -= size
+        self.dirty = True
+
+    def get_or_compute(self, key, compute, bypass=False):
+        """Return the cached value for ``key`` or compute and store it; falsy results aren't cached"""
+        if not bypass:
+            value = self.get(key)
+            if value is not None:
+                return value
+        value = compute()
+        if value:
+            self.put(key, value)
+        return value
+
+    async def get_or_compute_async(self, key, compute, bypass=False):
+        """get_or_compute for a coroutine function"""
+        if not bypass:
+            value = self.get(key)
+            if value is not None:
+                return value
+        value = await compute()
+        if value:
+            self.put(key, value)
+        return value
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
         except Exception as e:
-            print(f"❌ Error serving sitemap: {e}")
-            self.send_error(404, "Sitemap not found")
+            log.warning(f"⚠️ Ignoring unreadable result cache {self.path}: {e}")
+            return
+        now = time.time()
+        for key, expires_at, value in saved:
+            if expires_at > now:
+                self.put(key, value, expires_at)
+        self.dirty = False
+        log.info(f"💾 Loaded {len(self.entries)} cached results from {self.path}")
+
+    def save(self):
+        """Write the cache to ``path`` if anything changed since the last save"""
+        if not self.path or not self.dirty:
+            return
+        with self.lock:
+            snapshot = [[key, expires_at, value] for key, (expires_at, _, value) in self.entries.items()]
+            self.dirty = False
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"  # prefork workers save the same file
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, self.path)
+
+    def start_autosave(self, interval=30):
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.save()
+                except Exception as e:
+                    log.warning(f"⚠️ Failed to save result cache: {e}")
+
+        if self.path:
+            threading.Thread(target=loop, name='cache-autosave', daemon=True).start()
+
+
+class Cancellation:
+    """Reads like a threading.Event that is set once every added event is set"""
+
+    def __init__(self):
+        self.events = []
+
+    def add(self, event):
+        self.events.append(event)
+
+    def is_set(self):
+        return all(event.is_set() for event in list(self.events))
+
+
+class SingleFlight:
+    """Coalesce concurrent calls that share a key onto one execution.
+
+    The first caller runs ``fn``; callers arriving while it is in flight
+    wait for it and get the same return value or exception.  Nothing is
+    remembered once the call finishes; that is what ResultCache is for.
+
+    Callers that pass a ``cancel`` event get ``fn`` called with the call's
+    Cancellation, which reads as set once every one of them has given up.
+    """
+
+    class Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+            self.cancellation = Cancellation()
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.coalesced = 0
+
+    def do(self, key, fn, timeout=None, cancel=None):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = self.Call()
+            else:
+                self.coalesced += 1
+            if cancel is not None:
+                call.cancellation.add(cancel)
+
+        if leader:
+            try:
+                call.result = fn() if cancel is None else fn(call.cancellation)
+            except BaseException as e:
+                call.error = e
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+        elif not call.done.wait(timeout):
+            raise TimeoutError(f"Timed out waiting for in-flight request {key[:16]}")
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def stats(self):
+        with self.lock:
+            return {'in_flight': len(self.calls), 'coalesced': self.coalesced}
+
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines; the shared task is cancelled once every waiter has given up"""
+
+    def __init__(self):
+        self.tasks = {}
+        self.waiters = {}  # task -> callers still awaiting it
+        self.coalesced = 0
+
+    async def do(self, key, coro_fn, timeout=None):
+        task = self.tasks.get(key)
+        if task is None:
+            task = self.tasks[key] = asyncio.ensure_future(coro_fn())
+            task.add_done_callback(lambda _: self._forget(key, task))
+        else:
+            self.coalesced += 1
+        self.waiters[task] = self.waiters.get(task, 0) + 1
+        try:
+            # One waiter giving up must not cancel the call for everyone else
+            return await asyncio.wait_for(asyncio.shield(task), timeout)
+        finally:
+            self.waiters[task] -= 1
+            if not self.waiters[task]:
+                del self.waiters[task]
+                if not task.done():
+                    # Nobody wants the result any more; later callers start afresh
+                    self._forget(key, task)
+                    task.cancel()
+
+    def _forget(self, key, task):
+        if self.tasks.get(key) is task:
+            del self.tasks[key]
+
+    def stats(self):
+        return {'in_flight': len(self.tasks), 'coalesced': self.coalesced}
+
+
+IN_FLIGHT = SingleFlight()
+ASYNC_IN_FLIGHT = AsyncSingleFlight()
+
+
+def normalize_generation_inputs(data):
+    """Prompt fields with whitespace collapsed, and case folded where it doesn't change meaning"""
+    normalized = dict(data)
+    for field in ('language', 'productName', 'productDescription', 'targetAudience', 'specialOffer', 'tone', 'adFormat'):
+        value = data.get(field)
+        if isinstance(value, str):
+            normalized[field] = ' '.join(value.split())
+    for field in ('language', 'tone', 'adFormat'):
+        if isinstance(normalized.get(field), str):
+            normalized[field] = normalized[field].casefold()
+    return normalized
+
+
+def ad_copy_cache_key(data):
+    """Content address of the DeepSeek request a body would produce"""
+    payload = json.dumps(build_ad_copy_payload(normalize_generation_inputs(data)), sort_keys=True)
+    return 'copy:' + hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def image_cache_key(data):
+    prompt = build_image_prompt(normalize_generation_inputs(data))
+    return 'image:' + hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+
+
+def wants_new_variation(data, headers):
+    """True when the client asked to skip cached results for this request"""
+    return bool(data.get('newVariation')) or 'no-cache' in (headers.get('Cache-Control') or '')
+
+
+RESULT_CACHE = ResultCache(
+    max_entries=int(os.getenv('AD_CACHE_MAX_ENTRIES', 1000)),
+    max_bytes=int(os.getenv('AD_CACHE_MAX_BYTES', 16 * 1024 * 1024)),
+    ttl=float(os.getenv('AD_CACHE_TTL', 21600)),
+    path=os.getenv('AD_CACHE_FILE') or None
+)
+
+
+def collect_cache_metrics():
+    stats = RESULT_CACHE.stats()
+    coalesced = IN_FLIGHT.stats()['coalesced'] + ASYNC_IN_FLIGHT.stats()['coalesced']
+    return [
+        ('ad_cache_entries', {}, stats['entries']),
+        ('ad_cache_hits_total', {}, stats['hits']),
+        ('ad_cache_misses_total', {}, stats['misses']),
+        ('ad_cache_coalesced_total', {}, coalesced),
+    ]
+
+
+METRICS.register_collector(collect_cache_metrics)
+
+
+class StaticAsset:
+    """One file from the public directory, held in memory with its compressed variants"""
+
+    def __init__(self, path, stat, body, content_type):
+        self.path = path
+        self.mtime_ns = stat.st_mtime_ns
+        self.size = stat.st_size
+        self.content_type = content_type
+        self.last_modified = formatdate(stat.st_mtime, usegmt=True)
+        self.checked_at = time.monotonic()
+        digest = hashlib.sha1(body).hexdigest()[:20]
+        self.variants = {'identity': (body, f'"{digest}"')}
+
+        if content_type.startswith(COMPRESSIBLE_TYPES) and len(body) > 256:
+            compressed = gzip.compress(body, compresslevel=9, mtime=0)
+            if len(compressed) < len(body):
+                self.variants['gzip'] = (compressed, f'"{digest}-gz"')
+            if brotli is not None:
+                compressed = brotli.compress(body)
+                if len(compressed) < len(body):
+                    self.variants['br'] = (compressed, f'"{digest}-br"')
+
+    @property
+    def memory(self):
+        return sum(len(body) for body, _ in self.variants.values())
+
+    def etags(self):
+        return {etag for _, etag in self.variants.values()}
+
+
+class StaticAssetCache:
+    """Serves files under ``root`` from memory.
+
+    Files are loaded on first hit (or by ``warm()`` at startup) together with
+    gzip/brotli variants, picked per request by Accept-Encoding.  Answers
+    conditional requests with 304 and single byte ranges with 206.  A file is
+    re-read when its mtime or size changes, checked at most every
+    ``check_interval`` seconds.  ``respond()`` returns None for anything it
+    does not serve (missing files, directories without an index, files over
+    ``max_file_bytes``) so the caller can fall back to its normal handling.
+    Files named like the per-user history the old client wrote under
+    public/ are never served, even before ``--import-history`` has run.
+    """
+
+    PRIVATE_PREFIXES = ('user_ads_', 'user_data_')
+
+    def __init__(self, root, max_bytes=32 * 1024 * 1024, max_file_bytes=4 * 1024 * 1024,
+                 check_interval=1.0, cache_control=None):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.check_interval = check_interval
+        self.cache_control = cache_control or {}
+        self.assets = OrderedDict()  # url path -> StaticAsset
+        self.memory = 0
+        self.lock = threading.Lock()
+
+    def resolve(self, url_path):
+        """Filesystem path for a URL path, or None if it escapes the root, can't name a file or is private"""
+        parts = [part for part in unquote(url_path).split('/') if part and part != '.']
+        if '..' in parts or any('\0' in part for part in parts):
+            return None
+        if parts and parts[-1].lower().startswith(self.PRIVATE_PREFIXES):
+            return None
+        path = os.path.join(self.root, *parts)
+        if os.path.isdir(path):
+            path = os.path.join(path, 'index.html')
+        return path
+
+    def lookup(self, url_path):
+        now = time.monotonic()
+        with self.lock:
+            asset = self.assets.get(url_path)
+            if asset is not None:
+                self.assets.move_to_end(url_path)
+                if now - asset.checked_at < self.check_interval:
+                    return asset
+
+        path = self.resolve(url_path)
+        try:
+            stat = os.stat(path) if path else None
+        except (OSError, ValueError):
+            stat = None
+        if stat is None or not os.path.isfile(path) or stat.st_size > self.max_file_bytes:
+            self.evict(url_path)
+            return None
+        if asset is not None and asset.mtime_ns == stat.st_mtime_ns and asset.size == stat.st_size:
+            asset.checked_at = now
+            return asset
+
+        with open(path, 'rb') as f:
+            body = f.read()
+        asset = StaticAsset(path, stat, body, self.guess_type(path))
+        with self.lock:
+            old = self.assets.pop(url_path, None)
+            if old is not None:
+                self.memory -= old.memory
+            self.assets[url_path] = asset
+            self.memory += asset.memory
+            while self.memory > self.max_bytes and len(self.assets) > 1:
+                _, evicted = self.assets.popitem(last=False)
+                self.memory -= evicted.memory
+        return asset
+
+    def evict(self, url_path):
+        with self.lock:
+            old = self.assets.pop(url_path, None)
+            if old is not None:
+                self.memory -= old.memory
+
+    def warm(self):
+        """Load every file under the root up front"""
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                relative = os.path.relpath(os.path.join(directory, name), self.root)
+                self.lookup('/' + relative.replace(os.sep, '/'))
+        log.info(f"📦 Cached {len(self.assets)} static files ({self.memory // 1024} KiB with compressed variants)")
+
+    @staticmethod
+    def guess_type(path):
+        content_type = STATIC_CONTENT_TYPES.get(os.path.splitext(path)[1].lower())
+        if content_type is None:
+            content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        if content_type.startswith('text/') or content_type in ('application/javascript', 'application/json'):
+            content_type += '; charset=utf-8'
+        return content_type
+
+    @staticmethod
+    def accepted_encodings(header):
+        accepted = set()
+        for item in (header or '').split(','):
+            name, _, params = item.strip().partition(';')
+            q = params.strip()
+            if q.startswith('q='):
+                try:
+                    if float(q[2:]) == 0:
+                        continue
+                except ValueError:
+                    continue
+            accepted.add(name.strip().lower())
+        return accepted
+
+    def respond(self, url_path, headers, head_only=False):
+        """(status, header list, body) for a GET/HEAD of ``url_path``, or None to fall back"""
+        asset = self.lookup(url_path)
+        if asset is None:
+            return None
+
+        base_headers = [
+            ('Last-Modified', asset.last_modified),
+            ('Cache-Control', self.cache_control.get(url_path) or (
+                'no-cache' if asset.content_type.startswith('text/html') else STATIC_CACHE_CONTROL
+            )),
+            ('Vary', 'Accept-Encoding'),
+            ('Accept-Ranges', 'bytes'),
+        ]
+
+        if_none_match = headers.get('If-None-Match')
+        if if_none_match:
+            tags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+            if '*' in tags or tags & asset.etags():
+                return 304, [('ETag', next(iter(tags & asset.etags()), asset.variants['identity'][1]))] + base_headers, b''
+        elif headers.get('If-Modified-Since') == asset.last_modified:
+            return 304, base_headers, b''
+
+        body, etag = asset.variants['identity']
+        range_header = headers.get('Range')
+        if range_header and headers.get('If-Range') in (None, etag, asset.last_modified):
+            byte_range = self.parse_range(range_header, len(body))
+            if byte_range == 'unsatisfiable':
+                return 416, [('Content-Range', f'bytes */{len(body)}'), ('Content-Length', '0')], b''
+            if byte_range is not None:
+                start, end = byte_range
+                part = body[start:end + 1]
+                return 206, [
+                    ('Content-Type', asset.content_type),
+                    ('Content-Length', str(len(part))),
+                    ('Content-Range', f'bytes {start}-{end}/{len(body)}'),
+                    ('ETag', etag),
+                ] + base_headers, b'' if head_only else part
+
+        encoding = 'identity'
+        accepted = self.accepted_encodings(headers.get('Accept-Encoding'))
+        for candidate in ('br', 'gzip'):
+            if candidate in accepted and candidate in asset.variants:
+                encoding = candidate
+                break
+        body, etag = asset.variants[encoding]
+
+        response_headers = [
+            ('Content-Type', asset.content_type),
+            ('Content-Length', str(len(body))),
+            ('ETag', etag),
+        ] + base_headers
+        if encoding != 'identity':
+            response_headers.append(('Content-Encoding', encoding))
+        return 200, response_headers, b'' if head_only else body
+
+    @staticmethod
+    def parse_range(header, size):
+        """(start, end) for a single ``bytes=`` range; None to ignore it, 'unsatisfiable' for 416"""
+        unit, _, spec = header.partition('=')
+        if unit.strip() != 'bytes' or ',' in spec:
+            return None
+        first, _, last = spec.strip().partition('-')
+        try:
+            if not first:
+                length = int(last)
+                if length <= 0:
+                    return 'unsatisfiable'
+                return max(0, size - length), size - 1
+            start = int(first)
+            end = int(last) if last else size - 1
+        except ValueError:
+            return None
+        if start >= size or end < start:
+            return 'unsatisfiable'
+        return start, min(end, size - 1)
+
+
+# Content types the compressed variants are worth keeping for
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'application/xml', 'image/svg+xml')
+STATIC_CONTENT_TYPES = {
+    '.js': 'application/javascript',
+    '.xml': 'application/xml',
+    '.txt': 'text/plain',
+}
+# Assets are not fingerprinted, so keep browser caching short and rely on ETag revalidation;
+# HTML pages always revalidate
+STATIC_CACHE_CONTROL = os.getenv('STATIC_CACHE_CONTROL', 'public, max-age=300')
+
+STATIC_ASSETS = StaticAssetCache(
+    'public',
+    max_bytes=int(os.getenv('STATIC_CACHE_MAX_BYTES', 32 * 1024 * 1024)),
+    max_file_bytes=int(os.getenv('STATIC_MAX_FILE_BYTES', 4 * 1024 * 1024)),
+    check_interval=float(os.getenv('STATIC_CHECK_INTERVAL', 1)),
+    cache_control={
+        '/sitemap.xml': 'max-age=86400',
+        '/robots.txt': 'max-age=86400',
+    }
+)
+
+
+class ImageStore:
+    """Content-addressed disk store for generated images, served under /images/.
+
+    Each DeepAI output is downloaded once and saved as ``<sha256>.<ext>``
+    below ``root``, so identical pictures share a file.  Stored files never
+    change, which lets them go out with a year-long immutable Cache-Control
+    and their name as ETag.  Past ``max_bytes`` the least recently served
+    files are deleted.  Sizes, last use and the URL each image came from are
+    kept in ``index.db`` under ``root``, so prefork workers share one budget
+    and a link to an evicted image redirects to where it was downloaded
+    from.  Thumbnails need Pillow; without it the thumbnail URL is the full
+    image.
+    """
+
+    URL_PREFIX = '/images/'
+    EXTENSIONS = {'image/jpeg': 'jpg', 'image/png': 'png', 'image/webp': 'webp', 'image/gif': 'gif'}
+    THUMB_SUFFIX = '.thumb.jpg'
+    CACHE_CONTROL = 'public, max-age=31536000, immutable'
+    TOUCH_INTERVAL = 60  # seconds between last_served updates for one file
+
+    def __init__(self, root, max_bytes=512 * 1024 * 1024, max_image_bytes=10 * 1024 * 1024,
+                 thumb_size=320, chunk_size=64 * 1024, timeout=(5, 30)):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.max_image_bytes = max_image_bytes
+        self.thumb_size = thumb_size
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.db = None
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+
+    def _connect(self):
+        """Caller holds the lock"""
+        if self.db is None:
+            os.makedirs(self.root, exist_ok=True)
+            db = open_sqlite(os.path.join(self.root, 'index.db'))
+            db.execute('''CREATE TABLE IF NOT EXISTS images (
+                name TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                source_url TEXT,
+                last_served REAL NOT NULL,
+                stored INTEGER NOT NULL DEFAULT 1
+            )''')
+            db.execute('CREATE INDEX IF NOT EXISTS images_stored_served ON images (stored, last_served)')
+            if db.execute('SELECT 1 FROM images LIMIT 1').fetchone() is None:
+                # Files stored before there was an index
+                found = []
+                for directory, _, names in os.walk(self.root):
+                    for name in names:
+                        if self.parse_name(name):
+                            stat = os.stat(os.path.join(directory, name))
+                            found.append((name, stat.st_size, stat.st_mtime))
+                db.executemany('INSERT OR IGNORE INTO images (name, size, last_served) VALUES (?, ?, ?)', found)
+            self.db = db
+        return self.db
+
+    def parse_name(self, name):
+        """(digest, is_thumbnail) for a valid stored file name, else None"""
+        thumb = name.endswith(self.THUMB_SUFFIX)
+        digest, _, ext = name.removesuffix(self.THUMB_SUFFIX).partition('.')
+        if len(digest) != 64 or not all(c in '0123456789abcdef' for c in digest):
+            return None
+        valid = ext == '' if thumb else ext in self.EXTENSIONS.values()
+        return (digest, thumb) if valid else None
+
+    def path_for(self, name):
+        return os.path.join(self.root, name[:2], name)
+
+    def _add(self, name, size, source_url=None):
+        """Record a newly stored file and delete the least recently served ones past ``max_bytes``"""
+        with self.lock:
+            db = self._connect()
+            with db:
+                db.execute('BEGIN IMMEDIATE')
+                db.execute(
+                    'INSERT INTO images (name, size, source_url, last_served) VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT (name) DO UPDATE SET size = excluded.size, stored = 1, last_served = excluded.last_served, '
+                    'source_url = COALESCE(excluded.source_url, images.source_url)',
+                    (name, size, source_url, time.time())
+                )
+                total = db.execute('SELECT COALESCE(SUM(size), 0) FROM images WHERE stored = 1').fetchone()[0]
+                if total <= self.max_bytes:
+                    return
+                evicted = []
+                for row in db.execute('SELECT name, size FROM images WHERE stored = 1 AND name != ? '
+                                      'ORDER BY last_served', (name,)):
+                    if total <= self.max_bytes:
+                        break
+                    evicted.append(row['name'])
+                    total -= row['size']
+                # The rows stay, so links to these files can still be sent to their source
+                db.executemany('UPDATE images SET stored = 0 WHERE name = ?', [(old,) for old in evicted])
+                for old in evicted:
+                    try:
+                        os.unlink(self.path_for(old))
+                    except FileNotFoundError:
+                        pass
+
+    def _touch(self, name):
+        now = time.time()
+        with self.lock:
+            self._connect().execute('UPDATE images SET last_served = ? WHERE name = ? AND last_served < ?',
+                                    (now, name, now - self.TOUCH_INTERVAL))
+
+    def source_url(self, digest):
+        """Where the image with this digest was downloaded from, if known"""
+        names = [f"{digest}.{ext}" for ext in self.EXTENSIONS.values()]
+        with self.lock:
+            row = self._connect().execute(
+                f'SELECT source_url FROM images WHERE name IN ({", ".join("?" * len(names))}) '
+                'AND source_url IS NOT NULL', names
+            ).fetchone()
+        return row['source_url'] if row else None
+
+    def store_remote(self, url, deadline=None, cancel=None):
+        """Download ``url`` into the store and return its local URL.
+
+        ``deadline`` (a time.monotonic() value) bounds the whole download,
+        not just each read.  Setting ``cancel`` (a threading.Event) stops it
+        between chunks.
+        """
+        if cancel is not None and cancel.is_set():
+            raise ValueError("image download cancelled")
+        timeout = self.timeout
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ValueError("no time left to download the image")
+            timeout = (min(timeout[0], remaining), min(timeout[1], remaining))
+        response = self.session.get(url, stream=True, timeout=timeout)
+        try:
+            response.raise_for_status()
+            content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+            ext = self.EXTENSIONS.get(content_type)
+            if ext is None:
+                raise ValueError(f"not an image: {content_type or 'no Content-Type'}")
+
+            os.makedirs(self.root, exist_ok=True)
+            digest, size = hashlib.sha256(), 0
+            with tempfile.NamedTemporaryFile(dir=self.root, suffix='.part', delete=False) as tmp:
+                try:
+                    # read1 returns whatever has arrived, so a trickling upstream can't hold a read past the deadline
+                    while chunk := response.raw.read1(self.chunk_size):
+                        if deadline is not None and time.monotonic() > deadline:
+                            raise ValueError("image download ran past the generation deadline")
+                        if cancel is not None and cancel.is_set():
+                            raise ValueError("image download cancelled")
+                        size += len(chunk)
+                        if size > self.max_image_bytes:
+                            raise ValueError(f"image larger than {self.max_image_bytes} bytes")
+                        digest.update(chunk)
+                        tmp.write(chunk)
+                except BaseException:
+                    tmp.close()
+                    os.unlink(tmp.name)
+                    raise
+        finally:
+            response.close()
+
+        name = f"{digest.hexdigest()}.{ext}"
+        path = self.path_for(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.unlink(tmp.name)  # same picture stored before
+        else:
+            os.replace(tmp.name, path)
+            self._add(name, size, url)
+            self.make_thumbnail(name)
+        return self.URL_PREFIX + name
+
+    def localize(self, url, deadline=None, cancel=None):
+        """Local URL for a remote image, or ``url`` itself if it cannot be stored by ``deadline``"""
+        if not url or url.startswith(self.URL_PREFIX):
+            return url
+        try:
+            return self.store_remote(url, deadline, cancel)
+        except (requests.RequestException, OSError, ValueError) as e:
+            log.warning(f"⚠️ Keeping remote image URL, could not store it: {e}")
+            return url
+
+    def make_thumbnail(self, name):
+        """Write the thumbnail for a stored image; returns its file name, or None without Pillow"""
+        if Image is None:
+            return None
+        thumb_name = name.partition('.')[0] + self.THUMB_SUFFIX
+        thumb_path = self.path_for(thumb_name)
+        if os.path.exists(thumb_path):
+            return thumb_name
+        try:
+            with Image.open(self.path_for(name)) as image:
+                image.thumbnail((self.thumb_size, self.thumb_size))
+                with tempfile.NamedTemporaryFile(dir=os.path.dirname(thumb_path), suffix='.part', delete=False) as tmp:
+                    image.convert('RGB').save(tmp, 'JPEG', quality=80)
+            os.replace(tmp.name, thumb_path)
+        except (OSError, ValueError) as e:
+            log.warning(f"⚠️ Could not make a thumbnail for {name}: {e}")
+            return None
+        self._add(thumb_name, os.path.getsize(thumb_path))
+        return thumb_name
+
+    def thumbnail_url(self, image_url):
+        """URL of the thumbnail for a local image URL (the image itself without Pillow)"""
+        if Image is None or not image_url or not image_url.startswith(self.URL_PREFIX):
+            return image_url
+        return self.URL_PREFIX + image_url[len(self.URL_PREFIX):].partition('.')[0] + self.THUMB_SUFFIX
+
+    def respond(self, url_path, headers):
+        """(status, header list, open file or None) for a GET of an /images/ URL.
+
+        The caller streams the file in ``chunk_size`` pieces and closes it.
+        """
+        name = url_path[len(self.URL_PREFIX):]
+        parsed = self.parse_name(name)
+        if parsed is None:
+            return 404, [('Content-Length', '0')], None
+        digest, thumb = parsed
+
+        if thumb and not os.path.exists(self.path_for(name)):
+            original = next((f"{digest}.{ext}" for ext in self.EXTENSIONS.values()
+                             if os.path.exists(self.path_for(f"{digest}.{ext}"))), None)
+            if original is not None:
+                name = self.make_thumbnail(original) or original
+
+        try:
+            f = open(self.path_for(name), 'rb')
+        except FileNotFoundError:
+            source = self.source_url(digest)
+            if source:
+                return 302, [('Location', source), ('Content-Length', '0'), ('Cache-Control', 'no-cache')], None
+            return 404, [('Content-Length', '0')], None
+        self._touch(name)
+
+        etag = f'"{name}"'
+        base_headers = [('ETag', etag), ('Cache-Control', self.CACHE_CONTROL)]
+        if_none_match = headers.get('If-None-Match') or ''
+        if etag in {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}:
+            f.close()
+            return 304, base_headers, None
+
+        ext = name.rpartition('.')[2]
+        content_type = next(t for t, e in self.EXTENSIONS.items() if e == ext)
+        return 200, [
+            ('Content-Type', content_type),
+            ('Content-Length', str(os.fstat(f.fileno()).st_size)),
+        ] + base_headers, f
+
+
+IMAGE_STORE = ImageStore(
+    os.getenv('IMAGE_STORE_DIR', 'image_store'),
+    max_bytes=int(os.getenv('IMAGE_STORE_MAX_BYTES', 512 * 1024 * 1024)),
+    max_image_bytes=int(os.getenv('IMAGE_MAX_BYTES', 10 * 1024 * 1024)),
+    thumb_size=int(os.getenv('IMAGE_THUMB_SIZE', 320))
+)
+# IMAGE_STORE=0 keeps handing out DeepAI's own URLs
+IMAGE_STORE_ENABLED = os.getenv('IMAGE_STORE', '1') == '1'
+
+
+def store_image(url, deadline=None, cancel=None):
+    """What to return for a DeepAI output_url: a local /images/ URL when the image store is on"""
+    return IMAGE_STORE.localize(url, deadline, cancel) if IMAGE_STORE_ENABLED else url
+
+
+CONFIG_KEYS = ('DEEPSEEK_API_KEY', 'DEEPAI_API_KEY', 'RAZORPAY_KEY_ID', 'RAZORPAY_KEY_SECRET',
+               'FIREBASE_API_KEY', 'FIREBASE_AUTH_DOMAIN', 'FIREBASE_PROJECT_ID', 'FIREBASE_APP_ID')
+
+
+def log_config_status(level, missing_keys=None):
+    """Log which keys are configured; called at INFO on startup and at DEBUG per config.js fetch"""
+    for name in CONFIG_KEYS:
+        value = os.environ.get(name, '')
+        log.log(level, f"🔑 {name}: {'✅ Present' if value else '❌ Missing'} ({len(value)} chars)")
+
+    if missing_keys is None:
+        missing_keys = [name for name in ('DEEPSEEK_API_KEY', 'DEEPAI_API_KEY')
+                        if len(os.environ.get(name, '').strip()) < 5]
+    if missing_keys:
+        log.log(logging.ERROR if level >= logging.INFO else level,
+                f"❌ CRITICAL: Missing API keys: {', '.join(missing_keys)} - add them in the Secrets tab")
+
+
+def render_config_js():
+    """Build the window.CONFIG script served at /config.js"""
+    # Get API keys from environment
+    deepseek_key = os.environ.get('DEEPSEEK_API_KEY', '')
+    deepai_key = os.environ.get('DEEPAI_API_KEY', '')
+    razorpay_key_id = os.environ.get('RAZORPAY_KEY_ID', '')
+    razorpay_key_secret = os.environ.get('RAZORPAY_KEY_SECRET', '')
+    firebase_api_key = os.environ.get('FIREBASE_API_KEY', '')
+    firebase_auth_domain = os.environ.get('FIREBASE_AUTH_DOMAIN', '')
+    firebase_project_id = os.environ.get('FIREBASE_PROJECT_ID', '')
+    firebase_app_id = os.environ.get('FIREBASE_APP_ID', '')
+
+    # Check for missing keys
+    missing_keys = []
+    if not deepseek_key or len(deepseek_key.strip()) < 5:
+        missing_keys.append('DEEPSEEK_API_KEY')
+    if not deepai_key or len(deepai_key.strip()) < 5:
+        missing_keys.append('DEEPAI_API_KEY')
+
+    log_config_status(logging.DEBUG, missing_keys)
+
+    config_js = f'''
+window.CONFIG = {{
+    DEEPSEEK_API_KEY: '{deepseek_key}',
+    DEEPAI_API_KEY: '{deepai_key}',
+    RAZORPAY_KEY_ID: '{razorpay_key_id}',
+    RAZORPAY_KEY_SECRET: '{razorpay_key_secret}',
+    FIREBASE_API_KEY: '{firebase_api_key}',
+    FIREBASE_AUTH_DOMAIN: '{firebase_auth_domain}',
+    FIREBASE_PROJECT_ID: '{firebase_project_id}',
+    FIREBASE_APP_ID: '{firebase_app_id}',
+    SHOW_3D_EARLY: true,
+    MISSING_KEYS: {str(missing_keys).replace("'", '"')}
+}};
+console.log('✅ Config loaded from server:', Object.keys(window.CONFIG));
+if (window.CONFIG.MISSING_KEYS.length > 0) {{
+    console.error('❌ Missing API keys:', window.CONFIG.MISSING_KEYS);
+    console.log('🔧 Please add these keys in Replit Secrets and refresh the page');
+}}
+'''
+    return config_js
+
+
+CONFIG_ERROR_JS = '''
+window.CONFIG = {
+    DEEPSEEK_API_KEY: '',
+    DEEPAI_API_KEY: '',
+    RAZORPAY_KEY_ID: '',
+    RAZORPAY_KEY_SECRET: '',
+    FIREBASE_API_KEY: '',
+    FIREBASE_AUTH_DOMAIN: '',
+    FIREBASE_PROJECT_ID: '',
+    FIREBASE_APP_ID: '',
+    SHOW_3D_EARLY: true,
+    MISSING_KEYS: ["DEEPSEEK_API_KEY", "DEEPAI_API_KEY"]
+};
+console.error('❌ Config loading failed');
+'''
+
+
+class AdGeneratorHandler(SimpleHTTPRequestHandler):
+    # Persistent connections; every response carries Content-Length or closes the connection
+    protocol_version = 'HTTP/1.1'
+    # Whether requests feed the http_* metrics; the asyncio engine records its own
+    record_metrics = True
+    requests_served = 0
+    # Bounds every read and write on the client socket; without it a stalled client holds a pool thread forever
+    timeout = REQUEST_TIMEOUT
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, directory="public", **kwargs)
+
+    def handle_one_request(self):
+        self.request_started = None
+        self.response_status = None
+        if self.connection is not None and not self.wait_for_request():
+            self.close_connection = True
+            return
+        try:
+            super().handle_one_request()
+        finally:
+            self.requests_served += 1
+            if self.request_started is not None:
+                METRICS.inc('http_requests_in_flight', -1)
+                if self.command:
+                    record_request(urlparse(self.path).path, self.command, self.response_status or 0,
+                                   self.request_started)
+                    log_access(self.client_address[0], self.command, self.path, self.response_status or 0,
+                               self.request_started)
+
+    def wait_for_request(self):
+        """Wait up to KEEPALIVE_TIMEOUT for the next request; False once the client is idle or gone.
+
+        An idle kept-alive connection holds one of the pool's worker threads,
+        so it gives the thread up as soon as other connections are queued for
+        one, or the server starts draining. A new connection is always given
+        the chance to send its first request.
+        """
+        # A pipelined request may already be sitting in the read buffer
+        self.connection.settimeout(0)
+        try:
+            if self.rfile.peek(1):
+                return True
+        except OSError:
+            pass
+        finally:
+            self.connection.settimeout(self.timeout)
+
+        deadline = time.monotonic() + KEEPALIVE_TIMEOUT
+        pending = getattr(self.server, 'pending', None)
+        while not self.requests_served or (
+                not getattr(self.server, 'draining', False) and (pending is None or pending.empty())):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            try:
+                readable, _, _ = select.select([self.connection], [], [], min(KEEPALIVE_POLL_INTERVAL, remaining))
+            except (OSError, ValueError):
+                return False
+            if readable:
+                try:
+                    return bool(self.rfile.peek(1))
+                except OSError:
+                    return False
+        return False
+
+    def keep_alive_allowed(self):
+        """Whether the connection may stay open for another request after this response"""
+        if self.requests_served + 1 >= KEEPALIVE_MAX_REQUESTS or self.headers.get('Transfer-Encoding'):
+            return False
+        # Hand the worker back when other connections are queued for one
+        pending = getattr(self.server, 'pending', None)
+        return not getattr(self.server, 'draining', False) and (pending is None or pending.empty())
+
+    def parse_request(self):
+        if self.record_metrics:
+            self.request_started = time.perf_counter()
+            METRICS.inc('http_requests_in_flight')
+        return super().parse_request()
+
+    def send_response(self, code, message=None):
+        self.response_status = code
+        super().send_response(code, message)
+
+    def log_request(self, code='-', size='-'):
+        # The access record is written by handle_one_request once the response is complete
+        pass
+
+    def log_error(self, format, *args):
+        log.warning(format % args, extra={'fields': {'client': self.client_address[0]}})
+
+    def log_message(self, format, *args):
+        log.info(format % args, extra={'fields': {'client': self.client_address[0]}})
+
+    def end_headers(self):
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Authorization')
+        if not self.close_connection and not self.keep_alive_allowed():
+            self.send_header('Connection', 'close')
+        super().end_headers()
+
+    def do_OPTIONS(self):
+        self.send_response(200)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Authorization')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        parsed_path = urlparse(self.path)
+
+        if parsed_path.path == '/config.js' or parsed_path.path == '/api/config.js':
+            self.serve_config()
+        elif parsed_path.path == '/sitemap.xml':
+            self.serve_sitemap()
+        elif parsed_path.path == '/robots.txt':
+            self.serve_robots()
+        elif parsed_path.path == '/generate-ad/stream':
+            # EventSource can only GET, so the form fields may come in the query string
+            data = {key: values[0] for key, values in parse_qs(parsed_path.query).items()}
+            self.stream_with_generation_slot(data)
+        elif parsed_path.path.startswith('/api/'):
+            self.handle_api_request()
+        elif parsed_path.path.startswith(ImageStore.URL_PREFIX):
+            self.serve_image()
+        else:
+            self.serve_static()
+
+    def do_HEAD(self):
+        if urlparse(self.path).path.startswith(ImageStore.URL_PREFIX):
+            self.serve_image(head_only=True)
+        else:
+            self.serve_static(head_only=True)
+
+    def serve_image(self, head_only=False):
+        """Stream a stored image from IMAGE_STORE in chunks"""
+        status, headers, f = IMAGE_STORE.respond(urlparse(self.path).path, self.headers)
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        if f is not None:
+            with f:
+                if not head_only:
+                    shutil.copyfileobj(f, self.wfile, IMAGE_STORE.chunk_size)
+
+    def serve_static(self, head_only=False, not_found=None):
+        """Serve a file under public/ from STATIC_ASSETS, falling back to SimpleHTTPRequestHandler"""
+        path = urlparse(self.path).path
+        response = STATIC_ASSETS.respond(path, self.headers, head_only)
+        if response is None:
+            if not_found or STATIC_ASSETS.resolve(path) is None:
+                self.send_error(404, not_found)
+            elif head_only:
+                super().do_HEAD()
+            else:
+                super().do_GET()
+            return
+
+        status, headers, body = response
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def serve_sitemap(self):
+        """Serve sitemap.xml"""
+        self.serve_static(not_found="Sitemap not found")
+
+    def serve_robots(self):
+        """Serve robots.txt"""
+        self.serve_static(not_found="Robots.txt not found")
+
+    def do_POST(self):
+        """Handle POST requests"""
+        path = urlparse(self.path).path
+
+        if path == '/generate-ad':
+            if not self.acquire_generation_slot():
+                self.send_busy()
+                return
+            try:
+                self.handle_ad_generation()
+            finally:
+                self.release_generation_slot()
+        elif path == '/generate-ad/batch':
+            if not self.acquire_generation_slot():
+                self.send_busy()
+                return
+            try:
+                self.handle_batch_generation()
+            finally:
+                self.release_generation_slot()
+        elif path == '/generate-ad/stream':
+            try:
+                content_length = int(self.headers['Content-Length'])
+                data = json.loads(self.rfile.read(content_length).decode('utf-8'))
+            except (TypeError, ValueError):
+                self.send_json({'success': False, 'error': 'Invalid JSON in request'}, status=400)
+                return
+            self.stream_with_generation_slot(data)
+        elif path == '/api/jobs':
+            self.handle_job_submission()
+        elif path in ('/api/history', '/save-ad'):
+            self.handle_history_append()
+        elif path == '/api/create-razorpay-order':
+            self.handle_create_razorpay_order()
+        elif path == '/api/verify-payment':
+            self.handle_verify_payment()
+        else:
+            self.send_error(404, "API endpoint not implemented")
+
+    def serve_config(self):
+        try:
+            body = render_config_js().encode()
+            self.send_response(200)
+            self.send_header('Content-type', 'application/javascript')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(body)
+        except Exception as e:
+            log.error(f"❌ Error serving config: {e}")
+            body = CONFIG_ERROR_JS.encode()
+            self.send_response(500)
+            self.send_header('Content-type', 'application/javascript')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def handle_ad_generation(self):
+        try:
+            content_length = int(self.headers['Content-Length'])
+            post_data = self.rfile.read(content_length)
+            data = json.loads(post_data.decode('utf-8'))
+
+            log.info(f"🚀 Received ad generation request for {data.get('productName', '')!r}")
+            log.debug("Ad generation request body: %s", data)
+
+            # Copy and image prompts only depend on the request body, so run both at once
+            deadline = time.monotonic() + GENERATION_DEADLINE
+            bypass_cache = wants_new_variation(data, self.headers)
+            copy_future = UPSTREAM_EXECUTOR.submit(self.generate_ad_copy, data, bypass_cache)
+            # The image call has usually started by the time we give up on it, so it is told to stop
+            image_cancel = threading.Event()
+            image_future = UPSTREAM_EXECUTOR.submit(self.generate_image, data, bypass_cache, image_cancel)
+
+            try:
+                try:
+                    ad_copy = copy_future.result(timeout=GENERATION_DEADLINE)
+                except FutureTimeoutError:
+                    ad_copy = None
+                if not ad_copy:
+                    # No point waiting on the image without copy to go with it
+                    image_future.cancel()
+                    raise Exception("Failed to generate ad copy")
+
+                try:
+                    image_url = image_future.result(timeout=max(0, deadline - time.monotonic()))
+                    image_error = None if image_url else 'Failed to generate image'
+                except FutureTimeoutError:
+                    image_url = None
+                    image_error = 'Image generation timed out'
+            finally:
+                image_cancel.set()
+
+            self.send_json(assemble_ad_response(ad_copy, image_url, image_error))
+
+        except UpstreamRejected as e:
+            self.send_rejected(e)
+        except Exception as e:
+            log.exception(f"❌ Error in ad generation: {e}")
+            self.send_json({'success': False, 'error': str(e)}, status=500)
+
+    def stream_with_generation_slot(self, data):
+        if not self.acquire_generation_slot():
+            self.send_busy()
+            return
+        try:
+            self.handle_ad_generation_stream(data)
+        finally:
+            self.release_generation_slot()
+
+    def send_event(self, event, data):
+        self.wfile.write(format_sse(event, data))
+        self.wfile.flush()
+
+    def handle_ad_generation_stream(self, data):
+        """Relay ad copy tokens to the browser as Server-Sent Events.
+
+        Emits ``token`` events while DeepSeek streams, a ``copy`` event with
+        the full text, an ``image`` event once DeepAI answers (or the deadline
+        passes) and finally ``done``; failures end the stream with ``error``.
+        """
+        log.info(f"🚀 Received streaming ad generation request for {data.get('productName', '')!r}")
+        log.debug("Streaming ad generation request body: %s", data)
+        bypass_cache = wants_new_variation(data, self.headers)
+        deadline = time.monotonic() + GENERATION_DEADLINE
+        image_cancel = threading.Event()
+        image_future = UPSTREAM_EXECUTOR.submit(self.generate_image, data, bypass_cache, image_cancel)
+        upstream = None
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('X-Accel-Buffering', 'no')
+        self.send_header('Connection', 'close')  # the stream ends when the connection does
+        self.end_headers()
+
+        try:
+            copy_key = ad_copy_cache_key(data)
+            ad_copy = None if bypass_cache else RESULT_CACHE.get(copy_key)
+            if ad_copy is None:
+                upstream = self.open_ad_copy_stream(data)
+                tokens = []
+                for line in upstream.iter_lines(decode_unicode=True):
+                    token = parse_copy_stream_line(line or '')
+                    if token is None:
+                        break
+                    if token:
+                        tokens.append(token)
+                        self.send_event('token', {'text': token})
+                    if time.monotonic() > deadline:
+                        raise Exception("Ad copy generation timed out")
+                ad_copy = ''.join(tokens).strip()
+                if not ad_copy:
+                    raise Exception("Failed to generate ad copy")
+                RESULT_CACHE.put(copy_key, ad_copy)
+            self.send_event('copy', {'ad_copy': ad_copy})
+
+            while True:
+                try:
+                    wait = max(0, min(SSE_HEARTBEAT_INTERVAL, deadline - time.monotonic()))
+                    image_url = image_future.result(timeout=wait)
+                    image_error = None if image_url else 'Failed to generate image'
+                    break
+                except FutureTimeoutError:
+                    if time.monotonic() >= deadline:
+                        image_url, image_error = None, 'Image generation timed out'
+                        break
+                    self.wfile.write(b': keep-alive\n\n')
+                    self.wfile.flush()
+
+            self.send_event('image', image_event(image_url, image_error))
+            self.send_event('done', {'success': True})
+
+        except (BrokenPipeError, ConnectionResetError):
+            log.info("🔌 Client left the ad stream, closing upstream")
+            image_future.cancel()
+        except UpstreamRejected as e:
+            log.warning(f"⏳ {e}")
+            image_future.cancel()
+            try:
+                self.send_event('error', e.body())
+            except OSError:
+                pass
+        except Exception as e:
+            log.exception(f"❌ Error in streaming ad generation: {e}")
+            image_future.cancel()
+            try:
+                self.send_event('error', {'success': False, 'error': str(e)})
+            except OSError:
+                pass
+        finally:
+            image_cancel.set()
+            if upstream is not None:
+                upstream.close()
+            self.close_connection = True
+
+    def open_ad_copy_stream(self, data):
+        """Start a streamed DeepSeek completion and return the open response"""
+        deepseek_key = os.environ.get('DEEPSEEK_API_KEY')
+        if not deepseek_key:
+            raise Exception("DEEPSEEK_API_KEY not configured")
+
+        response = DEEPSEEK.post(
+            '/v1/chat/completions',
+            headers={
+                'Authorization': f'Bearer {deepseek_key}',
+                'Content-Type': 'application/json'
+            },
+            json=dict(build_ad_copy_payload(data), stream=True),
+            stream=True
+        )
+        if response.status_code != 200:
+            log.error(f"❌ DeepSeek API error: {response.status_code} - {response.text}")
+            response.close()
+            raise Exception("Failed to generate ad copy")
+        return response
+
+    def handle_batch_generation(self):
+        """Generate several format/tone/language variants of one product.
+
+        Returns every result at once, or with ``"stream": true`` (or an
+        ``Accept: text/event-stream`` header) sends each one as a ``result``
+        event as soon as it is ready.
+        """
+        try:
+            content_length = int(self.headers['Content-Length'])
+            data = json.loads(self.rfile.read(content_length).decode('utf-8'))
+            bodies = expand_batch_request(data)
+        except (TypeError, ValueError, AttributeError) as e:
+            self.send_json({'success': False, 'error': f'Invalid batch request: {e}'}, status=400)
+            return
+
+        log.info(f"🚀 Received batch generation request: {len(bodies)} variants of {data.get('productName', '')!r}")
+        bypass_cache = wants_new_variation(data, self.headers)
+        stream = bool(data.get('stream')) or 'text/event-stream' in (self.headers.get('Accept') or '')
+        results = []
+
+        def emit(result):
+            results.append(result)
+            if stream:
+                self.send_event('result', result)
+
+        if stream:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('X-Accel-Buffering', 'no')
+            self.send_header('Connection', 'close')  # the stream ends when the connection does
+            self.end_headers()
+
+        try:
+            self.run_batch(bodies, bypass_cache, emit)
+            if stream:
+                self.send_event('done', {'success': True, 'count': len(results)})
+            else:
+                results.sort(key=lambda result: result['index'])
+                self.send_json({'success': True, 'results': results})
+        except (BrokenPipeError, ConnectionResetError):
+            log.info("🔌 Client left the batch stream")
+        finally:
+            if stream:
+                self.close_connection = True
+
+    def run_batch(self, bodies, bypass_cache, emit):
+        """Generate every variant, passing each finished result to ``emit``.
+
+        The request's own generation slot is topped up with free ones, up to
+        BATCH_CONCURRENCY in total, and each slot runs one variant's copy and
+        image calls at a time, as /generate-ad does.  Variants whose image
+        prompt matches share a single image call.
+        """
+        slots = 1
+        while slots < BATCH_CONCURRENCY and self.acquire_generation_slot():
+            slots += 1
+        image_cancel = threading.Event()
+        try:
+            self.run_batch_in_slots(bodies, bypass_cache, emit, slots, image_cancel)
+        finally:
+            # Stops image calls still running past the deadline or after the client left
+            image_cancel.set()
+            for _ in range(slots - 1):
+                self.release_generation_slot()
+
+    def run_batch_in_slots(self, bodies, bypass_cache, emit, slots, image_cancel):
+        deadline = time.monotonic() + GENERATION_DEADLINE
+        image_keys = [image_cache_key(body) for body in bodies]
+        image_futures = {}
+        waiting = list(range(len(bodies)))
+        copy_futures = {}  # future -> variant index
+        copies = {}  # variant index -> ad copy whose image is still coming
+
+        def fill():
+            while waiting:
+                index = waiting[0]
+                calls = len(copy_futures) + sum(not future.done() for future in image_futures.values())
+                needed = 1 if image_keys[index] in image_futures else 2
+                if calls and calls + needed > 2 * slots:
+                    return
+                waiting.pop(0)
+                if image_keys[index] not in image_futures:
+                    image_futures[image_keys[index]] = UPSTREAM_EXECUTOR.submit(
+                        self.generate_image, bodies[index], bypass_cache, image_cancel)
+                copy_futures[UPSTREAM_EXECUTOR.submit(self.generate_ad_copy, bodies[index], bypass_cache)] = index
+
+        fill()
+        while copy_futures or copies or waiting:
+            for index in [i for i in copies if image_futures[image_keys[i]].done()]:
+                try:
+                    image_url = image_futures[image_keys[index]].result()
+                except Exception:
+                    image_url = None
+                emit(batch_result(index, bodies[index], copies.pop(index), image_url,
+                                  None if image_url else 'Failed to generate image'))
+
+            fill()
+            remaining = deadline - time.monotonic()
+            if not (copy_futures or copies or waiting) or remaining <= 0:
+                break
+            pending = set(copy_futures) | {future for future in image_futures.values() if not future.done()}
+            done, _ = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = copy_futures.pop(future, None)
+                if index is None:
+                    continue
+                try:
+                    ad_copy = future.result()
+                except Exception:
+                    ad_copy = None
+                if ad_copy:
+                    copies[index] = ad_copy
+                else:
+                    emit(batch_result(index, bodies[index], None))
+
+        # Out of time: report whatever is left and drop calls that haven't started
+        for future in image_futures.values():
+            future.cancel()
+        for index, ad_copy in copies.items():
+            emit(batch_result(index, bodies[index], ad_copy, None, 'Image generation timed out'))
+        for future, index in copy_futures.items():
+            future.cancel()
+            emit(batch_result(index, bodies[index], None, copy_error='Ad copy generation timed out'))
+        for index in waiting:
+            emit(batch_result(index, bodies[index], None, copy_error='Ad copy generation timed out'))
+
+    def generate_ad_copy(self, data, bypass_cache=False):
+        """Ad copy for a request body, served from RESULT_CACHE or a matching in-flight call"""
+        key = ad_copy_cache_key(data)
+        if bypass_cache:
+            # A fresh variation must not be handed someone else's in-flight result
+            return RESULT_CACHE.get_or_compute(key, lambda: self.fetch_ad_copy(data), bypass=True)
+        return RESULT_CACHE.get_or_compute(
+            key, lambda: IN_FLIGHT.do(key, lambda: self.fetch_ad_copy(data), GENERATION_DEADLINE)
+        )
+
+    def fetch_ad_copy(self, data):
+        try:
+            deepseek_key = os.environ.get('DEEPSEEK_API_KEY')
+            if not deepseek_key:
+                raise Exception("DEEPSEEK_API_KEY not configured")
+
+            headers = {
+                'Authorization': f'Bearer {deepseek_key}',
+                'Content-Type': 'application/json'
+            }
+
+            payload = build_ad_copy_payload(data)
+
+            response = DEEPSEEK.post(
+                '/v1/chat/completions',
+                headers=headers,
+                json=payload
+            )
+
+            if response.status_code == 200:
+                result = response.json()
+                return result['choices'][0]['message']['content'].strip()
+            else:
+                log.error(f"❌ DeepSeek API error: {response.status_code} - {response.text}")
+                return None
+
+        except UpstreamRejected:
+            raise
+        except Exception as e:
+            log.error(f"❌ Error generating ad copy: {e}")
+            return None
+
+    def generate_image(self, data, bypass_cache=False, cancel=None):
+        """Image URL for a request body, served from RESULT_CACHE or a matching in-flight call.
+
+        Setting ``cancel`` tells the call the request no longer wants the image;
+        a call shared with other requests stops once all of them have.
+        """
+        key = image_cache_key(data)
+        cancel = cancel or threading.Event()
+        if bypass_cache:
+            return RESULT_CACHE.get_or_compute(key, lambda: self.fetch_image(data, cancel), bypass=True)
+        return RESULT_CACHE.get_or_compute(
+            key, lambda: IN_FLIGHT.do(key, lambda shared: self.fetch_image(data, shared), GENERATION_DEADLINE, cancel)
+        )
+
+    def fetch_image(self, data, cancel=None):
+        deadline = time.monotonic() + GENERATION_DEADLINE
+        try:
+            deepai_key = os.environ.get('DEEPAI_API_KEY')
+            if not deepai_key:
+                raise Exception("DEEPAI_API_KEY not configured")
+            if cancel is not None and cancel.is_set():
+                return None
+
+            response = DEEPAI.post(
+                '/api/text2img',
+                data={'text': build_image_prompt(data)},
+                headers={'api-key': deepai_key}
+            )
+
+            if response.status_code == 200:
+                result = response.json()
+                return store_image(result.get('output_url'), deadline, cancel)
+            else:
+                log.error(f"❌ DeepAI API error: {response.status_code} - {response.text}")
+                return None
+
+        except UpstreamRejected as e:
+            log.warning(f"⏳ Skipping image: {e}")
+            return None
+        except Exception as e:
+            log.error(f"❌ Error generating image: {e}")
+            return None
+
+    def handle_api_request(self):
+        path = urlparse(self.path).path
+
+        if path == '/api/metrics':
+            body = render_metrics().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif path == '/api/history':
+            self.handle_history_listing()
+        elif path.startswith('/api/jobs/'):
+            job = JOB_STORE.get(path[len('/api/jobs/'):])
+            if job is None:
+                self.send_json({'success': False, 'error': 'Job not found or expired'}, status=404)
+            else:
+                self.send_json(dict(job, success=True))
+        elif path == '/api/upstreams':
+            self.send_json({client.name: client.state() for client in UPSTREAMS})
+        elif path == '/api/cache-stats':
+            stats = RESULT_CACHE.stats()
+            sync_flights, async_flights = IN_FLIGHT.stats(), ASYNC_IN_FLIGHT.stats()
+            stats['in_flight'] = sync_flights['in_flight'] + async_flights['in_flight']
+            stats['coalesced'] = sync_flights['coalesced'] + async_flights['coalesced']
+            self.send_json(stats)
+        else:
+            self.send_error(404, "API endpoint not implemented")
+
+    def send_json(self, data, status=200, headers=()):
+        """Send a JSON response, gzipped when it is large and the client accepts it"""
+        body, encoding_headers = encode_json_body(data, self.headers.get('Accept-Encoding'))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in list(headers) + encoding_headers:
+            self.send_header(name, value)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Authorization')
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def acquire_generation_slot(self):
+        """Claim one of the server's generation slots without blocking"""
+        slots = getattr(self.server, 'generation_slots', None)
+        if slots is None:
+            return True
+        if not slots.acquire(blocking=False):
+            return False
+        METRICS.inc('server_generation_slots_in_use')
+        return True
+
+    def release_generation_slot(self):
+        slots = getattr(self.server, 'generation_slots', None)
+        if slots is not None:
+            slots.release()
+            METRICS.inc('server_generation_slots_in_use', -1)
+
+    def send_busy(self, retry_after=5, reason="All generation slots busy"):
+        """Tell the client to retry later when all generation slots are taken"""
+        log.warning(f"⏳ {reason}, rejecting request")
+        # Closing also skips whatever is left of an unread request body
+        self.send_json({
+            'success': False,
+            'error': 'Server is busy, please try again shortly'
+        }, status=503, headers=[('Retry-After', str(retry_after)), ('Connection', 'close')])
+
+    def handle_job_submission(self):
+        """Queue a /generate-ad body as a job and answer 202 with its id straight away"""
+        try:
+            content_length = int(self.headers['Content-Length'])
+            data = json.loads(self.rfile.read(content_length).decode('utf-8'))
+        except (TypeError, ValueError):
+            self.send_json({'success': False, 'error': 'Invalid JSON in request'}, status=400)
+            return
+
+        # Paid plans jump the queue, but only for a verified sign-in with a verified payment behind it
+        uid = None
+        if self.headers.get('Authorization'):
+            uid = self.authenticated_uid()
+            if uid is None:
+                return
+        job_id = JOB_STORE.submit(data, job_priority(uid), wants_new_variation(data, self.headers))
+        if job_id is None:
+            self.send_busy(reason="Job queue full")
+            return
+        JOB_RUNNER.notify()
+        log.info(f"📥 Queued job {job_id} for {data.get('productName', '')!r}")
+        self.send_json({
+            'success': True,
+            'jobId': job_id,
+            'status': 'queued',
+            'statusUrl': f'/api/jobs/{job_id}'
+        }, status=202)
+
+    def authenticated_uid(self):
+        """uid behind the request's Firebase ID token (Authorization: Bearer); answers 401/503 and returns None otherwise"""
+        scheme, _, token = (self.headers.get('Authorization') or '').partition(' ')
+        token = token.strip()
+        if scheme.lower() != 'bearer' or not token:
+            self.send_json({'success': False, 'error': 'Sign in required'}, status=401,
+                           headers=[('WWW-Authenticate', 'Bearer')])
+            return None
+        try:
+            uid = ID_TOKENS.verify(token)
+        except UpstreamRejected as e:
+            self.send_rejected(e)
+            return None
+        except Exception as e:
+            log.error(f"❌ Could not verify ID token: {e}")
+            self.send_json({'success': False, 'error': 'Could not verify sign-in, please try again'}, status=503)
+            return None
+        if uid is None:
+            self.send_json({'success': False, 'error': 'Invalid or expired sign-in'}, status=401,
+                           headers=[('WWW-Authenticate', 'Bearer error="invalid_token"')])
+        return uid
+
+    def handle_history_listing(self):
+        """Page through the signed-in user's saved ads, newest first, optionally filtered by format, language or date"""
+        query = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+        uid = self.authenticated_uid()
+        if uid is None:
+            return
+        if query.get('userId', uid) != uid:
+            self.send_json({'success': False, 'error': "Cannot read another user's history"}, status=403)
+            return
+        try:
+            limit = min(max(int(query.get('limit', 20)), 1), HISTORY_PAGE_MAX)
+            since = parse_timestamp_ms(query['since']) if query.get('since') else None
+            until = parse_timestamp_ms(query['until']) if query.get('until') else None
+            ads, next_cursor = HISTORY_STORE.list(
+                uid, limit, query.get('cursor'),
+                ad_format=query.get('format'), language=query.get('language'), since=since, until=until
+            )
+        except ValueError as e:
+            self.send_json({'success': False, 'error': f'Invalid history query: {e}'}, status=400)
+            return
+        self.send_json({'success': True, 'ads': ads, 'nextCursor': next_cursor})
+
+    def handle_history_append(self):
+        """Save one generated ad to the signed-in user's history"""
+        try:
+            content_length = int(self.headers['Content-Length'])
+            ad = json.loads(self.rfile.read(content_length).decode('utf-8'))
+            if not isinstance(ad, dict):
+                raise ValueError('expected a JSON object')
+        except (TypeError, ValueError) as e:
+            self.send_json({'success': False, 'error': f'Invalid ad: {e}'}, status=400)
+            return
+        uid = self.authenticated_uid()
+        if uid is None:
+            return
+        if ad.get('userId', uid) != uid:
+            self.send_json({'success': False, 'error': "Cannot save to another user's history"}, status=403)
+            return
+        try:
+            saved = HISTORY_STORE.append(dict(ad, userId=uid))
+        except (TypeError, ValueError, AttributeError) as e:
+            self.send_json({'success': False, 'error': f'Invalid ad: {e}'}, status=400)
+            return
+        self.send_json({'success': True, 'ad': saved}, status=201)
+
+    def send_rejected(self, error):
+        """Pass an UpstreamRejected on to the client as 429/503 with Retry-After"""
+        log.warning(f"⏳ {error}")
+        self.send_json(error.body(), status=error.status, headers=[('Retry-After', str(error.retry_after))])
+
+    def handle_create_razorpay_order(self):
+        """Handle Razorpay order creation"""
+        try:
+            # Get request data
+            content_length = int(self.headers['Content-Length'])
+            post_data = self.rfile.read(content_length)
+            data = json.loads(post_data.decode('utf-8'))
+
+            log.info(f"📡 Creating Razorpay order for plan {data.get('planKey')!r}")
+            log.debug("Razorpay order request body: %s", data)
+
+            # Validate required fields
+            required_fields = ['amount', 'planKey']
+            missing_fields = [field for field in required_fields if not data.get(field)]
+
+            if missing_fields:
+                self.send_json({
+                    'success': False,
+                    'error': f'Missing required fields: {", ".join(missing_fields)}'
+                }, status=400)
+                return
+
+            # Get Razorpay keys
+            razorpay_key_id = os.getenv('RAZORPAY_KEY_ID')
+            razorpay_key_secret = os.getenv('RAZORPAY_KEY_SECRET')
+
+            if not razorpay_key_id or not razorpay_key_secret:
+                log.error("❌ Razorpay keys not found in environment")
+                self.send_json({
+                    'success': False,
+                    'error': 'Payment system configuration error'
+                }, status=500)
+                return
+
+            idempotency_key = order_idempotency_key(data, self.headers.get('Idempotency-Key'))
+            if idempotency_key is None:
+                order = self.create_razorpay_order(data, None, razorpay_key_id, razorpay_key_secret)
+            else:
+                order = self.create_razorpay_order_once(data, idempotency_key, razorpay_key_id, razorpay_key_secret)
+
+            if order.get('success'):
+                self.send_json(order)
+            else:
+                self.send_json(order, status=500)
+
+        except json.JSONDecodeError as e:
+            log.error(f"❌ JSON decode error: {e}")
+            self.send_json({
+                'success': False,
+                'error': 'Invalid JSON in request'
+            }, status=400)
+        except UpstreamRejected as e:
+            self.send_rejected(e)
+        except Exception as e:
+            log.exception(f"❌ Order creation error: {e}")
+            self.send_json({
+                'success': False,
+                'error': 'Failed to create order',
+                'details': str(e)
+            }, status=500)
+
+    def create_razorpay_order_once(self, data, idempotency_key, razorpay_key_id, razorpay_key_secret):
+        """create_razorpay_order for the first request with this key; duplicates, in any process, get its order"""
+        while True:
+            claimed, order = PAYMENT_STORE.claim_order(idempotency_key, ORDER_CLAIM_TIMEOUT)
+            if claimed:
+                break
+            if order is not None:
+                log.info(f"♻️ Reusing Razorpay order {order['orderId']} for a repeated request")
+                return order
+            time.sleep(ORDER_CLAIM_POLL_INTERVAL)
+
+        order = None
+        try:
+            order = self.create_razorpay_order(data, idempotency_key, razorpay_key_id, razorpay_key_secret)
+        finally:
+            if order is None or not order.get('success'):
+                PAYMENT_STORE.release_claim(idempotency_key)
+        return order
+
+    def create_razorpay_order(self, data, idempotency_key, razorpay_key_id, razorpay_key_secret):
+        """Create the order upstream and store it under ``idempotency_key`` if there is one; returns the response body"""
+        import base64
+        auth_str = f"{razorpay_key_id}:{razorpay_key_secret}"
+        auth_bytes = auth_str.encode('ascii')
+        auth_b64 = base64.b64encode(auth_bytes).decode('ascii')
+
+        # Generate a short receipt ID (max 40 chars)
+        receipt_id = f"rcpt_{str(uuid.uuid4())[:8]}_{int(time.time()) % 100000}"
+
+        order_data = {
+            'amount': int(data['amount']),
+            'currency': data.get('currency', 'INR'),
+            'receipt': receipt_id,
+            'notes': {
+                'planKey': data['planKey'],
+                'userId': data.get('userId', '')
+            }
+        }
+
+        response = RAZORPAY.post(
+            '/v1/orders',
+            json=order_data,
+            headers={
+                'Authorization': f'Basic {auth_b64}',
+                'Content-Type': 'application/json'
+            }
+        )
+
+        if response.status_code != 200:
+            log.error(f"❌ Razorpay API error: {response.status_code} - {response.text}")
+            return {
+                'success': False,
+                'error': 'Failed to create order',
+                'details': response.text
+            }
+
+        order = response.json()
+        log.info(f"✅ Razorpay order created: {order['id']}")
+        result = {
+            'success': True,
+            'orderId': order['id'],
+            'amount': order['amount'],
+            'currency': order['currency'],
+            'planKey': data['planKey']
+        }
+        if idempotency_key is not None:
+            PAYMENT_STORE.put_order(idempotency_key, order['id'], result, str(data.get('userId') or ''))
+        return result
+
+    def handle_verify_payment(self):
+        """Handle payment verification"""
+        try:
+            # Get request data
+            content_length = int(self.headers['Content-Length'])
+            post_data = self.rfile.read(content_length)
+            data = json.loads(post_data.decode('utf-8'))
+
+            log.info(f"📡 Verifying payment {data.get('razorpay_payment_id')!r}")
+            log.debug("Payment verification body: %s", data)
+
+            # Validate required fields
+            required_fields = ['razorpay_payment_id', 'razorpay_order_id', 'razorpay_signature']
+            missing_fields = [field for field in required_fields if not data.get(field)]
+
+            if missing_fields:
+                self.send_json({
+                    'success': False,
+                    'error': f'Missing required payment details: {", ".join(missing_fields)}'
+                }, status=400)
+                return
+
+            # Get Razorpay secret
+            razorpay_key_secret = os.getenv('RAZORPAY_KEY_SECRET')
+
+            if not razorpay_key_secret:
+                log.error("❌ Razorpay secret not found in environment")
+                self.send_json({
+                    'success': False,
+                    'error': 'Payment verification configuration error'
+                }, status=500)
+                return
+
+            # A payment verified before is answered from its record, with the plan it was verified for
+            recorded = PAYMENT_STORE.get_payment(data['razorpay_payment_id'])
+            if recorded is not None:
+                order_id, signature_hash, response = recorded
+                signature_matches = hmac.compare_digest(
+                    signature_hash, hashlib.sha256(data['razorpay_signature'].encode('utf-8')).hexdigest()
+                )
+                if order_id == data['razorpay_order_id'] and signature_matches:
+                    log.info(f"♻️ Payment {data['razorpay_payment_id']} already verified")
+                    self.send_json(response)
+                    return
+
+            # Verify signature
+            body = f"{data['razorpay_order_id']}|{data['razorpay_payment_id']}"
+            expected_signature = hmac.new(
+                razorpay_key_secret.encode('utf-8'),
+                body.encode('utf-8'),
+                hashlib.sha256
+            ).hexdigest()
+
+            is_authentic = hmac.compare_digest(expected_signature, data['razorpay_signature'])
+
+            if not is_authentic:
+                log.error("❌ Payment signature verification failed")
+                self.send_json({
+                    'success': False,
+                    'error': 'Payment verification failed - invalid signature'
+                }, status=400)
+                return
+
+            log.info("✅ Payment signature verified successfully")
+
+            # Payment verified successfully
+            response = {
+                'success': True,
+                'message': 'Payment verified successfully',
+                'planKey': data.get('planKey', 'pro'),
+                'payment_id': data['razorpay_payment_id'],
+                'order_id': data['razorpay_order_id']
+            }
+            PAYMENT_STORE.record_payment(data['razorpay_payment_id'], data['razorpay_order_id'],
+                                         data['razorpay_signature'], response)
+            self.send_json(response)
+
+        except json.JSONDecodeError as e:
+            log.error(f"❌ JSON decode error in payment verification: {e}")
+            self.send_json({
+                'success': False,
+                'error': 'Invalid JSON in request'
+            }, status=400)
+        except Exception as e:
+            log.exception(f"❌ Payment verification error: {e}")
+            self.send_json({
+                'success': False,
+                'error': 'Payment verification failed',
+                'details': str(e)
+            }, status=500)
+
+class ThreadPoolHTTPServer(HTTPServer):
+    """HTTPServer that hands accepted connections to a fixed pool of worker threads.
+
+    Accepted sockets wait in a bounded queue; when the queue is full the
+    connection is answered with a 503 straight from the accept loop.  Only
+    ``workers - reserved_workers`` threads may run ``/generate-ad`` at once, so
+    static files, config and payment calls keep flowing while generations wait
+    on the upstream APIs.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, server_address, handler_class, workers=16, queue_size=64,
+                 reserved_workers=4, drain_timeout=30, reuse_port=False):
+        self.workers = max(1, workers)
+        self.reuse_port = reuse_port
+        self.draining = False  # set on shutdown so kept-alive connections close after their current request
+        self.drain_timeout = drain_timeout
+        self.request_queue_size = max(5, queue_size)  # listen() backlog
+        self.pending = queue.Queue(maxsize=max(1, queue_size))
+        self.generation_slots = threading.BoundedSemaphore(
+            max(1, self.workers - max(0, reserved_workers))
+        )
+        self._threads = []
+        super().__init__(server_address, handler_class)
+        METRICS.register_collector(self.collect_metrics)
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"http-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def server_bind(self):
+        if self.reuse_port:
+            # Prefork workers each bind the same port and the kernel spreads connections
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def collect_metrics(self):
+        return [
+            ('server_queue_depth', {}, self.pending.qsize()),
+            ('server_workers', {}, self.workers),
+        ]
+
+    def process_request(self, request, client_address):
+        try:
+            self.pending.put_nowait((request, client_address))
+        except queue.Full:
+            log.warning(f"⚠️ Request queue full, rejecting {client_address[0]}")
+            self._reject(request)
+
+    def _reject(self, request):
+        try:
+            request.sendall(
+                b"HTTP/1.1 503 Service Unavailable\r\n"
+                b"Retry-After: 1\r\n"
+                b"Content-Length: 0\r\n"
+                b"Connection: close\r\n\r\n"
+            )
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def _worker(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        """Stop accepting, then let the workers drain what is already queued"""
+        self.draining = True
+        if self.reuse_port:
+            # Closing a SO_REUSEPORT socket resets connections still in its backlog; take them first
+            self.socket.setblocking(False)
+            wait = self.drain_timeout
+            while True:
+                try:
+                    request, client_address = self.socket.accept()
+                except OSError:
+                    break
+                try:
+                    self.pending.put((request, client_address), timeout=wait)
+                except queue.Full:
+                    wait = 0  # the workers are stuck; turn the rest away without waiting again
+                    self._reject(request)
+        super().server_close()
+        for _ in self._threads:
+            self.pending.put(None)
+        deadline = time.monotonic() + self.drain_timeout
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        busy = sum(thread.is_alive() for thread in self._threads)
+        if busy:
+            log.warning(f"⚠️ {busy} worker(s) still busy after {self.drain_timeout}s drain timeout")
+
+
+async def generate_ad_copy_async(data, bypass_cache=False):
+    """asyncio version of AdGeneratorHandler.generate_ad_copy"""
+    key = ad_copy_cache_key(data)
+    if bypass_cache:
+        return await RESULT_CACHE.get_or_compute_async(key, lambda: fetch_ad_copy_async(data), bypass=True)
+    return await RESULT_CACHE.get_or_compute_async(
+        key, lambda: ASYNC_IN_FLIGHT.do(key, lambda: fetch_ad_copy_async(data), GENERATION_DEADLINE)
+    )
+
+
+async def fetch_ad_copy_async(data):
+    try:
+        deepseek_key = os.environ.get('DEEPSEEK_API_KEY')
+        if not deepseek_key:
+            raise Exception("DEEPSEEK_API_KEY not configured")
+
+        response = await ASYNC_DEEPSEEK.post(
+            '/v1/chat/completions',
+            headers={'Authorization': f'Bearer {deepseek_key}'},
+            json_body=build_ad_copy_payload(data)
+        )
+
+        if response.status_code == 200:
+            result = response.json()
+            return result['choices'][0]['message']['content'].strip()
+        else:
+            log.error(f"❌ DeepSeek API error: {response.status_code} - {response.text}")
+            return None
+
+    except UpstreamRejected:
+        raise
+    except Exception as e:
+        log.error(f"❌ Error generating ad copy: {e}")
+        return None
+
+
+async def generate_image_async(data, bypass_cache=False):
+    """asyncio version of AdGeneratorHandler.generate_image"""
+    key = image_cache_key(data)
+    if bypass_cache:
+        return await RESULT_CACHE.get_or_compute_async(key, lambda: fetch_image_async(data), bypass=True)
+    return await RESULT_CACHE.get_or_compute_async(
+        key, lambda: ASYNC_IN_FLIGHT.do(key, lambda: fetch_image_async(data), GENERATION_DEADLINE)
+    )
+
+
+async def fetch_image_async(data):
+    deadline = time.monotonic() + GENERATION_DEADLINE
+    try:
+        deepai_key = os.environ.get('DEEPAI_API_KEY')
+        if not deepai_key:
+            raise Exception("DEEPAI_API_KEY not configured")
+
+        response = await ASYNC_DEEPAI.post(
+            '/api/text2img',
+            headers={'api-key': deepai_key},
+            form={'text': build_image_prompt(data)}
+        )
+
+        if response.status_code == 200:
+            result = response.json()
+            # The thread outlives a cancelled task, so it is told to stop between chunks
+            cancel = threading.Event()
+            try:
+                return await asyncio.to_thread(store_image, result.get('output_url'), deadline, cancel)
+            except asyncio.CancelledError:
+                cancel.set()
+                raise
+        else:
+            log.error(f"❌ DeepAI API error: {response.status_code} - {response.text}")
+            return None
+
+    except UpstreamRejected as e:
+        log.warning(f"⏳ Skipping image: {e}")
+        return None
+    except Exception as e:
+        log.error(f"❌ Error generating image: {e}")
+        return None
+
+
+async def generate_ad_async(data, bypass_cache=False):
+    """Run copy and image generation side by side under GENERATION_DEADLINE"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + GENERATION_DEADLINE
+    copy_task = asyncio.create_task(generate_ad_copy_async(data, bypass_cache))
+    image_task = asyncio.create_task(generate_image_async(data, bypass_cache))
+
+    try:
+        try:
+            ad_copy = await asyncio.wait_for(copy_task, GENERATION_DEADLINE)
+        except asyncio.TimeoutError:
+            ad_copy = None
+        if not ad_copy:
+            raise Exception("Failed to generate ad copy")
+
+        try:
+            image_url = await asyncio.wait_for(image_task, max(0, deadline - loop.time()))
+            image_error = None if image_url else 'Failed to generate image'
+        except asyncio.TimeoutError:
+            image_url = None
+            image_error = 'Image generation timed out'
+    finally:
+        # Unlike threads, a pending coroutine can actually be cancelled; a shared call stops once nobody waits on it
+        image_task.cancel()
+
+    return assemble_ad_response(ad_copy, image_url, image_error)
+
+
+async def run_batch_async(bodies, bypass_cache, emit):
+    """asyncio version of AdGeneratorHandler.run_batch; ``emit`` is a coroutine function"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + GENERATION_DEADLINE
+    limit = asyncio.Semaphore(BATCH_CONCURRENCY)
+    image_keys = [image_cache_key(body) for body in bodies]
+    image_tasks = {}
+    for body, key in zip(bodies, image_keys):
+        if key not in image_tasks:
+            image_tasks[key] = asyncio.create_task(generate_image_async(body, bypass_cache))
+    copies = {}
+    emitted = set()
+
+    async def run_variant(index, body):
+        async with limit:
+            ad_copy = await generate_ad_copy_async(body, bypass_cache)
+        if not ad_copy:
+            return batch_result(index, body, None)
+        copies[index] = ad_copy
+        image_url = await asyncio.shield(image_tasks[image_keys[index]])
+        return batch_result(index, body, ad_copy, image_url, None if image_url else 'Failed to generate image')
+
+    tasks = [asyncio.create_task(run_variant(index, body)) for index, body in enumerate(bodies)]
+    try:
+        for next_done in asyncio.as_completed(tasks, timeout=max(0, deadline - loop.time())):
+            result = await next_done
+            emitted.add(result['index'])
+            await emit(result)
+    except asyncio.TimeoutError:
+        for index, body in enumerate(bodies):
+            if index in emitted:
+                continue
+            if index in copies:
+                await emit(batch_result(index, body, copies[index], None, 'Image generation timed out'))
+            else:
+                await emit(batch_result(index, body, None, copy_error='Ad copy generation timed out'))
+    finally:
+        for task in tasks + list(image_tasks.values()):
+            task.cancel()
+
+
+def open_sqlite(path):
+    """Autocommit connection shared across threads, in WAL mode so reads don't block the writer"""
+    db = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+    db.row_factory = sqlite3.Row
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    return db
+
+
+# Plans whose subscribers' jobs are taken ahead of free ones
+PAID_PLANS = ('pro', 'unlimited')
+
+
+def job_priority(uid):
+    """Queue priority for a job from a verified user (or None); lower runs first"""
+    return 0 if uid and str(PAYMENT_STORE.plan_for(uid) or '').lower() in PAID_PLANS else 1
+
+
+class JobStore:
+    """SQLite-backed queue of /api/jobs generation requests.
+
+    Jobs outlive the process: whatever a previous run left ``running`` is
+    queued again when the database is opened, unless ``requeue_on_open`` is
+    cleared because a prefork supervisor does that per worker instead.
+    Finished jobs are deleted ``ttl`` seconds after they complete.  The
+    connection is opened on first use and shared behind a lock; claiming is a
+    single UPDATE so it stays atomic even with several processes on one file.
+    """
+
+    def __init__(self, path, ttl=3600, max_queued=500, max_attempts=3):
+        self.path = path
+        self.ttl = ttl
+        self.max_queued = max_queued
+        self.max_attempts = max_attempts
+        self.requeue_on_open = True
+        self.db = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if self.db is None:
+            db = open_sqlite(self.path)
+            db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                priority INTEGER NOT NULL,
+                request TEXT NOT NULL,
+                bypass_cache INTEGER NOT NULL DEFAULT 0,
+                result TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                run_after REAL NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                owner INTEGER
+            )''')
+            if 'owner' not in {row['name'] for row in db.execute('PRAGMA table_info(jobs)')}:
+                db.execute('ALTER TABLE jobs ADD COLUMN owner INTEGER')
+            db.execute('CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority, created_at)')
+            if self.requeue_on_open:
+                requeued = db.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'").rowcount
+                if requeued:
+                    log.info(f"🔁 Re-queued {requeued} job(s) interrupted by the last shutdown")
+            self.db = db
+        return self.db
+
+    def requeue_running(self, owner):
+        """Queue again the jobs a process (by pid) was running when it exited"""
+        with self.lock:
+            return self._connect().execute(
+                "UPDATE jobs SET status = 'queued', updated_at = ? WHERE status = 'running' AND owner = ?",
+                (time.time(), owner)
+            ).rowcount
+
+    def submit(self, data, priority, bypass_cache=False):
+        """Queue a job and return its id, or None when the queue is full"""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self.lock:
+            db = self._connect()
+            # Checking and inserting in one statement keeps the bound across processes
+            inserted = db.execute(
+                '''INSERT INTO jobs (id, status, priority, request, bypass_cache, run_after, created_at, updated_at)
+                   SELECT ?, 'queued', ?, ?, ?, ?, ?, ?
+                   WHERE (SELECT COUNT(*) FROM jobs WHERE status = 'queued') < ?''',
+                (job_id, priority, json.dumps(data), int(bypass_cache), now, now, now, self.max_queued)
+            ).rowcount
+        return job_id if inserted else None
+
+    def claim(self):
+        """Mark the next runnable job as running; returns (id, request, bypass_cache) or None"""
+        now = time.time()
+        with self.lock:
+            row = self._connect().execute(
+                '''UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ?, owner = ?
+                   WHERE id = (SELECT id FROM jobs WHERE status = 'queued' AND run_after <= ?
+                               ORDER BY priority, created_at LIMIT 1)
+                   RETURNING id, request, bypass_cache''',
+                (now, os.getpid(), now)
+            ).fetchone()
+        if row is None:
+            return None
+        return row['id'], json.loads(row['request']), bool(row['bypass_cache'])
+
+    def complete(self, job_id, result):
+        self._finish(job_id, 'done', result=json.dumps(result))
+
+    def fail(self, job_id, error):
+        self._finish(job_id, 'failed', error=error)
+
+    def _finish(self, job_id, status, result=None, error=None):
+        with self.lock:
+            self._connect().execute(
+                'UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = ? WHERE id = ?',
+                (status, result, error, time.time(), job_id)
+            )
+
+    def retry_later(self, job_id, delay, error):
+        """Put a job back in the queue after ``delay`` seconds, or fail it once out of attempts"""
+        now = time.time()
+        with self.lock:
+            self._connect().execute(
+                '''UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END,
+                                   error = ?, run_after = ?, updated_at = ?
+                   WHERE id = ?''',
+                (self.max_attempts, error, now + delay, now, job_id)
+            )
+
+    def get(self, job_id):
+        """Public view of a job, including its place in the queue while it waits"""
+        with self.lock:
+            db = self._connect()
+            row = db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is None:
+                return None
+            job = {
+                'jobId': row['id'],
+                'status': row['status'],
+                'attempts': row['attempts'],
+                'createdAt': row['created_at'],
+                'updatedAt': row['updated_at'],
+            }
+            if row['status'] == 'queued':
+                job['position'] = db.execute(
+                    '''SELECT COUNT(*) FROM jobs WHERE status = 'queued'
+                       AND (priority < ? OR (priority = ? AND created_at < ?))''',
+                    (row['priority'], row['priority'], row['created_at'])
+                ).fetchone()[0]
+        if row['result'] is not None:
+            job['result'] = json.loads(row['result'])
+        if row['error'] is not None:
+            job['error'] = row['error']
+        return job
+
+    def purge_expired(self):
+        with self.lock:
+            return self._connect().execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                (time.time() - self.ttl,)
+            ).rowcount
+
+    def counts(self):
+        with self.lock:
+            rows = self._connect().execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        return {status: count for status, count in rows}
+
+
+class JobRunner:
+    """Works through a JobStore with ``workers`` coroutines running generate_ad_async.
+
+    In async mode the workers share the server's event loop; the threaded
+    server gives them a loop of their own on a background thread.  Jobs an
+    upstream refused go back in the queue after its Retry-After.
+    """
+
+    def __init__(self, store, workers=4, poll_interval=1.0, purge_interval=300):
+        self.store = store
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.purge_interval = purge_interval
+        self.loop = None
+        self.wakeup = None
+
+    def start_thread(self):
+        threading.Thread(target=asyncio.run, args=(self.run(),), name='job-runner', daemon=True).start()
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        await asyncio.gather(self.purge(), *(self.work() for _ in range(self.workers)))
+
+    def notify(self):
+        """Wake idle workers; safe to call from any thread"""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    async def work(self):
+        while True:
+            try:
+                job = await asyncio.to_thread(self.store.claim)
+            except sqlite3.Error as e:
+                log.error(f"❌ Could not claim a job: {e}")
+                job = None
+            if job is None:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+                continue
+
+            job_id, data, bypass_cache = job
+            try:
+                result = await generate_ad_async(data, bypass_cache)
+            except UpstreamRejected as e:
+                log.warning(f"⏳ Job {job_id} deferred: {e}")
+                await asyncio.to_thread(self.store.retry_later, job_id, e.retry_after, str(e))
+            except Exception as e:
+                log.error(f"❌ Job {job_id} failed: {e}")
+                await asyncio.to_thread(self.store.fail, job_id, str(e))
+            else:
+                await asyncio.to_thread(self.store.complete, job_id, result)
+
+    async def purge(self):
+        while True:
+            try:
+                purged = await asyncio.to_thread(self.store.purge_expired)
+                if purged:
+                    log.info(f"🧹 Removed {purged} expired job(s)")
+            except sqlite3.Error as e:
+                log.warning(f"⚠️ Job cleanup failed: {e}")
+            await asyncio.sleep(self.purge_interval)
+
+
+JOB_STORE = JobStore(
+    os.getenv('JOB_DB', 'jobs.db'),
+    ttl=float(os.getenv('JOB_TTL', 3600)),
+    max_queued=int(os.getenv('JOB_MAX_QUEUED', 500)),
+    max_attempts=int(os.getenv('JOB_MAX_ATTEMPTS', 3))
+)
+JOB_RUNNER = JobRunner(JOB_STORE, workers=int(os.getenv('JOB_WORKERS', 4)))
+
+
+def collect_job_metrics():
+    try:
+        counts = JOB_STORE.counts()
+    except sqlite3.Error:
+        return []
+    return [('jobs', {'status': status}, counts.get(status, 0))
+            for status in ('queued', 'running', 'done', 'failed')]
+
+
+METRICS.register_collector(collect_job_metrics)
+
+
+class IdTokenVerifier:
+    """Maps Firebase ID tokens to the uid they were issued for.
+
+    Tokens are checked with Identity Toolkit's accounts:lookup, which turns
+    away forged, expired and revoked ones and those of other projects.  An
+    answer is remembered for up to ``ttl`` seconds, never past the token's
+    own expiry.
+    """
+
+    def __init__(self, client, ttl=300, max_entries=10000):
+        self.client = client
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.verified = OrderedDict()  # token -> (uid, valid until)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def expiry(token):
+        """The ``exp`` claim of a JWT, unverified; None if it doesn't parse"""
+        try:
+            payload = token.split('.')[1]
+            claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+            return float(claims['exp'])
+        except (IndexError, KeyError, TypeError, ValueError):
+            return None
+
+    def verify(self, token):
+        """uid for a valid token, None for an invalid one; raises when Firebase can't be asked"""
+        now = time.time()
+        with self.lock:
+            entry = self.verified.get(token)
+            if entry is not None and entry[1] > now:
+                self.verified.move_to_end(token)
+                return entry[0]
+        expires = self.expiry(token)
+        if expires is None or expires <= now:
+            return None
+
+        api_key = os.environ.get('FIREBASE_API_KEY')
+        if not api_key:
+            raise Exception("FIREBASE_API_KEY not configured")
+        response = self.client.post('/v1/accounts:lookup', params={'key': api_key}, json={'idToken': token})
+        if response.status_code == 400:
+            return None
+        if response.status_code != 200:
+            raise Exception(f"Firebase token lookup failed: {response.status_code}")
+        users = response.json().get('users') or []
+        if not users or not users[0].get('localId'):
+            return None
+
+        uid = users[0]['localId']
+        with self.lock:
+            self.verified[token] = (uid, min(expires, now + self.ttl))
+            while len(self.verified) > self.max_entries:
+                self.verified.popitem(last=False)
+        return uid
+
+
+ID_TOKENS = IdTokenVerifier(FIREBASE_AUTH, ttl=float(os.getenv('ID_TOKEN_CACHE_TTL', 300)))
+
+
+class HistoryStore:
+    """Per-user ad history in SQLite, replacing the public/user_ads_<uid>.json files.
+
+    Rows are only ever appended.  Listing walks the (user_id, created_at)
+    index with a keyset cursor, so a page costs the same however many ads
+    a user has.  SQLite's own locking keeps concurrent writers, threads or
+    processes, from clobbering each other.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if self.db is None:
+            db = open_sqlite(self.path)
+            db.execute('''CREATE TABLE IF NOT EXISTS ads (
+                id TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                created_at INTEGER NOT NULL,
+                ad_format TEXT,
+                language TEXT,
+                product_name TEXT,
+                form_data TEXT NOT NULL,
+                text_content TEXT,
+                image_url TEXT,
+                UNIQUE (user_id, id)
+            )''')
+            db.execute('CREATE INDEX IF NOT EXISTS ads_user_time ON ads (user_id, created_at)')
+            db.execute('CREATE INDEX IF NOT EXISTS ads_user_format_time ON ads (user_id, ad_format, created_at)')
+            db.execute('CREATE INDEX IF NOT EXISTS ads_user_language_time ON ads (user_id, language, created_at)')
+            db.execute('''CREATE TABLE IF NOT EXISTS users (
+                uid TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )''')
+            self.db = db
+        return self.db
+
+    @staticmethod
+    def _row(ad):
+        """Column values for an ad in the legacy user_ads JSON shape"""
+        form_data = ad.get('formData') or {}
+        timestamp = ad.get('timestamp')
+        created_at = parse_timestamp_ms(timestamp) if timestamp else int(time.time() * 1000)
+        text_content = ad.get('textContent', ad.get('adCopy'))
+        return (
+            str(ad.get('id') or created_at),
+            str(ad['userId']),
+            created_at,
+            form_data.get('adFormat'),
+            form_data.get('language'),
+            form_data.get('productName'),
+            json.dumps(form_data),
+            json.dumps(text_content) if text_content is not None else None,
+            ad.get('imageUrl'),
+        )
+
+    def append(self, ad):
+        """Store one ad and return it as listed; an ad already stored under the same id is left alone"""
+        row = self._row(ad)
+        with self.lock:
+            self._connect().execute(
+                'INSERT OR IGNORE INTO ads (id, user_id, created_at, ad_format, language, product_name, '
+                'form_data, text_content, image_url) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', row
+            )
+        return self._ad(dict(zip(('id', 'user_id', 'created_at', 'ad_format', 'language', 'product_name',
+                                  'form_data', 'text_content', 'image_url'), row)))
+
+    @staticmethod
+    def _ad(row):
+        return {
+            'id': row['id'],
+            'userId': row['user_id'],
+            'formData': json.loads(row['form_data']),
+            'textContent': json.loads(row['text_content']) if row['text_content'] is not None else None,
+            'imageUrl': row['image_url'],
+            'thumbnailUrl': IMAGE_STORE.thumbnail_url(row['image_url']),
+            'timestamp': format_timestamp_ms(row['created_at']),
+        }
+
+    def list(self, user_id, limit=20, cursor=None, ad_format=None, language=None, since=None, until=None):
+        """Newest-first page of a user's ads and the cursor for the next page (None at the end).
+
+        ``since``/``until`` are epoch milliseconds; ``cursor`` is the value a
+        previous call returned.
+        """
+        clauses, params = ['user_id = ?'], [user_id]
+        if ad_format:
+            clauses.append('ad_format = ?')
+            params.append(ad_format)
+        if language:
+            clauses.append('language = ?')
+            params.append(language)
+        if since is not None:
+            clauses.append('created_at >= ?')
+            params.append(since)
+        if until is not None:
+            clauses.append('created_at < ?')
+            params.append(until)
+        if cursor:
+            created_at, _, rowid = cursor.partition('-')
+            clauses.append('(created_at < ? OR (created_at = ? AND rowid < ?))')
+            params += [int(created_at), int(created_at), int(rowid)]
+
+        with self.lock:
+            rows = self._connect().execute(
+                f'SELECT rowid, * FROM ads WHERE {" AND ".join(clauses)} '
+                'ORDER BY created_at DESC, rowid DESC LIMIT ?',
+                params + [limit + 1]
+            ).fetchall()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = f"{rows[-1]['created_at']}-{rows[-1]['rowid']}"
+        return [self._ad(row) for row in rows], next_cursor
+
+    def save_user(self, user):
+        with self.lock:
+            self._connect().execute(
+                'INSERT INTO users (uid, data, updated_at) VALUES (?, ?, ?) '
+                'ON CONFLICT (uid) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at',
+                (str(user['uid']), json.dumps(user), time.time())
+            )
+
+    def import_legacy(self, directory):
+        """One-shot import of user_ads_<uid>.json and user_data_<uid>.json files.
+
+        Safe to run again: ads already imported are skipped and user records
+        overwritten.  Returns (ads, users) imported.
+        """
+        ads = users = 0
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if not name.endswith('.json') or not name.startswith(('user_ads_', 'user_data_')):
+                continue
+            try:
+                with open(path, encoding='utf-8') as f:
+                    document = json.load(f)
+            except (OSError, ValueError) as e:
+                log.warning(f"⚠️ Skipping {path}: {e}")
+                continue
+
+            if name.startswith('user_data_'):
+                if isinstance(document, dict) and document.get('uid'):
+                    self.save_user(document)
+                    users += 1
+                continue
+
+            if not isinstance(document, list):
+                if document:
+                    log.warning(f"⚠️ Skipping {path}: expected a list of ads")
+                continue
+            file_uid = name[len('user_ads_'):-len('.json')]
+            rows = []
+            for position, ad in enumerate(document):
+                if not isinstance(ad, dict):
+                    log.warning(f"⚠️ Skipping entry {position} in {path}: not an ad object")
+                    continue
+                ad = dict(ad, userId=ad.get('userId') or file_uid)
+                try:
+                    rows.append(self._row(ad))
+                except (KeyError, TypeError, ValueError, AttributeError) as e:
+                    log.warning(f"⚠️ Skipping ad {ad.get('id')!r} in {path}: {e}")
+            with self.lock:
+                db = self._connect()
+                with db:
+                    db.execute('BEGIN IMMEDIATE')
+                    ads += db.executemany(
+                        'INSERT OR IGNORE INTO ads (id, user_id, created_at, ad_format, language, product_name, '
+                        'form_data, text_content, image_url) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows
+                    ).rowcount
+        return ads, users
+
+
+def parse_timestamp_ms(value):
+    """Epoch milliseconds for an ISO 8601 timestamp (``Z`` suffix allowed) or a number of ms"""
+    if isinstance(value, (int, float)) or str(value).isdigit():
+        return int(value)
+    parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp() * 1000)
+
+
+def format_timestamp_ms(value):
+    """ISO 8601 UTC timestamp in the format the browser's Date.toISOString() writes"""
+    return datetime.fromtimestamp(value / 1000, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+HISTORY_STORE = HistoryStore(os.getenv('HISTORY_DB', 'history.db'))
+HISTORY_PAGE_MAX = 100
+
+
+class PaymentStore:
+    """Razorpay orders by idempotency key, verified payments and paying users, in SQLite.
+
+    An order is reused for ``order_window`` seconds, until a payment for it
+    is verified.  Before an order is created upstream its key is claimed
+    with a pending row, so duplicates in any process wait for that order
+    instead of creating their own.  Each table keeps at most ``max_entries``
+    rows, dropping the oldest; losing an old payment record only means its
+    next verification checks the signature again.  A verified payment also
+    records the plan of its order for the user the order was created for,
+    which is what the job queue trusts.
+    """
+
+    def __init__(self, path, order_window=3600, max_entries=10000):
+        self.path = path
+        self.order_window = order_window
+        self.max_entries = max_entries
+        self.db = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if self.db is None:
+            db = open_sqlite(self.path)
+            db.execute('''CREATE TABLE IF NOT EXISTS orders (
+                idempotency_key TEXT PRIMARY KEY,
+                order_id TEXT NOT NULL,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                state TEXT NOT NULL DEFAULT 'created'
+            )''')
+            columns = {row['name'] for row in db.execute('PRAGMA table_info(orders)')}
+            if 'state' not in columns:
+                db.execute("ALTER TABLE orders ADD COLUMN state TEXT NOT NULL DEFAULT 'created'")
+            if 'user_id' not in columns:
+                db.execute("ALTER TABLE orders ADD COLUMN user_id TEXT NOT NULL DEFAULT ''")
+            db.execute('CREATE INDEX IF NOT EXISTS orders_created ON orders (created_at)')
+            db.execute('CREATE INDEX IF NOT EXISTS orders_order_id ON orders (order_id)')
+            db.execute('''CREATE TABLE IF NOT EXISTS payments (
+                payment_id TEXT PRIMARY KEY,
+                order_id TEXT NOT NULL,
+                signature_hash TEXT NOT NULL,
+                response TEXT NOT NULL,
+                verified_at REAL NOT NULL
+            )''')
+            db.execute('CREATE INDEX IF NOT EXISTS payments_verified ON payments (verified_at)')
+            db.execute('''CREATE TABLE IF NOT EXISTS subscribers (
+                user_id TEXT PRIMARY KEY,
+                plan TEXT NOT NULL,
+                order_id TEXT NOT NULL,
+                verified_at REAL NOT NULL
+            )''')
+            self.db = db
+        return self.db
+
+    def _trim(self, db, table, column):
+        db.execute(f'''DELETE FROM {table} WHERE rowid IN (
+            SELECT rowid FROM {table} ORDER BY {column} DESC LIMIT -1 OFFSET ?)''', (self.max_entries,))
+
+    def get_order(self, idempotency_key):
+        """The order response stored under this key, if still inside the window"""
+        with self.lock:
+            row = self._connect().execute(
+                "SELECT response FROM orders WHERE idempotency_key = ? AND state = 'created' AND created_at >= ?",
+                (idempotency_key, time.time() - self.order_window)
+            ).fetchone()
+        return json.loads(row['response']) if row else None
+
+    def claim_order(self, idempotency_key, stale_after):
+        """Reserve ``idempotency_key`` for an order about to be created upstream.
+
+        Returns (True, None) when the caller now holds the claim, (False,
+        response) when the order already exists and (False, None) while
+        another request is creating it.  A claim older than ``stale_after``
+        seconds is taken over.
+        """
+        now = time.time()
+        with self.lock:
+            db = self._connect()
+            with db:
+                db.execute('BEGIN IMMEDIATE')
+                row = db.execute('SELECT state, response, created_at FROM orders WHERE idempotency_key = ?',
+                                 (idempotency_key,)).fetchone()
+                if row is not None:
+                    if row['state'] == 'created' and row['created_at'] >= now - self.order_window:
+                        return False, json.loads(row['response'])
+                    if row['state'] == 'pending' and row['created_at'] >= now - stale_after:
+                        return False, None
+                db.execute(
+                    "INSERT OR REPLACE INTO orders (idempotency_key, order_id, response, created_at, state) "
+                    "VALUES (?, '', 'null', ?, 'pending')", (idempotency_key, now)
+                )
+        return True, None
+
+    def release_claim(self, idempotency_key):
+        """Drop a claim whose order could not be created, so the next request tries again"""
+        with self.lock:
+            self._connect().execute("DELETE FROM orders WHERE idempotency_key = ? AND state = 'pending'",
+                                    (idempotency_key,))
+
+    def put_order(self, idempotency_key, order_id, response, user_id=''):
+        with self.lock:
+            db = self._connect()
+            db.execute(
+                "INSERT OR REPLACE INTO orders (idempotency_key, order_id, response, created_at, state, user_id) "
+                "VALUES (?, ?, ?, ?, 'created', ?)",
+                (idempotency_key, order_id, json.dumps(response), time.time(), user_id)
+            )
+            db.execute('DELETE FROM orders WHERE created_at < ?', (time.time() - self.order_window,))
+            self._trim(db, 'orders', 'created_at')
+
+    def get_payment(self, payment_id):
+        """(order_id, signature_hash, response) recorded for a verified payment, or None"""
+        with self.lock:
+            row = self._connect().execute(
+                'SELECT order_id, signature_hash, response FROM payments WHERE payment_id = ?', (payment_id,)
+            ).fetchone()
+        return (row['order_id'], row['signature_hash'], json.loads(row['response'])) if row else None
+
+    def record_payment(self, payment_id, order_id, signature, response):
+        """Remember a verified payment; its order is paid, so it is no longer handed out again.
+
+        The user the order was created for becomes a subscriber to the order's
+        plan (not the plan the verification request names).
+        """
+        now = time.time()
+        with self.lock:
+            db = self._connect()
+            with db:
+                db.execute('BEGIN IMMEDIATE')
+                db.execute(
+                    'INSERT OR IGNORE INTO payments (payment_id, order_id, signature_hash, response, verified_at) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (payment_id, order_id, hashlib.sha256(signature.encode('utf-8')).hexdigest(),
+                     json.dumps(response), now)
+                )
+                order = db.execute("SELECT user_id, response FROM orders WHERE order_id = ? AND state = 'created' "
+                                   "AND user_id != ''", (order_id,)).fetchone()
+                plan = json.loads(order['response']).get('planKey') if order else None
+                if plan:
+                    db.execute('INSERT OR REPLACE INTO subscribers (user_id, plan, order_id, verified_at) '
+                               'VALUES (?, ?, ?, ?)', (order['user_id'], plan, order_id, now))
+                db.execute('DELETE FROM orders WHERE order_id = ?', (order_id,))
+                self._trim(db, 'payments', 'verified_at')
+
+    def plan_for(self, user_id):
+        """Plan of the user's latest verified payment, or None"""
+        with self.lock:
+            row = self._connect().execute('SELECT plan FROM subscribers WHERE user_id = ?', (user_id,)).fetchone()
+        return row['plan'] if row else None
+
+
+def order_idempotency_key(data, header_key=None):
+    """Store key for an order request: who is buying what, plus the client's Idempotency-Key if any.
+
+    Without a client key, a signed-in user's repeats of the same purchase
+    inside the window (double clicks, retries) still share one order.  With
+    neither a userId nor a client key there is nothing to tell buyers apart,
+    so the result is None and every request gets its own order.
+    """
+    client_key = header_key or data.get('idempotencyKey') or ''
+    if not data.get('userId') and not client_key:
+        return None
+    parts = [data.get('userId', ''), data['planKey'], int(data['amount']), data.get('currency', 'INR'), client_key]
+    return hashlib.sha256('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+PAYMENT_STORE = PaymentStore(
+    os.getenv('PAYMENTS_DB', 'payments.db'),
+    order_window=float(os.getenv('ORDER_IDEMPOTENCY_WINDOW', 3600)),
+    max_entries=int(os.getenv('PAYMENT_STORE_MAX_ENTRIES', 10000))
+)
+# Seconds after which a claimed order that never got created is taken over, and how often duplicates check
+ORDER_CLAIM_TIMEOUT = float(os.getenv('ORDER_CLAIM_TIMEOUT', 90))
+ORDER_CLAIM_POLL_INTERVAL = 0.1
+
+
+class BufferedRequestHandler(AdGeneratorHandler):
+    """AdGeneratorHandler run against an in-memory request instead of a socket.
+
+    The asyncio engine uses it for routes it does not implement natively, so
+    every route keeps a single implementation.
+    """
+
+    record_metrics = False
+
+    def __init__(self, request, client_address, server, keep_alive=False):
+        # The engine decides whether its connection stays open; this only labels the response
+        self.allow_keep_alive = keep_alive
+        super().__init__(request, client_address, server)
+
+    def keep_alive_allowed(self):
+        return self.allow_keep_alive
+
+    def handle(self):
+        # Exactly one buffered request; the engine owns the connection
+        self.handle_one_request()
+
+    def setup(self):
+        self.connection = None
+        self.rfile = io.BytesIO(self.request)
+        self.wfile = io.BytesIO()
+
+    def finish(self):
+        # Keep wfile readable; the engine collects the response from it
+        pass
+
+
+# Whether the response being written on this connection leaves it open; one value per connection task
+RESPONSE_KEEP_ALIVE = contextvars.ContextVar('response_keep_alive', default=False)
+
+
+class AsyncAdServer:
+    """asyncio serving engine for the same routes as AdGeneratorHandler.
+
+    The generation routes and ``/config.js`` are handled natively with
+    non-blocking upstream calls, and cached static files are answered straight
+    from STATIC_ASSETS.  Everything else (payment API, uncached files) is
+    handed to BufferedRequestHandler on a small thread pool.  Connections are
+    kept alive between requests up to KEEPALIVE_TIMEOUT and
+    KEEPALIVE_MAX_REQUESTS; event streams always end with the connection.
+    """
+
+    max_header_bytes = 64 * 1024
+    max_body_bytes = 1024 * 1024
+    request_timeout = REQUEST_TIMEOUT
+    accept_batch = 100  # connections taken per wakeup, so a burst doesn't starve running requests
+
+    def __init__(self, host, port, bridge_workers=8, drain_timeout=30, reuse_port=False):
+        self.host = host
+        self.port = port
+        self.drain_timeout = drain_timeout
+        self.reuse_port = reuse_port
+        self.bridge_executor = ThreadPoolExecutor(max_workers=bridge_workers, thread_name_prefix='bridge')
+        self.connections = set()
+        self.idle = set()  # connection tasks waiting for their next request
+        self.stopping = False
+        self.listener = None
+
+    async def serve(self):
+        # Accepted by hand rather than through start_server, so every accepted connection is
+        # tracked from the start and the backlog can still be taken off the socket at shutdown
+        self.listener = socket.create_server((self.host, self.port), backlog=100, reuse_port=self.reuse_port)
+        self.listener.setblocking(False)
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self.listener.fileno(), self.accept_pending, self.accept_batch)
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        PREFORK_CHANNEL.ready()
+        jobs = asyncio.create_task(JOB_RUNNER.run())
+
+        await stop.wait()
+        log.info("👋 Server stopping, draining in-flight requests...")
+        # Running jobs are picked up again on the next start
+        jobs.cancel()
+        loop.remove_reader(self.listener.fileno())
+        # Closing a SO_REUSEPORT socket resets connections still in its backlog; take them first
+        self.accept_pending()
+        self.listener.close()
+        self.stopping = True
+        for task in self.idle:
+            task.cancel()
+        if self.connections:
+            await asyncio.wait(set(self.connections), timeout=self.drain_timeout)
+        self.bridge_executor.shutdown(wait=False, cancel_futures=True)
+
+    def accept_pending(self, limit=None):
+        """Start a connection task for each connection queued on the listener, up to ``limit``"""
+        accepted = 0
+        while limit is None or accepted < limit:
+            try:
+                sock, _ = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                log.warning(f"⚠️ Accept failed: {e}")
+                return
+            sock.setblocking(False)
+            self.connections.add(asyncio.create_task(self.handle_connection(sock)))
+            accepted += 1
 
-    def serve_robots(self):
-        """Serve robots.txt"""
+    async def handle_connection(self, sock):
         try:
-            with open('public/robots.txt', 'r') as f:
-                robots_content = f.read()
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'text/plain')
-            self.send_header('Cache-Control', 'max-age=86400')  # Cache for 1 day
-            self.end_headers()
-            self.wfile.write(robots_content.encode())
-        except Exception as e:
-            print(f"❌ Error serving robots.txt: {e}")
-            self.send_error(404, "Robots.txt not found")
+            try:
+                reader, writer = await asyncio.open_connection(sock=sock, limit=self.max_header_bytes)
+            except OSError:
+                sock.close()
+                return
+            peer = writer.get_extra_info('peername') or ('', 0)
+            try:
+                for served in range(KEEPALIVE_MAX_REQUESTS):
+                    # Responses say Connection: close unless this request turns out to allow reuse
+                    RESPONSE_KEEP_ALIVE.set(False)
+                    if not await self.handle_request(reader, writer, peer, served):
+                        break
+            except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError, asyncio.CancelledError):
+                pass
+            finally:
+                writer.close()
+        finally:
+            self.connections.discard(asyncio.current_task())
 
-    def do_POST(self):
-        """Handle POST requests"""
-        path = urlparse(self.path).path
+    async def handle_request(self, reader, writer, peer, served):
+        """Read and answer one request; returns whether the connection may be reused"""
+        task = asyncio.current_task()
+        if served:
+            if self.stopping:
+                return False
+            self.idle.add(task)
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'),
+                                          KEEPALIVE_TIMEOUT if served else self.request_timeout)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            return False
+        finally:
+            self.idle.discard(task)
 
-        if path == '/generate-ad':
-            self.handle_ad_generation()
-        elif path == '/api/create-razorpay-order':
-            self.handle_create_razorpay_order()
-        elif path == '/api/verify-payment':
-            self.handle_verify_payment()
-        else:
-            self.send_error(404, "API endpoint not implemented")
+        request_line, _, header_block = head.decode('latin-1').partition('\r\n')
+        parts = request_line.split()
+        if len(parts) != 3:
+            await self.send(writer, 400, b'Bad request', 'text/plain')
+            return False
+        method, target, version = parts
+        headers = requests.structures.CaseInsensitiveDict()
+        for line in header_block.split('\r\n'):
+            name, sep, value = line.partition(':')
+            if sep:
+                headers[name.strip()] = value.strip()
 
-    def serve_config(self):
         try:
-            # Get API keys from environment
-            deepseek_key = os.environ.get('DEEPSEEK_API_KEY', '')
-            deepai_key = os.environ.get('DEEPAI_API_KEY', '')
-            razorpay_key_id = os.environ.get('RAZORPAY_KEY_ID', '')
-            razorpay_key_secret = os.environ.get('RAZORPAY_KEY_SECRET', '')
-            firebase_api_key = os.environ.get('FIREBASE_API_KEY', '')
-            firebase_auth_domain = os.environ.get('FIREBASE_AUTH_DOMAIN', '')
-            firebase_project_id = os.environ.get('FIREBASE_PROJECT_ID', '')
-            firebase_app_id = os.environ.get('FIREBASE_APP_ID', '')
-
-            # Check for missing keys
-            missing_keys = []
-            if not deepseek_key or len(deepseek_key.strip()) < 5:
-                missing_keys.append('DEEPSEEK_API_KEY')
-            if not deepai_key or len(deepai_key.strip()) < 5:
-                missing_keys.append('DEEPAI_API_KEY')
-
-            # Log key status
-            print(f"🔑 DEEPSEEK_API_KEY: {'✅ Present' if deepseek_key else '❌ Missing'} ({len(deepseek_key)} chars)")
-            print(f"🔑 DEEPAI_API_KEY: {'✅ Present' if deepai_key else '❌ Missing'} ({len(deepai_key)} chars)")
-            print(f"🔑 RAZORPAY_KEY_ID: {'✅ Present' if razorpay_key_id else '❌ Missing'} ({len(razorpay_key_id)} chars)")
-            print(f"🔑 RAZORPAY_KEY_SECRET: {'✅ Present' if razorpay_key_secret else '❌ Missing'} ({len(razorpay_key_secret)} chars)")
-            print(f"🔑 FIREBASE_API_KEY: {'✅ Present' if firebase_api_key else '❌ Missing'} ({len(firebase_api_key)} chars)")
-            print(f"🔑 FIREBASE_AUTH_DOMAIN: {'✅ Present' if firebase_auth_domain else '❌ Missing'} ({len(firebase_auth_domain)} chars)")
-            print(f"🔑 FIREBASE_PROJECT_ID: {'✅ Present' if firebase_project_id else '❌ Missing'} ({len(firebase_project_id)} chars)")
-            print(f"🔑 FIREBASE_APP_ID: {'✅ Present' if firebase_app_id else '❌ Missing'} ({len(firebase_app_id)} chars)")
-
-            if missing_keys:
-                print(f"❌ CRITICAL: Missing API keys: {', '.join(missing_keys)}")
-                print("   - Go to Secrets tab in the left sidebar")
-                print("   - Add DEEPSEEK_API_KEY with your DeepSeek API key")
-                print("   - Add DEEPAI_API_KEY with your DeepAI API key")
-
-            config_js = f'''
-window.CONFIG = {{
-    DEEPSEEK_API_KEY: '{deepseek_key}',
-    DEEPAI_API_KEY: '{deepai_key}',
-    RAZORPAY_KEY_ID: '{razorpay_key_id}',
-    RAZORPAY_KEY_SECRET: '{razorpay_key_secret}',
-    FIREBASE_API_KEY: '{firebase_api_key}',
-    FIREBASE_AUTH_DOMAIN: '{firebase_auth_domain}',
-    FIREBASE_PROJECT_ID: '{firebase_project_id}',
-    FIREBASE_APP_ID: '{firebase_app_id}',
-    SHOW_3D_EARLY: true,
-    MISSING_KEYS: {str(missing_keys).replace("'", '"')}
-}};
-console.log('✅ Config loaded from server:', Object.keys(window.CONFIG));
-if (window.CONFIG.MISSING_KEYS.length > 0) {{
-    console.error('❌ Missing API keys:', window.CONFIG.MISSING_KEYS);
-    console.log('🔧 Please add these keys in Replit Secrets and refresh the page');
-}}
-'''
-            self.send_response(200)
-            self.send_header('Content-type', 'application/javascript')
-            self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(config_js.encode())
-        except Exception as e:
-            print(f"❌ Error serving config: {e}")
-            error_config = f'''
-window.CONFIG = {{
-    DEEPSEEK_API_KEY: '',
-    DEEPAI_API_KEY: '',
-    RAZORPAY_KEY_ID: '',
-    RAZORPAY_KEY_SECRET: '',
-    FIREBASE_API_KEY: '',
-    FIREBASE_AUTH_DOMAIN: '',
-    FIREBASE_PROJECT_ID: '',
-    FIREBASE_APP_ID: '',
-    SHOW_3D_EARLY: true,
-    MISSING_KEYS: ["DEEPSEEK_API_KEY", "DEEPAI_API_KEY"]
-}};
-console.error('❌ Config loading failed');
-'''
-            self.send_response(500)
-            self.send_header('Content-type', 'application/javascript')
-            self.end_headers()
-            self.wfile.write(error_config.encode())
+            length = int(headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            await self.send(writer, 400, b'Invalid Content-Length', 'text/plain')
+            return False
+        if length > self.max_body_bytes:
+            await self.send(writer, 413, b'Request body too large', 'text/plain')
+            return False
+        body = await asyncio.wait_for(reader.readexactly(length), self.request_timeout) if length else b''
 
-    def handle_ad_generation(self):
+        RESPONSE_KEEP_ALIVE.set(
+            served + 1 < KEEPALIVE_MAX_REQUESTS and not self.stopping and not headers.get('Transfer-Encoding')
+            and client_wants_keep_alive(version, headers.get('Connection'))
+        )
+        started = time.perf_counter()
+        METRICS.inc('http_requests_in_flight')
+        status = 0
         try:
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            data = json.loads(post_data.decode('utf-8'))
+            status = await self.dispatch(method, target, headers, head + body, body, writer, peer)
+        finally:
+            METRICS.inc('http_requests_in_flight', -1)
+            record_request(urlparse(target).path, method, status, started)
+        log_access(peer[0], method, target, status, started)
+        return RESPONSE_KEEP_ALIVE.get()
 
-            print(f"🚀 Received ad generation request: {data}")
+    async def dispatch(self, method, target, headers, raw_request, body, writer, peer):
+        path = urlparse(target).path
 
-            # Generate ad copy
-            ad_copy = self.generate_ad_copy(data)
-            if not ad_copy:
-                raise Exception("Failed to generate ad copy")
+        if method == 'GET' and path in ('/config.js', '/api/config.js'):
+            try:
+                config_js = render_config_js()
+                status = 200
+            except Exception as e:
+                log.error(f"❌ Error serving config: {e}")
+                config_js, status = CONFIG_ERROR_JS, 500
+            await self.send(writer, status, config_js.encode(), 'application/javascript',
+                            {'Cache-Control': 'no-cache, no-store, must-revalidate'})
+            return status
 
-            # Generate image
-            image_url = self.generate_image(data)
-            if not image_url:
-                raise Exception("Failed to generate image")
+        if method == 'POST' and path == '/generate-ad':
+            try:
+                data = json.loads(body.decode('utf-8'))
+                log.info(f"🚀 Received ad generation request for {data.get('productName', '')!r}")
+                log.debug("Ad generation request body: %s", data)
+                response = await generate_ad_async(data, wants_new_variation(data, headers))
+                status = 200
+            except UpstreamRejected as e:
+                log.warning(f"⏳ {e}")
+                await self.send_json(writer, e.status, e.body(), headers, {'Retry-After': str(e.retry_after)})
+                return e.status
+            except Exception as e:
+                log.exception(f"❌ Error in ad generation: {e}")
+                response, status = {'success': False, 'error': str(e)}, 500
+            await self.send_json(writer, status, response, headers)
+            return status
 
-            response = {
-                'success': True,
-                'ad_copy': ad_copy,
-                'image_url': image_url
-            }
+        if method == 'POST' and path == '/generate-ad/batch':
+            return await self.batch_generation(writer, body, headers)
 
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(response).encode())
+        if path == '/generate-ad/stream' and method in ('GET', 'POST'):
+            try:
+                if method == 'GET':
+                    data = {key: values[0] for key, values in parse_qs(urlparse(target).query).items()}
+                else:
+                    data = json.loads(body.decode('utf-8'))
+            except ValueError:
+                await self.send_json(writer, 400, {'success': False, 'error': 'Invalid JSON in request'}, headers)
+                return 400
+            await self.stream_ad_generation(writer, data, headers)
+            return 200
 
-        except Exception as e:
-            print(f"❌ Error in ad generation: {e}")
-            traceback.print_exc()
+        if method in ('GET', 'HEAD') and path.startswith(ImageStore.URL_PREFIX):
+            # May hit the index, the disk and Pillow, so keep it off the loop
+            status, response_headers, f = await asyncio.to_thread(IMAGE_STORE.respond, path, headers)
+            await self.write_response(writer, status, response_headers, b'')
+            if f is not None:
+                with f:
+                    while method == 'GET' and (chunk := await asyncio.to_thread(f.read, IMAGE_STORE.chunk_size)):
+                        writer.write(chunk)
+                        await writer.drain()
+            return status
 
-            error_response = {
-                'success': False,
-                'error': str(e)
-            }
+        if method in ('GET', 'HEAD') and not path.startswith('/api/'):
+            # A cache miss stats and reads (and maybe compresses) the file, so keep it off the loop
+            response = await asyncio.to_thread(STATIC_ASSETS.respond, path, headers, method == 'HEAD')
+            if response is not None:
+                status, response_headers, content = response
+                await self.write_response(writer, status, response_headers, content)
+                return status
 
-            self.send_response(500)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(error_response).encode())
+        # Everything else goes through the regular handler off the event loop
+        loop = asyncio.get_running_loop()
+        output, keep_alive = await loop.run_in_executor(self.bridge_executor, self.run_bridged, raw_request, peer,
+                                                        RESPONSE_KEEP_ALIVE.get())
+        RESPONSE_KEEP_ALIVE.set(keep_alive)
+        writer.write(output)
+        await writer.drain()
+        return output[9:12].decode('latin-1') if output else '-'
 
-    def generate_ad_copy(self, data):
+    async def batch_generation(self, writer, body, headers):
+        """asyncio version of AdGeneratorHandler.handle_batch_generation"""
         try:
-            deepseek_key = os.environ.get('DEEPSEEK_API_KEY')
-            if not deepseek_key:
-                raise Exception("DEEPSEEK_API_KEY not configured")
+            data = json.loads(body.decode('utf-8'))
+            bodies = expand_batch_request(data)
+        except (ValueError, AttributeError) as e:
+            await self.send_json(writer, 400, {'success': False, 'error': f'Invalid batch request: {e}'}, headers)
+            return 400
 
-            language = data.get('language', 'English')
-            product_name = data.get('productName', '')
-            product_description = data.get('productDescription', '')
-            target_audience = data.get('targetAudience', '')
-            special_offer = data.get('specialOffer', '')
-            tone = data.get('tone', 'professional')
+        log.info(f"🚀 Received batch generation request: {len(bodies)} variants of {data.get('productName', '')!r}")
+        bypass_cache = wants_new_variation(data, headers)
+        results = []
 
-            prompt = f"""Create a compelling Facebook ad copy in {language} for:
-Product: {product_name}
-Description: {product_description}
-Target Audience: {target_audience}
-Special Offer: {special_offer}
-Tone: {tone}
+        if not (data.get('stream') or 'text/event-stream' in (headers.get('Accept') or '')):
+            async def collect(result):
+                results.append(result)
 
-Create engaging ad copy that includes:
-1. An attention-grabbing headline
-2. Clear benefits and value proposition
-3. Call to action
-4. Keep it concise and persuasive
+            await run_batch_async(bodies, bypass_cache, collect)
+            results.sort(key=lambda result: result['index'])
+            await self.send_json(writer, 200, {'success': True, 'results': results}, headers)
+            return 200
 
-Write in {language} language only."""
+        self.start_event_stream(writer)
 
-            headers = {
-                'Authorization': f'Bearer {deepseek_key}',
-                'Content-Type': 'application/json'
-            }
+        async def send_result(result):
+            results.append(result)
+            writer.write(format_sse('result', result))
+            await writer.drain()
 
-            payload = {
-                'model': 'deepseek-chat',
-                'messages': [{'role': 'user', 'content': prompt}],
-                'max_tokens': 300,
-                'temperature': 0.7
-            }
+        try:
+            await run_batch_async(bodies, bypass_cache, send_result)
+            writer.write(format_sse('done', {'success': True, 'count': len(results)}))
+            await writer.drain()
+        except ConnectionError:
+            log.info("🔌 Client left the batch stream")
+        return 200
 
-            response = requests.post(
-                'https://api.deepseek.com/v1/chat/completions',
-                headers=headers,
-                json=payload,
-                timeout=30
-            )
+    async def stream_ad_generation(self, writer, data, headers):
+        """asyncio version of AdGeneratorHandler.handle_ad_generation_stream"""
+        log.info(f"🚀 Received streaming ad generation request for {data.get('productName', '')!r}")
+        log.debug("Streaming ad generation request body: %s", data)
+        bypass_cache = wants_new_variation(data, headers)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + GENERATION_DEADLINE
+        image_task = asyncio.create_task(generate_image_async(data, bypass_cache))
 
-            if response.status_code == 200:
-                result = response.json()
-                return result['choices'][0]['message']['content'].strip()
-            else:
-                print(f"❌ DeepSeek API error: {response.status_code} - {response.text}")
-                return None
+        self.start_event_stream(writer)
 
-        except Exception as e:
-            print(f"❌ Error generating ad copy: {e}")
-            return None
+        async def emit(event, payload):
+            writer.write(format_sse(event, payload))
+            await writer.drain()
 
-    def generate_image(self, data):
         try:
-            deepai_key = os.environ.get('DEEPAI_API_KEY')
-            if not deepai_key:
-                raise Exception("DEEPAI_API_KEY not configured")
+            copy_key = ad_copy_cache_key(data)
+            ad_copy = None if bypass_cache else RESULT_CACHE.get(copy_key)
+            if ad_copy is None:
+                deepseek_key = os.environ.get('DEEPSEEK_API_KEY')
+                if not deepseek_key:
+                    raise Exception("DEEPSEEK_API_KEY not configured")
+                tokens = []
 
-            product_name = data.get('productName', '')
-            product_description = data.get('productDescription', '')
+                async def relay():
+                    stream = ASYNC_DEEPSEEK.stream_lines(
+                        '/v1/chat/completions',
+                        headers={'Authorization': f'Bearer {deepseek_key}'},
+                        json_body=dict(build_ad_copy_payload(data), stream=True)
+                    )
+                    async with aclosing(stream):
+                        async for line in stream:
+                            token = parse_copy_stream_line(line)
+                            if token is None:
+                                break
+                            if token:
+                                tokens.append(token)
+                                await emit('token', {'text': token})
 
-            prompt = f"Professional advertisement image for {product_name}: {product_description}, high quality, modern design, marketing photo"
+                try:
+                    await asyncio.wait_for(relay(), max(0, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    raise Exception("Ad copy generation timed out")
+                ad_copy = ''.join(tokens).strip()
+                if not ad_copy:
+                    raise Exception("Failed to generate ad copy")
+                RESULT_CACHE.put(copy_key, ad_copy)
+            await emit('copy', {'ad_copy': ad_copy})
 
-            response = requests.post(
-                'https://api.deepai.org/api/text2img',
-                data={'text': prompt},
-                headers={'api-key': deepai_key},
-                timeout=30
-            )
+            while True:
+                try:
+                    wait = max(0, min(SSE_HEARTBEAT_INTERVAL, deadline - loop.time()))
+                    image_url = await asyncio.wait_for(asyncio.shield(image_task), wait)
+                    image_error = None if image_url else 'Failed to generate image'
+                    break
+                except asyncio.TimeoutError:
+                    if loop.time() >= deadline:
+                        image_url, image_error = None, 'Image generation timed out'
+                        break
+                    writer.write(b': keep-alive\n\n')
+                    await writer.drain()
 
-            if response.status_code == 200:
-                result = response.json()
-                return result.get('output_url')
-            else:
-                print(f"❌ DeepAI API error: {response.status_code} - {response.text}")
-                return None
+            await emit('image', image_event(image_url, image_error))
+            await emit('done', {'success': True})
 
+        except ConnectionError:
+            log.info("🔌 Client left the ad stream, closing upstream")
+        except UpstreamRejected as e:
+            log.warning(f"⏳ {e}")
+            try:
+                await emit('error', e.body())
+            except ConnectionError:
+                pass
         except Exception as e:
-            print(f"❌ Error generating image: {e}")
-            return None
+            log.exception(f"❌ Error in streaming ad generation: {e}")
+            try:
+                await emit('error', {'success': False, 'error': str(e)})
+            except ConnectionError:
+                pass
+        finally:
+            image_task.cancel()
 
-    def handle_api_request(self):
-        self.send_error(404, "API endpoint not implemented")
+    def run_bridged(self, raw_request, peer, keep_alive):
+        """Run a request through BufferedRequestHandler; returns (response bytes, whether to keep the connection)"""
+        handler = BufferedRequestHandler(raw_request, peer, self, keep_alive=keep_alive)
+        return handler.wfile.getvalue(), keep_alive and not handler.close_connection
 
-    def send_json(self, data, status=200):
-        """Send a JSON response"""
-        self.send_response(status)
-        self.send_header('Content-Type', 'application/json')
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        self.end_headers()
-        self.wfile.write(json.dumps(data).encode('utf-8'))
+    @staticmethod
+    def start_event_stream(writer):
+        RESPONSE_KEEP_ALIVE.set(False)
+        writer.write((
+            "HTTP/1.1 200 OK\r\n"
+            f"Date: {formatdate(usegmt=True)}\r\n"
+            "Content-Type: text/event-stream\r\n"
+            "Cache-Control: no-cache\r\n"
+            "X-Accel-Buffering: no\r\n"
+            "Connection: close\r\n"
+            "Access-Control-Allow-Origin: *\r\n\r\n"
+        ).encode('latin-1'))
 
-    def handle_create_razorpay_order(self):
-        """Handle Razorpay order creation"""
-        try:
-            # Get request data
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            data = json.loads(post_data.decode('utf-8'))
+    async def send(self, writer, status, body, content_type, extra_headers=None):
+        headers = [('Content-Type', content_type), ('Content-Length', str(len(body)))]
+        headers += list((extra_headers or {}).items())
+        await self.write_response(writer, status, headers, body)
 
-            print(f"📡 Creating Razorpay order: {data}")
+    async def send_json(self, writer, status, data, request_headers, extra_headers=None):
+        body, encoding_headers = encode_json_body(data, request_headers.get('Accept-Encoding'))
+        await self.send(writer, status, body, 'application/json', dict(extra_headers or {}, **dict(encoding_headers)))
 
-            # Validate required fields
-            required_fields = ['amount', 'planKey']
-            missing_fields = [field for field in required_fields if not data.get(field)]
+    async def write_response(self, writer, status, headers, body):
+        lines = [
+            f"HTTP/1.1 {status} {HTTPStatus(status).phrase}",
+            f"Date: {formatdate(usegmt=True)}",
+            "Connection: keep-alive" if RESPONSE_KEEP_ALIVE.get() else "Connection: close",
+            "Access-Control-Allow-Origin: *",
+            "Access-Control-Allow-Methods: GET, POST, OPTIONS",
+            "Access-Control-Allow-Headers: Content-Type, Authorization",
+        ]
+        lines += [f"{name}: {value}" for name, value in headers]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
 
-            if missing_fields:
-                self.send_json({
-                    'success': False,
-                    'error': f'Missing required fields: {", ".join(missing_fields)}'
-                }, status=400)
-                return
 
-            # Get Razorpay keys
-            razorpay_key_id = os.getenv('RAZORPAY_KEY_ID')
-            razorpay_key_secret = os.getenv('RAZORPAY_KEY_SECRET')
+def encode_metrics(values, histograms):
+    """METRICS.snapshot() output as JSON-safe lists"""
+    return {
+        'values': [[name, [list(pair) for pair in labels], value] for (name, labels), value in values.items()],
+        'histograms': [[name, [list(pair) for pair in labels], series]
+                       for (name, labels), series in histograms.items()],
+    }
 
-            if not razorpay_key_id or not razorpay_key_secret:
-                print("❌ Razorpay keys not found in environment")
-                self.send_json({
-                    'success': False,
-                    'error': 'Payment system configuration error'
-                }, status=500)
+
+def decode_metrics(data):
+    values = {(name, tuple(tuple(pair) for pair in labels)): value for name, labels, value in data['values']}
+    histograms = {(name, tuple(tuple(pair) for pair in labels)): series
+                  for name, labels, series in data['histograms']}
+    return values, histograms
+
+
+class PreforkChannel:
+    """Worker end of the pipe to the prefork supervisor; a no-op outside prefork mode.
+
+    The worker says ``ready`` once it is listening, then reports a metrics
+    snapshot every ``interval`` seconds.  If the supervisor has gone away the
+    write fails and the worker shuts itself down rather than live on orphaned.
+    """
+
+    def __init__(self, fd=None, rollup_path=None, interval=2.0):
+        self.fd = int(fd) if fd else None
+        self.rollup_path = rollup_path
+        self.interval = interval
+        self.lock = threading.Lock()
+
+    @property
+    def active(self):
+        return self.fd is not None
+
+    def send(self, message):
+        data = (json.dumps(message) + '\n').encode('utf-8')
+        try:
+            with self.lock:
+                while data:
+                    data = data[os.write(self.fd, data):]
+        except OSError:
+            log.warning("⚠️ Lost the prefork supervisor, shutting down")
+            os.kill(os.getpid(), signal.SIGTERM)
+            raise
+
+    def ready(self):
+        if not self.active:
+            return
+        try:
+            self.send({'event': 'ready'})
+        except OSError:
+            return
+        threading.Thread(target=self.report, name='prefork-report', daemon=True).start()
+
+    def report(self):
+        while True:
+            try:
+                self.send(dict(encode_metrics(*METRICS.snapshot()), event='metrics'))
+            except OSError:
                 return
+            time.sleep(self.interval)
 
-            # Create order using Razorpay API
-            import base64
-            auth_str = f"{razorpay_key_id}:{razorpay_key_secret}"
-            auth_bytes = auth_str.encode('ascii')
-            auth_b64 = base64.b64encode(auth_bytes).decode('ascii')
-
-            # Generate a short receipt ID (max 40 chars)
-            receipt_id = f"rcpt_{str(uuid.uuid4())[:8]}_{int(time.time()) % 100000}"
-            
-            order_data = {
-                'amount': int(data['amount']),
-                'currency': data.get('currency', 'INR'),
-                'receipt': receipt_id,
-                'notes': {
-                    'planKey': data['planKey'],
-                    'userId': data.get('userId', '')
-                }
-            }
+    def finish(self):
+        """Send a last snapshot once drained, so nothing served is missing from the roll-up"""
+        if self.active:
+            try:
+                self.send(dict(encode_metrics(*METRICS.snapshot()), event='metrics'))
+            except OSError:
+                pass
 
-            response = requests.post(
-                'https://api.razorpay.com/v1/orders',
-                json=order_data,
-                headers={
-                    'Authorization': f'Basic {auth_b64}',
-                    'Content-Type': 'application/json'
-                },
-                timeout=30
-            )
 
-            if response.status_code == 200:
-                order = response.json()
-                print(f"✅ Razorpay order created: {order['id']}")
+PREFORK_CHANNEL = PreforkChannel(
+    os.getenv('PREFORK_CHANNEL_FD'),
+    rollup_path=os.getenv('PREFORK_METRICS_FILE'),
+    interval=float(os.getenv('PREFORK_STATS_INTERVAL', 2))
+)
 
-                self.send_json({
-                    'success': True,
-                    'orderId': order['id'],
-                    'amount': order['amount'],
-                    'currency': order['currency'],
-                    'planKey': data['planKey']
-                })
-            else:
-                print(f"❌ Razorpay API error: {response.status_code} - {response.text}")
-                self.send_json({
-                    'success': False,
-                    'error': 'Failed to create order',
-                    'details': response.text
-                }, status=500)
 
-        except json.JSONDecodeError as e:
-            print(f"❌ JSON decode error: {e}")
-            self.send_json({
-                'success': False,
-                'error': 'Invalid JSON in request'
-            }, status=400)
-        except Exception as e:
-            print(f"❌ Order creation error: {e}")
-            self.send_json({
-                'success': False,
-                'error': 'Failed to create order',
-                'details': str(e)
-            }, status=500)
+def render_metrics():
+    """Prometheus text for /api/metrics; under prefork, the supervisor's roll-up of every worker"""
+    if PREFORK_CHANNEL.rollup_path:
+        try:
+            with open(PREFORK_CHANNEL.rollup_path) as f:
+                return METRICS.render(*decode_metrics(json.load(f)))
+        except FileNotFoundError:
+            pass  # no worker has reported yet
+        except (ValueError, KeyError) as e:
+            log.warning(f"⚠️ Unreadable metrics roll-up, serving this worker's own: {e}")
+    return METRICS.render()
 
-    def handle_verify_payment(self):
-        """Handle payment verification"""
+
+METRICS.describe('prefork_workers', 'gauge', 'Prefork worker processes that are up and serving')
+METRICS.describe('prefork_worker_restarts_total', 'counter', 'Prefork workers restarted after exiting unexpectedly')
+METRICS.describe('prefork_reloads_total', 'counter', 'Rolling reloads completed, by result')
+
+
+class PreforkWorker:
+    """One server.py worker process as seen by PreforkSupervisor"""
+
+    def __init__(self, slot, process, fd):
+        self.slot = slot
+        self.process = process
+        self.fd = fd
+        self.buffer = b''
+        self.ready = False
+        self.metrics = None  # last reported (values, histograms)
+        self.started = time.monotonic()
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+
+class PreforkSupervisor:
+    """Runs ``workers`` server.py processes that share one port through SO_REUSEPORT.
+
+    Each worker is a fresh interpreter running ``engine`` (threaded or async),
+    so a reload also picks up new code.  A worker that exits on its own is
+    started again, with a growing delay if it keeps dying straight away.
+    SIGHUP replaces the workers one at a time, each new one listening before
+    the old one is told to drain, so the port never goes dark.  SIGTERM or
+    SIGINT drains them all and exits.
+
+    Workers report metrics snapshots over a pipe; counters and histograms
+    are summed, gauges are kept per worker slot, and the result is written to
+    ``rollup_path`` for whichever worker answers /api/metrics.  Totals from
+    workers that have exited are carried forward so counters never go back.
+    """
+
+    # Gauges read from shared storage, so every worker reports the same value
+    shared_collectors = {'jobs': collect_job_metrics}
+
+    def __init__(self, workers, engine='threaded', drain_timeout=30, ready_timeout=30):
+        self.size = max(1, workers)
+        self.engine = engine
+        self.drain_timeout = drain_timeout
+        self.ready_timeout = ready_timeout
+        self.workers = {}  # slot -> current PreforkWorker
+        self.processes = []  # every live process: current, starting and draining
+        self.failures = {}  # slot -> consecutive quick exits
+        self.restart_at = {}  # slot -> monotonic time its replacement is due
+        self.retired = ({}, {})  # counters and histograms of exited workers
+        self.rollup_dir = tempfile.mkdtemp(prefix='adgen-prefork-')
+        self.rollup_path = os.path.join(self.rollup_dir, 'metrics.json')
+        self.rollup_dirty = False
+        self.stopping = False
+        self.reload_requested = False
+
+    def spawn(self, slot):
+        read_fd, write_fd = os.pipe()
+        env = dict(os.environ, SERVER_MODE=self.engine, PREFORK_CHANNEL_FD=str(write_fd),
+                   PREFORK_METRICS_FILE=self.rollup_path)
         try:
-            # Get request data
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            data = json.loads(post_data.decode('utf-8'))
+            process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--mode', self.engine],
+                                       env=env, pass_fds=(write_fd,))
+        except OSError:
+            os.close(read_fd)
+            raise
+        finally:
+            os.close(write_fd)
+        worker = PreforkWorker(slot, process, read_fd)
+        self.processes.append(worker)
+        log.info(f"👷 Started worker {slot} (pid {worker.pid})")
+        return worker
 
-            print(f"📡 Verifying payment: {data}")
+    def pump(self, timeout):
+        """Read whatever the workers have sent, waiting up to ``timeout`` seconds"""
+        fds = {worker.fd: worker for worker in self.processes if worker.fd is not None}
+        if not fds:
+            time.sleep(timeout)
+            return
+        readable, _, _ = select.select(list(fds), [], [], timeout)
+        for fd in readable:
+            self.read(fds[fd])
 
-            # Validate required fields
-            required_fields = ['razorpay_payment_id', 'razorpay_order_id', 'razorpay_signature']
-            missing_fields = [field for field in required_fields if not data.get(field)]
+    def read(self, worker):
+        """Handle one read's worth of messages; returns False once the worker closed its end"""
+        data = os.read(worker.fd, 65536)
+        if not data:
+            os.close(worker.fd)
+            worker.fd = None
+            return False
+        *lines, worker.buffer = (worker.buffer + data).split(b'\n')
+        for line in lines:
+            self.handle_message(worker, line)
+        return True
 
-            if missing_fields:
-                self.send_json({
-                    'success': False,
-                    'error': f'Missing required payment details: {", ".join(missing_fields)}'
-                }, status=400)
-                return
+    def handle_message(self, worker, line):
+        try:
+            message = json.loads(line)
+        except ValueError:
+            log.warning(f"⚠️ Unreadable message from worker {worker.slot} (pid {worker.pid})")
+            return
+        if message.get('event') == 'ready':
+            worker.ready = True
+            self.failures.pop(worker.slot, None)
+            log.info(f"✅ Worker {worker.slot} (pid {worker.pid}) is serving")
+        elif message.get('event') == 'metrics':
+            worker.metrics = decode_metrics(message)
+            self.rollup_dirty = True
 
-            # Get Razorpay secret
-            razorpay_key_secret = os.getenv('RAZORPAY_KEY_SECRET')
+    def reap(self):
+        """Forget exited workers, and schedule replacements for ones that were not asked to stop"""
+        for worker in [worker for worker in self.processes if worker.process.poll() is not None]:
+            self.processes.remove(worker)
+            while worker.fd is not None and self.read(worker):
+                pass  # its final report may still be in the pipe
+            self.retire_metrics(worker)
+            requeued = JOB_STORE.requeue_running(worker.pid)
+            if requeued:
+                log.info(f"🔁 Re-queued {requeued} job(s) left by worker {worker.slot} (pid {worker.pid})")
+            if self.workers.get(worker.slot) is not worker:
+                continue  # replaced by a reload, or never became current
+            del self.workers[worker.slot]
+            if self.stopping:
+                continue
+            quick = time.monotonic() - worker.started < 5
+            failures = self.failures[worker.slot] = self.failures.get(worker.slot, 0) + 1 if quick else 0
+            delay = min(30, 0.5 * 2 ** failures) if failures else 0
+            log.error(f"💥 Worker {worker.slot} (pid {worker.pid}) exited with {worker.process.returncode}, "
+                      f"restarting in {delay:g}s")
+            METRICS.inc('prefork_worker_restarts_total')
+            self.restart_at[worker.slot] = time.monotonic() + delay
 
-            if not razorpay_key_secret:
-                print("❌ Razorpay secret not found in environment")
-                self.send_json({
-                    'success': False,
-                    'error': 'Payment verification configuration error'
-                }, status=500)
-                return
+    def restart_due(self):
+        now = time.monotonic()
+        for slot, due in list(self.restart_at.items()):
+            if due <= now:
+                del self.restart_at[slot]
+                self.workers[slot] = self.spawn(slot)
 
-            # Verify signature
-            body = f"{data['razorpay_order_id']}|{data['razorpay_payment_id']}"
-            expected_signature = hmac.new(
-                razorpay_key_secret.encode('utf-8'),
-                body.encode('utf-8'),
-                hashlib.sha256
-            ).hexdigest()
+    def retire_metrics(self, worker):
+        """Fold an exited worker's counters and histograms into the carried-forward totals"""
+        if worker.metrics is None:
+            return
+        values, histograms = worker.metrics
+        retired_values, retired_histograms = self.retired
+        for key, value in values.items():
+            if METRICS.meta.get(key[0], ('untyped',))[0] == 'counter':
+                retired_values[key] = retired_values.get(key, 0) + value
+        for key, series in histograms.items():
+            total = retired_histograms.setdefault(key, [0] * len(series))
+            for i, count in enumerate(series):
+                total[i] += count
+        self.rollup_dirty = True
 
-            is_authentic = hmac.compare_digest(expected_signature, data['razorpay_signature'])
+    def rollup(self):
+        """Sum every worker's metrics into one snapshot"""
+        values, histograms = dict(self.retired[0]), {key: list(series) for key, series in self.retired[1].items()}
+        for worker in self.processes:
+            if worker.metrics is None:
+                continue
+            current = self.workers.get(worker.slot) is worker
+            worker_values, worker_histograms = worker.metrics
+            for (name, labels), value in worker_values.items():
+                if name in self.shared_collectors:
+                    continue
+                if METRICS.meta.get(name, ('untyped',))[0] == 'counter':
+                    values[(name, labels)] = values.get((name, labels), 0) + value
+                elif current:  # gauges from a draining worker would clash with its replacement's
+                    values[(name, labels + (('worker', str(worker.slot)),))] = value
+            for key, series in worker_histograms.items():
+                total = histograms.setdefault(key, [0] * len(series))
+                for i, count in enumerate(series):
+                    total[i] += count
+        with METRICS.lock:
+            for (name, labels), value in METRICS.values.items():
+                values[(name, labels)] = values.get((name, labels), 0) + value
+        for collector in self.shared_collectors.values():
+            for name, labels, value in collector():
+                values[(name, tuple(labels.items()))] = value
+        values[('prefork_workers', ())] = sum(worker.ready for worker in self.workers.values())
+        return values, histograms
 
-            if not is_authentic:
-                print("❌ Payment signature verification failed")
-                self.send_json({
-                    'success': False,
-                    'error': 'Payment verification failed - invalid signature'
-                }, status=400)
+    def write_rollup(self):
+        tmp_path = f"{self.rollup_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(encode_metrics(*self.rollup()), f)
+        os.replace(tmp_path, self.rollup_path)
+        self.rollup_dirty = False
+
+    def wait_ready(self, worker):
+        deadline = time.monotonic() + self.ready_timeout
+        while not worker.ready and not self.stopping and time.monotonic() < deadline:
+            if worker.process.poll() is not None and worker.fd is None:
+                return False
+            self.pump(0.1)
+        return worker.ready
+
+    def reload(self):
+        """Replace the workers one at a time, keeping the port served throughout"""
+        log.info(f"🔄 Rolling reload of {len(self.workers)} worker(s)...")
+        for slot in sorted(self.workers):
+            old = self.workers[slot]
+            new = self.spawn(slot)
+            if not self.wait_ready(new):
+                if not self.stopping:
+                    log.error(f"❌ Replacement for worker {slot} did not come up, keeping the old workers")
+                    METRICS.inc('prefork_reloads_total', result='failed')
+                if new.process.poll() is None:
+                    new.process.terminate()
                 return
+            self.workers[slot] = new
+            old.process.terminate()  # SIGTERM: stop accepting and drain
+        METRICS.inc('prefork_reloads_total', result='ok')
+        log.info("✅ Rolling reload complete")
 
-            print("✅ Payment signature verified successfully")
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
 
-            # Payment verified successfully
-            self.send_json({
-                'success': True,
-                'message': 'Payment verified successfully',
-                'planKey': data.get('planKey', 'pro'),
-                'payment_id': data['razorpay_payment_id'],
-                'order_id': data['razorpay_order_id']
-            })
+    def request_reload(self, signum=None, frame=None):
+        self.reload_requested = True
 
-        except json.JSONDecodeError as e:
-            print(f"❌ JSON decode error in payment verification: {e}")
-            self.send_json({
-                'success': False,
-                'error': 'Invalid JSON in request'
-            }, status=400)
-        except Exception as e:
-            print(f"❌ Payment verification error: {e}")
-            self.send_json({
-                'success': False,
-                'error': 'Payment verification failed',
-                'details': str(e)
-            }, status=500)
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.request_reload)
+        # Workers skip the startup re-queue; opening the store here does it once for all of them
+        JOB_STORE.counts()
+        try:
+            for slot in range(self.size):
+                self.workers[slot] = self.spawn(slot)
+            while not self.stopping:
+                if self.reload_requested:
+                    self.reload_requested = False
+                    self.reload()
+                self.pump(0.5)
+                self.reap()
+                self.restart_due()
+                if self.rollup_dirty:
+                    self.write_rollup()
+        finally:
+            log.info(f"👋 Stopping {len(self.processes)} worker(s)...")
+            for worker in self.processes:
+                if worker.process.poll() is None:
+                    worker.process.terminate()
+            deadline = time.monotonic() + self.drain_timeout + 5
+            for worker in self.processes:
+                try:
+                    worker.process.wait(max(0, deadline - time.monotonic()))
+                except subprocess.TimeoutExpired:
+                    log.warning(f"⚠️ Worker {worker.slot} (pid {worker.pid}) did not drain in time, killing it")
+                    worker.process.kill()
+            self.reap()
+            shutil.rmtree(self.rollup_dir, ignore_errors=True)
 
-def run_server():
+
+def run_server(mode=None):
+    mode = mode or os.getenv('SERVER_MODE', 'threaded')
     port = int(os.getenv('PORT', 5000))
     server_address = ('0.0.0.0', port)
+    workers = int(os.getenv('SERVER_WORKERS', 16))
+    queue_size = int(os.getenv('SERVER_QUEUE_SIZE', 64))
+    reserved_workers = int(os.getenv('SERVER_RESERVED_WORKERS', 4))
+    drain_timeout = float(os.getenv('SERVER_DRAIN_TIMEOUT', 30))
+
+    listener = setup_logging()
+    try:
+        if mode == 'prefork':
+            if not hasattr(socket, 'SO_REUSEPORT'):
+                log.error("❌ Prefork mode needs SO_REUSEPORT, which this platform does not have")
+                return
+            engine = os.getenv('PREFORK_ENGINE', 'threaded')
+            if engine not in ('threaded', 'async'):
+                log.error(f"❌ PREFORK_ENGINE must be threaded or async, not {engine!r}")
+                return
+            processes = int(os.getenv('PREFORK_WORKERS') or os.cpu_count() or 1)
+            log_config_status(logging.INFO)
+            log.info(f"🚀 Starting prefork supervisor on port {port} with {processes} {engine} workers...")
+            PreforkSupervisor(processes, engine=engine, drain_timeout=drain_timeout).run()
+            log.info("👋 Server stopped")
+            return
+
+        reuse_port = PREFORK_CHANNEL.active
+        if reuse_port:
+            # The supervisor re-queues interrupted jobs and handles SIGHUP for the group
+            JOB_STORE.requeue_on_open = False
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        else:
+            log_config_status(logging.INFO)
+        RESULT_CACHE.start_autosave(float(os.getenv('AD_CACHE_SAVE_INTERVAL', 30)))
+        if os.getenv('STATIC_PRELOAD', '1') == '1':
+            STATIC_ASSETS.warm()
 
-    print(f"🚀 Starting server on port {port}...")
+        if mode == 'async':
+            log.info(f"🚀 Starting asyncio server on port {port}...")
+            asyncio.run(AsyncAdServer('0.0.0.0', port, bridge_workers=workers, drain_timeout=drain_timeout,
+                                      reuse_port=reuse_port).serve())
+            PREFORK_CHANNEL.finish()
+            RESULT_CACHE.save()
+            log.info("👋 Server stopped")
+            return
 
-    httpd = HTTPServer(server_address, AdGeneratorHandler)
+        log.info(f"🚀 Starting server on port {port} with {workers} workers (queue: {queue_size})...")
 
-    try:
-        httpd.serve_forever()
-    except KeyboardInterrupt:
-        print("\n👋 Server stopped")
+        httpd = ThreadPoolHTTPServer(
+            server_address,
+            AdGeneratorHandler,
+            workers=workers,
+            queue_size=queue_size,
+            reserved_workers=reserved_workers,
+            drain_timeout=drain_timeout,
+            reuse_port=reuse_port
+        )
+
+        JOB_RUNNER.start_thread()
+
+        # serve_forever() has to be stopped from another thread
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=httpd.shutdown).start())
+        # Only report ready once a SIGTERM from the supervisor drains cleanly
+        PREFORK_CHANNEL.ready()
+
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        log.info("👋 Server stopping, draining in-flight requests...")
         httpd.server_close()
+        PREFORK_CHANNEL.finish()
+        RESULT_CACHE.save()
+        log.info("👋 Server stopped")
+    finally:
+        # Flush queued records before the process exits
+        listener.stop()
 
 if __name__ == '__main__':
-    run_server()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Facebook Ad Generator server')
+    parser.add_argument('--mode', choices=['threaded', 'async', 'prefork'],
+                        help='serving engine (default: $SERVER_MODE or threaded)')
+    parser.add_argument('--import-history', metavar='DIR',
+                        help='import user_ads_*.json / user_data_*.json from DIR into $HISTORY_DB and exit')
+    args = parser.parse_args()
+    if args.import_history:
+        ads, users = HISTORY_STORE.import_legacy(args.import_history)
+        print(f"📚 Imported {ads} ads and {users} user records into {HISTORY_STORE.path}")
+    else:
+        run_server(args.mode)
@@ -0,0 +1,46 @@
+"""Shared fixtures: bench.py's mock upstream and a server.py subprocess pointed at it"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bench  # noqa: E402
+
+MOCK_SETTINGS = {
+    'copy_latency': 20, 'image_latency': 20, 'order_latency': 20, 'jitter': 0,
+    'error_rate': 0.0, 'stream_tokens': 5, 'token_delay': 5, 'image_chunk_delay': 0,
+}
+
+
+@pytest.fixture
+def mock_upstream():
+    mock = bench.start_mock(dict(MOCK_SETTINGS))
+    yield mock
+    mock.shutdown()
+    mock.server_close()
+
+
+@pytest.fixture
+def run_server(mock_upstream, tmp_path):
+    """Start server.py in a mode with extra env vars; returns (process, port) and stops it afterwards"""
+    processes = []
+
+    def start(mode='threaded', **env):
+        port = bench.free_port()
+        process = bench.start_server(mode, port, f'http://127.0.0.1:{mock_upstream.server_port}', str(tmp_path),
+                                     {name: str(value) for name, value in env.items()})
+        processes.append(process)
+        return process, port
+
+    yield start
+    for process in processes:
+        if process.poll() is None:
+            process.terminate()
+            try:
+                process.wait(15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
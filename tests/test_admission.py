@@ -0,0 +1,194 @@
+"""AdmissionGate, CircuitBreaker and LatencyTracker: how a provider client sheds load before calling out"""
+import asyncio
+import http.client
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import server
+
+
+def rejection(call):
+    with pytest.raises(server.UpstreamRejected) as info:
+        call()
+    return info.value
+
+
+def test_full_queue_is_turned_away_with_429():
+    gate = server.AdmissionGate('test', limit=1, max_waiting=0, queue_timeout=5)
+    gate.acquire()
+    started = time.monotonic()
+    error = rejection(gate.acquire)
+    assert time.monotonic() - started < 0.5
+    assert (error.status, error.reason, error.retry_after) == (429, 'queue_full', 5)
+    assert gate.state() == {'active': 1, 'waiting': 0, 'limit': 1, 'max_waiting': 0}
+
+
+def test_queue_timeout_gives_503():
+    gate = server.AdmissionGate('test', limit=1, max_waiting=1, queue_timeout=0.2)
+    gate.acquire()
+    started = time.monotonic()
+    error = rejection(gate.acquire)
+    assert time.monotonic() - started >= 0.2
+    assert (error.status, error.reason) == (503, 'queue_timeout')
+    assert gate.state()['waiting'] == 0
+
+
+def test_waiting_thread_takes_the_released_slot():
+    gate = server.AdmissionGate('test', limit=1, max_waiting=1, queue_timeout=5)
+    gate.acquire()
+    with ThreadPoolExecutor(1) as pool:
+        waiter = pool.submit(gate.acquire)
+        time.sleep(0.1)
+        assert gate.state()['waiting'] == 1
+        gate.release()
+        waiter.result(1)
+    assert gate.state()['active'] == 1
+
+
+def test_async_queue_full_and_timeout():
+    async def scenario():
+        gate = server.AdmissionGate('test', limit=1, max_waiting=1, queue_timeout=0.2)
+        await gate.acquire_async()
+        waiting = asyncio.create_task(gate.acquire_async())
+        await asyncio.sleep(0.05)
+        try:
+            await gate.acquire_async()
+        except server.UpstreamRejected as e:
+            full = e.status
+        try:
+            await waiting
+        except server.UpstreamRejected as e:
+            timed_out = e.status
+        return full, timed_out, gate.state()['waiting']
+
+    assert asyncio.run(scenario()) == (429, 503, 0)
+
+
+def test_async_waiter_is_woken_by_a_release_from_another_thread():
+    gate = server.AdmissionGate('test', limit=1, max_waiting=1, queue_timeout=5)
+    gate.acquire()  # held by a worker thread, as when both engines share a client
+
+    async def scenario():
+        threading.Timer(0.1, gate.release).start()
+        started = time.monotonic()
+        await gate.acquire_async()
+        return time.monotonic() - started
+
+    assert asyncio.run(scenario()) < 1
+    assert gate.state() == {'active': 1, 'waiting': 0, 'limit': 1, 'max_waiting': 1}
+
+
+def test_cancelled_async_waiter_passes_its_wakeup_on():
+    async def scenario():
+        gate = server.AdmissionGate('test', limit=1, max_waiting=2, queue_timeout=5)
+        await gate.acquire_async()
+        first = asyncio.create_task(gate.acquire_async())
+        second = asyncio.create_task(gate.acquire_async())
+        await asyncio.sleep(0.05)
+        # The first waiter is cancelled just as the release picks it to wake
+        first.cancel()
+        gate.release()
+        await asyncio.wait_for(second, 1)
+        return first.cancelled(), gate.state()['active']
+
+    assert asyncio.run(scenario()) == (True, 1)
+
+
+def breaker(**settings):
+    settings = {'failure_rate': 0.5, 'slow_call': 1, 'window': 4, 'min_calls': 4, 'cooldown': 0.2, **settings}
+    return server.CircuitBreaker('test', **settings)
+
+
+def test_breaker_opens_once_enough_calls_fail():
+    circuit = breaker()
+    for ok in (True, False, True):
+        circuit.before_call()
+        circuit.record(ok, 0.1)
+    assert circuit.state()['state'] == 'closed'
+    circuit.before_call()
+    circuit.record(True, 2)  # slower than slow_call counts as a failure
+    assert circuit.state()['state'] == 'open'
+    error = rejection(circuit.before_call)
+    assert (error.status, error.reason) == (503, 'circuit open')
+
+
+def test_breaker_probes_after_the_cooldown_and_closes_on_success():
+    circuit = breaker(min_calls=1)
+    circuit.record(False, 0.1)
+    assert circuit.state()['state'] == 'open'
+    time.sleep(0.25)
+    circuit.before_call()
+    assert circuit.state()['state'] == 'half_open'
+    rejection(circuit.before_call)  # only one probe at a time
+    circuit.record(True, 0.1)
+    assert circuit.state() == {'state': 'closed', 'recent_calls': 0, 'recent_failures': 0}
+    circuit.before_call()
+
+
+def test_failed_probe_opens_the_breaker_again():
+    circuit = breaker(min_calls=1)
+    circuit.record(False, 0.1)
+    time.sleep(0.25)
+    circuit.before_call()
+    circuit.record(False, 0.1)
+    assert circuit.state()['state'] == 'open'
+    rejection(circuit.before_call)
+
+
+def test_abandoned_probe_lets_another_one_through():
+    circuit = breaker(min_calls=1)
+    circuit.record(False, 0.1)
+    time.sleep(0.25)
+    circuit.before_call()
+    circuit.abandon()
+    circuit.before_call()
+    assert circuit.state()['state'] == 'half_open'
+
+
+def test_latency_tracker_uses_the_ceiling_until_it_has_samples():
+    tracker = server.LatencyTracker(30, floor=5, multiplier=3, min_samples=20)
+    for _ in range(19):
+        tracker.observe(1)
+    assert tracker.timeout() == 30
+    tracker.observe(1)
+    assert tracker.timeout() == 5  # 3 x 1s, raised to the floor
+
+
+def test_latency_tracker_follows_the_p99():
+    tracker = server.LatencyTracker(30, floor=1, multiplier=3, min_samples=20)
+    for _ in range(99):
+        tracker.observe(2)
+    tracker.observe(4)
+    assert tracker.timeout() == 12
+    for _ in range(100):
+        tracker.observe(20)
+    assert tracker.timeout() == 30  # capped at the configured timeout
+
+
+@pytest.mark.parametrize('engine', ['threaded', 'async'])
+def test_saturated_provider_answers_429_with_retry_after(run_server, mock_upstream, engine):
+    mock_upstream.settings['copy_latency'] = 1000
+    _, port = run_server(engine, DEEPSEEK_MAX_CONCURRENCY=1, DEEPSEEK_ASYNC_MAX_CONCURRENCY=1,
+                         DEEPSEEK_MAX_WAITING=0, DEEPSEEK_QUEUE_TIMEOUT=2)
+
+    def generate(name):
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        try:
+            connection.request('POST', '/generate-ad', json.dumps({'productName': name}),
+                               {'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            return response.status, response.getheader('Retry-After'), json.loads(response.read())
+        finally:
+            connection.close()
+
+    with ThreadPoolExecutor(2) as pool:
+        first = pool.submit(generate, f'Admitted {engine}')
+        time.sleep(0.3)
+        status, retry_after, body = generate(f'Turned away {engine}')
+        assert first.result()[0] == 200
+    assert (status, retry_after) == (429, '2')
+    assert body['success'] is False
@@ -0,0 +1,69 @@
+"""/generate-ad runs copy and image side by side, and stops the image work once it is not wanted"""
+import http.client
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import server
+
+
+def generate(port, body):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        connection.request('POST', '/generate-ad', json.dumps(body), {'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+
+def stored_images(root):
+    return [name for _, _, names in os.walk(root) for name in names if name.endswith('.jpg')]
+
+
+@pytest.mark.parametrize('engine', ['threaded', 'async'])
+def test_generation_returns_copy_and_stored_image(run_server, tmp_path, engine):
+    _, port = run_server(engine)
+    status, result = generate(port, {'productName': f'Copy and image {engine}', 'productDescription': 'Test'})
+    assert status == 200
+    assert result['success'] is True
+    assert result['image_url'].startswith('/images/')
+    assert len(stored_images(tmp_path / 'images')) == 1
+
+
+@pytest.mark.parametrize('engine', ['threaded', 'async'])
+def test_failed_copy_stops_the_image_download(run_server, mock_upstream, tmp_path, engine):
+    # The copy call times out after 0.5s, while the image download is still trickling in for 3s more
+    mock_upstream.settings.update(copy_latency=3000, image_chunk_delay=200)
+    _, port = run_server(engine, DEEPSEEK_TIMEOUT=0.5, DEEPSEEK_MIN_TIMEOUT=0.5, DEEPSEEK_RETRIES=0)
+    status, result = generate(port, {'productName': f'No copy {engine}', 'productDescription': 'Test'})
+    assert status == 500
+    assert result['error'] == 'Failed to generate ad copy'
+    time.sleep(4)
+    assert stored_images(tmp_path / 'images') == []
+
+
+def test_cancelled_download_stops_between_chunks(mock_upstream, tmp_path):
+    mock_upstream.settings['image_chunk_delay'] = 100
+    store = server.ImageStore(str(tmp_path / 'images'))
+    cancel = threading.Event()
+    threading.Timer(0.3, cancel.set).start()
+    started = time.monotonic()
+    with pytest.raises(ValueError, match='cancelled'):
+        store.store_remote(f'http://127.0.0.1:{mock_upstream.server_port}/img/cancelled.jpg', cancel=cancel)
+    assert time.monotonic() - started < 1
+    assert stored_images(tmp_path / 'images') == []
+
+
+def test_cancelled_request_skips_the_image_call(monkeypatch):
+    calls = []
+    monkeypatch.setenv('DEEPAI_API_KEY', 'test')
+    monkeypatch.setattr(server.DEEPAI, 'post', lambda *args, **kwargs: calls.append(args))
+    cancel = threading.Event()
+    cancel.set()
+    handler = server.AdGeneratorHandler.__new__(server.AdGeneratorHandler)
+    assert handler.fetch_image({'productName': 'Not wanted'}, cancel) is None
+    assert calls == []
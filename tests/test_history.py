@@ -0,0 +1,135 @@
+"""HistoryStore and /api/history: per-user ad history behind a verified sign-in, paged with a keyset cursor"""
+import http.client
+import json
+from urllib.parse import urlencode
+
+import pytest
+
+import bench
+import server
+
+
+def ad(user_id, ad_id, timestamp, ad_format='facebook', language='English'):
+    return {'id': ad_id, 'userId': user_id, 'timestamp': timestamp, 'textContent': f'Copy {ad_id}',
+            'formData': {'productName': f'Product {ad_id}', 'adFormat': ad_format, 'language': language}}
+
+
+@pytest.fixture
+def history(tmp_path):
+    return server.HistoryStore(str(tmp_path / 'history.db'))
+
+
+def all_pages(history, user_id, limit, **filters):
+    ids, cursor = [], None
+    while True:
+        ads, cursor = history.list(user_id, limit, cursor, **filters)
+        ids.append([entry['id'] for entry in ads])
+        if cursor is None:
+            return ids
+
+
+def test_cursor_walks_every_ad_once_newest_first(history):
+    for n in range(5):
+        history.append(ad('alice', f'a{n}', 1700000000000 + n * 1000))
+    # Two ads saved in the same millisecond are ordered by insertion
+    history.append(ad('alice', 'a5', 1700000004000))
+    history.append(ad('bob', 'b0', 1700000009000))
+    assert all_pages(history, 'alice', 2) == [['a5', 'a4'], ['a3', 'a2'], ['a1', 'a0']]
+    assert all_pages(history, 'alice', 4) == [['a5', 'a4', 'a3', 'a2'], ['a1', 'a0']]
+    assert all_pages(history, 'carol', 2) == [[]]
+
+
+def test_ads_appended_while_paging_do_not_shift_later_pages(history):
+    for n in range(4):
+        history.append(ad('alice', f'a{n}', 1700000000000 + n * 1000))
+    first, cursor = history.list('alice', 2)
+    history.append(ad('alice', 'newer', 1700000009000))
+    second, cursor = history.list('alice', 2, cursor)
+    assert [entry['id'] for entry in first + second] == ['a3', 'a2', 'a1', 'a0']
+    assert cursor is None
+
+
+def test_filters(history):
+    history.append(ad('alice', 'fb', '2024-01-01T00:00:00.000Z'))
+    history.append(ad('alice', 'ig', '2024-02-01T00:00:00.000Z', ad_format='instagram'))
+    history.append(ad('alice', 'es', '2024-03-01T00:00:00.000Z', language='Spanish'))
+    assert all_pages(history, 'alice', 10, ad_format='instagram') == [['ig']]
+    assert all_pages(history, 'alice', 10, language='Spanish') == [['es']]
+    since = server.parse_timestamp_ms('2024-01-15T00:00:00Z')
+    until = server.parse_timestamp_ms('2024-03-01T00:00:00Z')
+    assert all_pages(history, 'alice', 10, since=since, until=until) == [['ig']]
+
+
+def test_same_ad_is_stored_once(history):
+    saved = history.append(ad('alice', 'a0', '2024-01-01T00:00:00.000Z'))
+    history.append(ad('alice', 'a0', '2024-01-01T00:00:00.000Z'))
+    ads, _ = history.list('alice')
+    assert ads == [saved]
+    assert saved['timestamp'] == '2024-01-01T00:00:00.000Z'
+    assert saved['textContent'] == 'Copy a0'
+
+
+def test_import_legacy_files_once(history, tmp_path):
+    public = tmp_path / 'public'
+    public.mkdir()
+    (public / 'user_ads_alice.json').write_text(json.dumps([
+        {'id': 'a0', 'timestamp': '2024-01-01T00:00:00.000Z', 'formData': {}, 'adCopy': 'Old copy'},
+        'not an ad',
+    ]))
+    (public / 'user_data_alice.json').write_text(json.dumps({'uid': 'alice', 'plan': 'free'}))
+    (public / 'index.html').write_text('<h1>Ad generator</h1>')
+    assert history.import_legacy(str(public)) == (1, 1)
+    history.import_legacy(str(public))
+    ads, _ = history.list('alice')
+    assert [(entry['id'], entry['userId'], entry['textContent']) for entry in ads] == [('a0', 'alice', 'Old copy')]
+
+
+def request(port, method, path, token=None, body=None):
+    headers = {'Content-Type': 'application/json'}
+    if token:
+        headers['Authorization'] = f'Bearer {token}'
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        connection.request(method, path, json.dumps(body) if body is not None else None, headers)
+        response = connection.getresponse()
+        return response.status, response.getheader('WWW-Authenticate'), json.loads(response.read())
+    finally:
+        connection.close()
+
+
+@pytest.mark.parametrize('engine', ['threaded', 'async'])
+def test_history_needs_a_verified_sign_in(run_server, engine):
+    _, port = run_server(engine)
+    alice = bench.mock_id_token('alice')
+    assert request(port, 'GET', '/api/history')[:2] == (401, 'Bearer')
+    assert request(port, 'GET', '/api/history', bench.mock_id_token('alice', valid=False))[0] == 401
+    assert request(port, 'GET', '/api/history', bench.mock_id_token('alice', expires_in=-60))[0] == 401
+    assert request(port, 'POST', '/api/history', body=ad('alice', 'a0', 1700000000000))[0] == 401
+
+    # A token only reaches its own user's history, whatever the request names
+    assert request(port, 'GET', '/api/history?userId=bob', alice)[0] == 403
+    assert request(port, 'POST', '/api/history', alice, ad('bob', 'b0', 1700000000000))[0] == 403
+    unnamed = ad('alice', 'a0', 1700000000000)
+    del unnamed['userId']
+    status, _, saved = request(port, 'POST', '/api/history', alice, unnamed)
+    assert (status, saved['ad']['userId']) == (201, 'alice')
+    assert request(port, 'GET', '/api/history', bench.mock_id_token('bob'))[2]['ads'] == []
+
+
+@pytest.mark.parametrize('engine', ['threaded', 'async'])
+def test_history_pages_with_a_cursor(run_server, engine):
+    _, port = run_server(engine)
+    token = bench.mock_id_token('alice')
+    for n in range(5):
+        assert request(port, 'POST', '/api/history', token, ad('alice', f'a{n}', 1700000000000 + n))[0] == 201
+
+    pages, query = [], {'limit': 2}
+    while True:
+        status, _, page = request(port, 'GET', '/api/history?' + urlencode(query), token)
+        assert status == 200
+        pages.append([entry['id'] for entry in page['ads']])
+        if page['nextCursor'] is None:
+            break
+        query['cursor'] = page['nextCursor']
+    assert pages == [['a4', 'a3'], ['a2', 'a1'], ['a0']]
+    assert request(port, 'GET', '/api/history?since=not-a-date', token)[0] == 400
@@ -0,0 +1,135 @@
+"""ImageStore: content-addressed image storage behind /images/, fed from the bench.py mock image route"""
+import http.client
+import json
+import os
+import time
+
+import pytest
+
+import bench
+import server
+
+from conftest import MOCK_SETTINGS
+
+IMAGE_BYTES = 4 + 32 * 2048  # what the mock sends for every /img/ path
+
+
+@pytest.fixture
+def store(tmp_path):
+    return server.ImageStore(str(tmp_path / 'images'))
+
+
+def image_url(mock, name):
+    return f'http://127.0.0.1:{mock.server_port}/img/{name}.jpg'
+
+
+def stored_files(store):
+    return sorted(name for _, _, names in os.walk(store.root) for name in names if name.endswith('.jpg'))
+
+
+def test_identical_images_share_one_file(store, mock_upstream):
+    # The mock's bytes depend only on the path, so a second mock serves the same picture from another URL
+    other = bench.start_mock(dict(MOCK_SETTINGS))
+    try:
+        first = store.store_remote(image_url(mock_upstream, 'same'))
+        second = store.store_remote(image_url(other, 'same'))
+    finally:
+        other.shutdown()
+        other.server_close()
+    different = store.store_remote(image_url(mock_upstream, 'different'))
+    assert first == second != different
+    assert first.startswith('/images/') and first.endswith('.jpg')
+    assert stored_files(store) == sorted([first[len('/images/'):], different[len('/images/'):]])
+
+
+def test_stored_image_is_served_with_its_etag(store, mock_upstream):
+    url = store.store_remote(image_url(mock_upstream, 'served'))
+    status, headers, f = store.respond(url, {})
+    with f:
+        assert status == 200
+        assert len(f.read()) == IMAGE_BYTES
+    headers = dict(headers)
+    assert headers['Content-Type'] == 'image/jpeg'
+    assert headers['Cache-Control'] == server.ImageStore.CACHE_CONTROL
+    assert headers['ETag'] == f'"{url[len("/images/"):]}"'
+
+    for if_none_match in (headers['ETag'], f'"other", W/{headers["ETag"]}'):
+        status, headers_304, body = store.respond(url, {'If-None-Match': if_none_match})
+        assert (status, body) == (304, None)
+        assert dict(headers_304)['ETag'] == headers['ETag']
+
+
+def test_unknown_names_are_not_found(store):
+    assert store.respond('/images/' + 'a' * 64 + '.jpg', {})[0] == 404
+    assert store.respond('/images/../index.db', {})[0] == 404
+    assert store.respond('/images/not-a-digest.jpg', {})[0] == 404
+
+
+def test_evicted_image_redirects_to_its_source(tmp_path, mock_upstream):
+    store = server.ImageStore(str(tmp_path / 'images'), max_bytes=IMAGE_BYTES + IMAGE_BYTES // 2)
+    old_source = image_url(mock_upstream, 'old')
+    old = store.store_remote(old_source)
+    new = store.store_remote(image_url(mock_upstream, 'new'))
+
+    assert stored_files(store) == [new[len('/images/'):]]
+    status, headers, body = store.respond(old, {})
+    assert (status, body) == (302, None)
+    assert dict(headers)['Location'] == old_source
+    status, _, f = store.respond(new, {})
+    f.close()
+    assert status == 200
+
+
+def test_budget_is_shared_between_store_instances(tmp_path, mock_upstream):
+    # Prefork workers each have their own ImageStore over the same directory
+    root = str(tmp_path / 'images')
+    first = server.ImageStore(root, max_bytes=IMAGE_BYTES + IMAGE_BYTES // 2)
+    second = server.ImageStore(root, max_bytes=IMAGE_BYTES + IMAGE_BYTES // 2)
+    old = first.store_remote(image_url(mock_upstream, 'worker-one'))
+    second.store_remote(image_url(mock_upstream, 'worker-two'))
+    assert len(stored_files(first)) == 1
+    assert first.respond(old, {})[0] == 302
+
+
+def test_download_is_bounded_by_the_deadline(store, mock_upstream):
+    # About 1.6s of trickling image, against a 0.5s deadline
+    mock_upstream.settings['image_chunk_delay'] = 100
+    source = image_url(mock_upstream, 'slow')
+    started = time.monotonic()
+    with pytest.raises(ValueError, match='deadline'):
+        store.store_remote(source, deadline=time.monotonic() + 0.5)
+    assert time.monotonic() - started < 1
+    assert stored_files(store) == []
+    # Generation keeps DeepAI's own URL instead
+    assert store.localize(source, deadline=time.monotonic() + 0.5) == source
+
+
+def test_failed_download_keeps_the_remote_url(store, mock_upstream):
+    missing = f'http://127.0.0.1:{mock_upstream.server_port}/missing.jpg'
+    assert store.localize(missing) == missing
+    assert stored_files(store) == []
+
+
+@pytest.mark.parametrize('engine', ['threaded', 'async'])
+def test_generated_image_is_served_with_conditional_requests(run_server, engine):
+    _, port = run_server(engine)
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        connection.request('POST', '/generate-ad', json.dumps({'productName': f'Served image {engine}'}),
+                           {'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        url = json.loads(response.read())['image_url']
+        assert url.startswith('/images/')
+
+        connection.request('GET', url)
+        response = connection.getresponse()
+        assert response.status == 200
+        assert len(response.read()) == IMAGE_BYTES
+        etag = response.getheader('ETag')
+
+        connection.request('GET', url, headers={'If-None-Match': etag})
+        response = connection.getresponse()
+        response.read()
+        assert response.status == 304
+    finally:
+        connection.close()
@@ -0,0 +1,81 @@
+"""Background job queue priority comes from a verified sign-in and a verified payment, never the request body"""
+import hashlib
+import hmac
+import http.client
+import json
+import sqlite3
+
+import bench
+
+
+def post(port, path, body, headers=None):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        connection.request('POST', path, json.dumps(body),
+                           dict({'Content-Type': 'application/json'}, **(headers or {})))
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+
+def pay(port, user_id, plan):
+    """Create and verify an order for ``user_id`` the way the checkout does"""
+    status, order = post(port, '/api/create-razorpay-order', {'amount': 49900, 'planKey': plan, 'userId': user_id})
+    assert status == 200
+    payment_id = f'pay_{user_id}'
+    signature = hmac.new(bench.BENCH_RAZORPAY_SECRET.encode('utf-8'),
+                         f"{order['orderId']}|{payment_id}".encode('utf-8'), hashlib.sha256).hexdigest()
+    # The plan named here is ignored in favour of the order's
+    status, _ = post(port, '/api/verify-payment', {
+        'razorpay_order_id': order['orderId'], 'razorpay_payment_id': payment_id,
+        'razorpay_signature': signature, 'planKey': 'unlimited'
+    })
+    assert status == 200
+
+
+def job_priority(tmp_path, job_id):
+    with sqlite3.connect(tmp_path / 'jobs.db') as db:
+        return db.execute('SELECT priority FROM jobs WHERE id = ?', (job_id,)).fetchone()[0]
+
+
+def submit(port, token=None, **body):
+    headers = {'Authorization': f'Bearer {token}'} if token else {}
+    return post(port, '/api/jobs', dict({'productName': 'Queued product'}, **body), headers)
+
+
+def test_self_declared_plan_gets_no_priority(run_server, tmp_path):
+    _, port = run_server()
+    status, job = submit(port, subscriptionStatus='pro')
+    assert status == 202
+    assert job_priority(tmp_path, job['jobId']) == 1
+
+
+def test_verified_subscriber_runs_first(run_server, tmp_path):
+    _, port = run_server()
+    pay(port, 'payer', 'pro')
+    status, job = submit(port, bench.mock_id_token('payer'))
+    assert status == 202
+    assert job_priority(tmp_path, job['jobId']) == 0
+
+
+def test_signed_in_user_without_payment_gets_no_priority(run_server, tmp_path):
+    _, port = run_server()
+    pay(port, 'payer', 'pro')
+    status, job = submit(port, bench.mock_id_token('someone-else'), subscriptionStatus='pro')
+    assert status == 202
+    assert job_priority(tmp_path, job['jobId']) == 1
+
+
+def test_plan_comes_from_the_order(run_server, tmp_path):
+    _, port = run_server()
+    pay(port, 'basic-payer', 'starter')
+    status, job = submit(port, bench.mock_id_token('basic-payer'))
+    assert status == 202
+    assert job_priority(tmp_path, job['jobId']) == 1
+
+
+def test_invalid_token_is_rejected(run_server):
+    _, port = run_server()
+    status, _ = submit(port, bench.mock_id_token('payer', valid=False))
+    assert status == 401
@@ -0,0 +1,157 @@
+"""HTTP/1.1 keep-alive framing in both serving engines"""
+import json
+import socket
+import time
+
+import pytest
+
+ENGINES = ['threaded', 'async']
+
+
+def connect(port):
+    sock = socket.create_connection(('127.0.0.1', port), timeout=10)
+    return sock, sock.makefile('rb')
+
+
+def read_response(rfile):
+    """Read one response off a kept-alive connection; returns (status, lower-cased headers, body)"""
+    status_line = rfile.readline()
+    assert status_line, "connection closed before a response"
+    headers = {}
+    while True:
+        line = rfile.readline().decode('latin-1')
+        if line in ('\r\n', '\n', ''):
+            break
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    body = rfile.read(int(headers.get('content-length', 0)))
+    return int(status_line.split()[1]), headers, body
+
+
+def get(path, version='HTTP/1.1'):
+    return f'GET {path} {version}\r\nHost: test\r\n\r\n'.encode('latin-1')
+
+
+def post(path, body, content_length=None):
+    payload = json.dumps(body).encode('utf-8')
+    head = (f'POST {path} HTTP/1.1\r\nHost: test\r\nContent-Type: application/json\r\n'
+            f'Content-Length: {content_length if content_length is not None else len(payload)}\r\n\r\n')
+    return head.encode('latin-1') + payload
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_sequential_requests_share_a_connection(run_server, engine):
+    _, port = run_server(engine)
+    sock, rfile = connect(port)
+    with sock:
+        for _ in range(3):
+            sock.sendall(get('/robots.txt'))
+            status, headers, body = read_response(rfile)
+            assert status == 200
+            assert headers.get('connection', '').lower() != 'close'
+            assert b'User-agent' in body
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_pipelined_requests_are_answered_in_order(run_server, engine):
+    _, port = run_server(engine)
+    sock, rfile = connect(port)
+    with sock:
+        sock.sendall(get('/robots.txt') + get('/config.js') + get('/robots.txt'))
+        answers = [read_response(rfile) for _ in range(3)]
+    assert [status for status, _, _ in answers] == [200, 200, 200]
+    assert b'User-agent' in answers[0][2]
+    assert 'javascript' in answers[1][1]['content-type']
+    assert answers[2][2] == answers[0][2]
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_post_body_is_consumed_before_the_next_request(run_server, engine):
+    _, port = run_server(engine)
+    sock, rfile = connect(port)
+    with sock:
+        sock.sendall(post('/api/create-razorpay-order', {'amount': 49900, 'planKey': 'pro', 'userId': 'framing'})
+                     + get('/robots.txt'))
+        status, _, body = read_response(rfile)
+        assert status == 200
+        assert json.loads(body)['success'] is True
+        status, _, body = read_response(rfile)
+        assert status == 200
+        assert b'User-agent' in body
+
+
+def test_malformed_content_length_is_rejected(run_server):
+    _, port = run_server('async')
+    sock, rfile = connect(port)
+    with sock:
+        sock.sendall(post('/generate-ad', {}, content_length='12abc'))
+        status, _, _ = read_response(rfile)
+    assert status == 400
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_http10_connection_is_closed_after_the_response(run_server, engine):
+    _, port = run_server(engine)
+    sock, rfile = connect(port)
+    with sock:
+        sock.sendall(get('/robots.txt', 'HTTP/1.0'))
+        status, _, _ = read_response(rfile)
+        assert status == 200
+        assert rfile.read() == b''
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_idle_connection_is_closed_after_keepalive_timeout(run_server, engine):
+    _, port = run_server(engine, KEEPALIVE_TIMEOUT=0.5)
+    sock, rfile = connect(port)
+    with sock:
+        sock.sendall(get('/robots.txt'))
+        assert read_response(rfile)[0] == 200
+        started = time.monotonic()
+        assert rfile.read() == b''
+    assert time.monotonic() - started < 3
+
+
+def test_idle_connections_give_up_their_thread_to_queued_ones(run_server):
+    _, port = run_server('threaded', SERVER_WORKERS=2, KEEPALIVE_TIMEOUT=5)
+    idle = [connect(port) for _ in range(2)]
+    try:
+        for sock, rfile in idle:
+            sock.sendall(get('/robots.txt'))
+            assert read_response(rfile)[0] == 200
+        started = time.monotonic()
+        sock, rfile = connect(port)
+        with sock:
+            sock.sendall(get('/robots.txt'))
+            assert read_response(rfile)[0] == 200
+        assert time.monotonic() - started < 2
+    finally:
+        for sock, _ in idle:
+            sock.close()
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_stalled_request_is_dropped(run_server, engine):
+    _, port = run_server(engine, REQUEST_TIMEOUT=1)
+    sock, rfile = connect(port)
+    with sock:
+        sock.sendall(b'GET /robots.txt HTTP/1.1\r\n')
+        started = time.monotonic()
+        rfile.read()
+    assert time.monotonic() - started < 3
+
+
+def test_stalled_clients_do_not_hold_every_thread(run_server):
+    _, port = run_server('threaded', SERVER_WORKERS=2, REQUEST_TIMEOUT=1)
+    stalled = [connect(port) for _ in range(2)]
+    try:
+        for sock, _ in stalled:
+            sock.sendall(b'GET /robots.txt HTTP/1.1\r\n')
+        time.sleep(0.2)
+        sock, rfile = connect(port)
+        with sock:
+            sock.sendall(get('/robots.txt'))
+            assert read_response(rfile)[0] == 200
+    finally:
+        for sock, _ in stalled:
+            sock.close()
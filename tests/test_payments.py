@@ -0,0 +1,54 @@
+"""Razorpay order idempotency: repeats of one purchase share an order, across worker processes too"""
+import http.client
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+ORDER = {'amount': 49900, 'currency': 'INR', 'planKey': 'pro'}
+
+
+def create_order(port, body, headers=None):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        connection.request('POST', '/api/create-razorpay-order', json.dumps(body),
+                           dict({'Content-Type': 'application/json'}, **(headers or {})))
+        response = connection.getresponse()
+        result = json.loads(response.read())
+        assert response.status == 200, result
+        return result['orderId']
+    finally:
+        connection.close()
+
+
+def create_concurrently(port, bodies, headers=None):
+    with ThreadPoolExecutor(len(bodies)) as pool:
+        return list(pool.map(lambda body: create_order(port, body, headers), bodies))
+
+
+@pytest.mark.parametrize('mode, env', [
+    ('threaded', {}),
+    ('async', {}),
+    ('prefork', {'PREFORK_WORKERS': 2}),
+])
+def test_concurrent_repeats_share_one_order(run_server, mock_upstream, mode, env):
+    mock_upstream.settings['order_latency'] = 300
+    _, port = run_server(mode, **env)
+    order_ids = create_concurrently(port, [dict(ORDER, userId='buyer')] * 8)
+    assert len(set(order_ids)) == 1
+    # Later repeats inside the window get the stored order back
+    assert create_order(port, dict(ORDER, userId='buyer')) == order_ids[0]
+
+
+def test_client_keys_tell_purchases_apart(run_server):
+    _, port = run_server()
+    first = create_order(port, dict(ORDER, userId='buyer'), {'Idempotency-Key': 'cart-1'})
+    second = create_order(port, dict(ORDER, userId='buyer'), {'Idempotency-Key': 'cart-2'})
+    assert first != second
+    assert create_order(port, dict(ORDER, userId='buyer'), {'Idempotency-Key': 'cart-1'}) == first
+
+
+def test_anonymous_orders_are_not_merged(run_server):
+    _, port = run_server()
+    order_ids = create_concurrently(port, [ORDER] * 4)
+    assert len(set(order_ids)) == 4
@@ -0,0 +1,80 @@
+"""Prefork supervisor: workers share the port, reload one at a time and drain on SIGTERM"""
+import http.client
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+ENGINES = ['threaded', 'async']
+
+
+def workers(process):
+    with open(f'/proc/{process.pid}/task/{process.pid}/children') as children:
+        return {int(pid) for pid in children.read().split()}
+
+
+def wait_for(condition, timeout=20):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def fetch(port, path='/robots.txt'):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally:
+        connection.close()
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_workers_serve_and_stop_on_sigterm(run_server, engine):
+    process, port = run_server('prefork', PREFORK_WORKERS=2, PREFORK_ENGINE=engine)
+    assert wait_for(lambda: len(workers(process)) == 2)
+    started = workers(process)
+    assert all(fetch(port) == 200 for _ in range(10))
+
+    process.send_signal(signal.SIGTERM)
+    process.wait(20)
+    assert not any(os.path.exists(f'/proc/{pid}') for pid in started)
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_reload_replaces_workers_without_dropping_requests(run_server, engine):
+    process, port = run_server('prefork', PREFORK_WORKERS=2, PREFORK_ENGINE=engine)
+    assert wait_for(lambda: len(workers(process)) == 2)
+    original = workers(process)
+
+    statuses, failures = [], []
+    stop = threading.Event()
+
+    def hammer():
+        while not stop.is_set():
+            try:
+                statuses.append(fetch(port))
+            except OSError as e:
+                failures.append(e)
+
+    clients = [threading.Thread(target=hammer) for _ in range(4)]
+    for client in clients:
+        client.start()
+    try:
+        process.send_signal(signal.SIGHUP)
+        assert wait_for(lambda: len(workers(process)) == 2 and not workers(process) & original)
+        time.sleep(0.5)
+    finally:
+        stop.set()
+        for client in clients:
+            client.join()
+
+    assert failures == []
+    assert statuses and set(statuses) == {200}
+    assert process.poll() is None
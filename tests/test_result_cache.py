@@ -0,0 +1,117 @@
+"""ResultCache: repeated generation requests are answered from cache unless the client asks for a new variation"""
+import asyncio
+import http.client
+import json
+import time
+
+import pytest
+
+import server
+
+
+def test_repeat_is_a_hit():
+    cache, calls = server.ResultCache(), []
+
+    def compute():
+        calls.append(1)
+        return 'copy'
+
+    assert cache.get_or_compute('key', compute) == 'copy'
+    assert cache.get_or_compute('key', compute) == 'copy'
+    assert calls == [1]
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+
+def test_bypass_recomputes_and_refreshes_the_entry():
+    cache = server.ResultCache()
+    cache.put('key', 'old copy')
+    assert cache.get_or_compute('key', lambda: 'new copy', bypass=True) == 'new copy'
+    assert cache.stats()['hits'] == 0
+    assert cache.get('key') == 'new copy'
+
+
+def test_failed_results_are_not_cached():
+    cache = server.ResultCache()
+    assert cache.get_or_compute('key', lambda: None) is None
+    assert cache.get_or_compute('key', lambda: 'copy') == 'copy'
+
+
+def test_async_repeat_is_a_hit():
+    cache, calls = server.ResultCache(), []
+
+    async def compute():
+        calls.append(1)
+        return 'image'
+
+    async def scenario():
+        return [await cache.get_or_compute_async('key', compute, bypass=bypass) for bypass in (False, False, True)]
+
+    assert asyncio.run(scenario()) == ['image'] * 3
+    assert calls == [1, 1]
+
+
+def test_entries_expire_and_least_recently_used_go_first():
+    cache = server.ResultCache(max_entries=2, ttl=0.1)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == (1, None, 3)
+    assert cache.stats()['evictions'] == 1
+    time.sleep(0.15)
+    assert cache.get('a') is None
+
+
+def test_saved_cache_is_reloaded_without_expired_entries(tmp_path):
+    path = str(tmp_path / 'cache.json')
+    cache = server.ResultCache(path=path)
+    cache.put('fresh', 'copy')
+    cache.put('stale', 'copy', expires_at=time.time() - 1)
+    cache.save()
+    reloaded = server.ResultCache(path=path)
+    assert reloaded.get('fresh') == 'copy'
+    assert reloaded.get('stale') is None
+
+
+def test_cosmetic_differences_share_a_key():
+    body = {'productName': 'Trail  shoes', 'productDescription': 'Light', 'tone': 'Friendly', 'language': 'English'}
+    same = dict(body, productName='Trail shoes ', tone='friendly', language='english')
+    assert server.ad_copy_cache_key(body) == server.ad_copy_cache_key(same)
+    assert server.image_cache_key(body) == server.image_cache_key(dict(body, tone='Formal'))
+    assert server.ad_copy_cache_key(body) != server.ad_copy_cache_key(dict(body, tone='Formal'))
+
+
+def test_new_variation_requests():
+    assert server.wants_new_variation({'newVariation': True}, {})
+    assert server.wants_new_variation({}, {'Cache-Control': 'no-cache'})
+    assert not server.wants_new_variation({}, {})
+
+
+def request(port, method, path, body=None, headers=None):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        connection.request(method, path, json.dumps(body) if body is not None else None,
+                           {'Content-Type': 'application/json', **(headers or {})})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+
+@pytest.mark.parametrize('engine', ['threaded', 'async'])
+def test_server_serves_repeats_from_cache_unless_bypassed(run_server, engine):
+    _, port = run_server(engine)
+    body = {'productName': f'Cached {engine}', 'productDescription': 'Test'}
+
+    def cache_stats():
+        stats = request(port, 'GET', '/api/cache-stats')[1]
+        return stats['hits'], stats['misses']
+
+    first = request(port, 'POST', '/generate-ad', body)[1]
+    assert cache_stats() == (0, 2)  # copy and image
+    assert request(port, 'POST', '/generate-ad', body)[1] == first
+    assert cache_stats() == (2, 2)
+
+    assert request(port, 'POST', '/generate-ad', dict(body, newVariation=True))[0] == 200
+    assert request(port, 'POST', '/generate-ad', body, {'Cache-Control': 'no-cache'})[0] == 200
+    assert cache_stats() == (2, 2)
@@ -0,0 +1,176 @@
+"""SingleFlight and AsyncSingleFlight: concurrent callers share one call"""
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import server
+
+
+def test_threads_share_one_call():
+    flight = server.SingleFlight()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        time.sleep(0.2)
+        return 'copy'
+
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(lambda _: flight.do('key', fetch), range(4)))
+    assert results == ['copy'] * 4
+    assert calls == [1]
+    assert flight.coalesced == 3
+    assert flight.stats()['in_flight'] == 0
+
+
+def test_threads_share_the_error():
+    flight = server.SingleFlight()
+    started = threading.Event()
+
+    def fail():
+        started.set()
+        time.sleep(0.2)
+        raise ValueError('upstream down')
+
+    def call():
+        try:
+            flight.do('key', fail)
+        except ValueError as e:
+            return str(e)
+
+    with ThreadPoolExecutor(2) as pool:
+        first = pool.submit(call)
+        started.wait()
+        second = pool.submit(call)
+        assert first.result() == second.result() == 'upstream down'
+
+
+class Upstream:
+    """A slow coroutine call that records whether it finished or was cancelled"""
+
+    def __init__(self, delay=0.2):
+        self.delay = delay
+        self.started = 0
+        self.cancelled = 0
+
+    async def fetch(self):
+        self.started += 1
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return 'image'
+
+
+def test_coroutines_share_one_task():
+    async def scenario():
+        flight, upstream = server.AsyncSingleFlight(), Upstream()
+        results = await asyncio.gather(*(flight.do('key', upstream.fetch) for _ in range(3)))
+        return flight, upstream, results
+
+    flight, upstream, results = asyncio.run(scenario())
+    assert results == ['image'] * 3
+    assert upstream.started == 1
+    assert flight.coalesced == 2
+    assert flight.stats()['in_flight'] == 0
+
+
+def test_one_waiter_giving_up_keeps_the_call_for_others():
+    async def scenario():
+        flight, upstream = server.AsyncSingleFlight(), Upstream()
+        leaving = asyncio.create_task(flight.do('key', upstream.fetch))
+        staying = asyncio.create_task(flight.do('key', upstream.fetch))
+        await asyncio.sleep(0.05)
+        leaving.cancel()
+        return upstream, await staying
+
+    upstream, result = asyncio.run(scenario())
+    assert result == 'image'
+    assert upstream.cancelled == 0
+
+
+def test_call_is_cancelled_once_every_waiter_gives_up():
+    async def scenario():
+        flight, upstream = server.AsyncSingleFlight(), Upstream()
+        waiters = [asyncio.create_task(flight.do('key', upstream.fetch)) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.sleep(0)
+        in_flight = flight.stats()['in_flight']
+        # A later caller starts a fresh call rather than joining the cancelled one
+        result = await flight.do('key', upstream.fetch)
+        return upstream, in_flight, result
+
+    upstream, in_flight, result = asyncio.run(scenario())
+    assert upstream.cancelled == 1
+    assert in_flight == 0
+    assert result == 'image'
+    assert upstream.started == 2
+
+
+def test_timeout_cancels_the_call():
+    async def scenario():
+        flight, upstream = server.AsyncSingleFlight(), Upstream(delay=5)
+        try:
+            await flight.do('key', upstream.fetch, timeout=0.05)
+        except asyncio.TimeoutError:
+            pass
+        await asyncio.sleep(0)
+        return upstream.cancelled
+
+    # Checked inside the loop: asyncio.run cancels whatever is left when it returns
+    assert asyncio.run(scenario()) == 1
+
+
+def test_failed_copy_stops_the_shared_image_call(monkeypatch):
+    upstream = Upstream(delay=5)
+
+    async def no_copy(data):
+        return None
+
+    monkeypatch.setattr(server, 'fetch_ad_copy_async', no_copy)
+    monkeypatch.setattr(server, 'fetch_image_async', lambda data: upstream.fetch())
+
+    async def scenario():
+        try:
+            await server.generate_ad_async({'productName': 'Single flight test'})
+        except Exception as e:
+            assert str(e) == 'Failed to generate ad copy'
+        for _ in range(100):
+            if upstream.cancelled:
+                break
+            await asyncio.sleep(0.01)
+        return upstream.started, upstream.cancelled
+
+    assert asyncio.run(scenario()) == (1, 1)
+
+
+def test_shared_call_is_cancelled_once_every_caller_gives_up():
+    flight = server.SingleFlight()
+    started, seen = threading.Event(), []
+    cancels = [threading.Event(), threading.Event()]
+
+    def fetch(cancellation):
+        started.set()
+        for _ in range(50):
+            if cancellation.is_set():
+                seen.append('cancelled')
+                return None
+            time.sleep(0.02)
+        return 'image'
+
+    with ThreadPoolExecutor(2) as pool:
+        leader = pool.submit(flight.do, 'key', fetch, None, cancels[0])
+        started.wait()
+        follower = pool.submit(flight.do, 'key', fetch, None, cancels[1])
+        time.sleep(0.05)
+        cancels[0].set()
+        time.sleep(0.1)
+        assert seen == []  # the follower still wants the image
+        cancels[1].set()
+        assert leader.result() is None and follower.result() is None
+    assert seen == ['cancelled']
@@ -0,0 +1,127 @@
+"""StaticAssetCache: files under public/ served from memory"""
+import gzip
+import http.client
+import os
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def public(tmp_path):
+    (tmp_path / 'index.html').write_text('<h1>Ad generator</h1>')
+    (tmp_path / 'app.js').write_text('console.log("ad generator");\n' * 40)
+    (tmp_path / 'user_ads_alice.json').write_text('[{"id": "ad1"}]')
+    (tmp_path / 'user_data_alice.json').write_text('{"uid": "alice"}')
+    return tmp_path
+
+
+@pytest.mark.parametrize('path', ['/user_ads_alice.json', '/user_data_alice.json', '/USER_ADS_alice.json',
+                                  '/%75ser_ads_alice.json', '/./user_ads_alice.json'])
+def test_legacy_history_files_are_not_served(public, path):
+    cache = server.StaticAssetCache(str(public))
+    assert cache.resolve(path) is None
+    assert cache.respond(path, {}) is None
+
+
+def test_warm_skips_legacy_history_files(public):
+    cache = server.StaticAssetCache(str(public))
+    cache.warm()
+    assert sorted(cache.assets) == ['/app.js', '/index.html']
+
+
+def test_matching_etag_gives_304(public):
+    cache = server.StaticAssetCache(str(public))
+    status, headers, body = cache.respond('/app.js', {})
+    etag = dict(headers)['ETag']
+    assert (status, body) == (200, (public / 'app.js').read_bytes())
+
+    for if_none_match in (etag, f'W/{etag}', f'"stale", {etag}', '*'):
+        status, headers, body = cache.respond('/app.js', {'If-None-Match': if_none_match})
+        assert (status, body) == (304, b'')
+    assert cache.respond('/app.js', {'If-None-Match': '"stale"'})[0] == 200
+
+
+def test_unchanged_last_modified_gives_304(public):
+    cache = server.StaticAssetCache(str(public))
+    last_modified = dict(cache.respond('/app.js', {})[1])['Last-Modified']
+    assert cache.respond('/app.js', {'If-Modified-Since': last_modified})[0] == 304
+
+
+def test_gzip_variant_has_its_own_etag(public):
+    cache = server.StaticAssetCache(str(public))
+    plain = dict(cache.respond('/app.js', {})[1])
+    status, headers, body = cache.respond('/app.js', {'Accept-Encoding': 'gzip, deflate'})
+    headers = dict(headers)
+    assert status == 200
+    assert headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(body) == (public / 'app.js').read_bytes()
+    assert headers['ETag'] != plain['ETag']
+    assert headers['Vary'] == 'Accept-Encoding'
+    assert cache.respond('/app.js', {'If-None-Match': headers['ETag']})[0] == 304
+    # Refused with q=0, and too small to be worth compressing
+    assert 'Content-Encoding' not in dict(cache.respond('/app.js', {'Accept-Encoding': 'gzip;q=0'})[1])
+    assert 'Content-Encoding' not in dict(cache.respond('/index.html', {'Accept-Encoding': 'gzip'})[1])
+
+
+@pytest.mark.parametrize('range_header, start, end', [
+    ('bytes=0-6', 0, 6),
+    ('bytes=8-', 8, 1159),
+    ('bytes=-4', 1156, 1159),
+    ('bytes=10-100000', 10, 1159),
+])
+def test_single_range_gives_206(public, range_header, start, end):
+    cache = server.StaticAssetCache(str(public))
+    data = (public / 'app.js').read_bytes()
+    assert len(data) == 1160
+    status, headers, body = cache.respond('/app.js', {'Range': range_header, 'Accept-Encoding': 'gzip'})
+    headers = dict(headers)
+    assert (status, body) == (206, data[start:end + 1])
+    assert headers['Content-Range'] == f'bytes {start}-{end}/1160'
+    assert headers['Content-Length'] == str(end + 1 - start)
+    assert 'Content-Encoding' not in headers
+
+
+def test_unsatisfiable_and_ignored_ranges(public):
+    cache = server.StaticAssetCache(str(public))
+    size = len((public / 'app.js').read_bytes())
+    status, headers, _ = cache.respond('/app.js', {'Range': f'bytes={size}-'})
+    assert (status, dict(headers)['Content-Range']) == (416, f'bytes */{size}')
+    assert cache.respond('/app.js', {'Range': 'bytes=0-1,4-5'})[0] == 200
+    assert cache.respond('/app.js', {'Range': 'lines=0-1'})[0] == 200
+    # A range against an older copy of the file gets the whole new one
+    assert cache.respond('/app.js', {'Range': 'bytes=0-1', 'If-Range': '"old"'})[0] == 200
+
+
+def test_changed_file_gets_a_new_etag(public):
+    cache = server.StaticAssetCache(str(public), check_interval=0)
+    etag = dict(cache.respond('/app.js', {})[1])['ETag']
+    (public / 'app.js').write_text('console.log("changed");\n' * 40)
+    os.utime(public / 'app.js', ns=(0, 10 ** 18))
+    status, headers, _ = cache.respond('/app.js', {'If-None-Match': etag})
+    assert status == 200
+    assert dict(headers)['ETag'] != etag
+
+
+@pytest.mark.parametrize('engine', ['threaded', 'async'])
+def test_server_answers_conditional_and_range_requests(run_server, engine):
+    _, port = run_server(engine)
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        connection.request('GET', '/robots.txt')
+        response = connection.getresponse()
+        full = response.read()
+        etag = response.getheader('ETag')
+        assert response.status == 200
+
+        connection.request('GET', '/robots.txt', headers={'If-None-Match': etag})
+        response = connection.getresponse()
+        assert (response.status, response.read()) == (304, b'')
+
+        connection.request('GET', '/robots.txt', headers={'Range': 'bytes=0-9'})
+        response = connection.getresponse()
+        assert (response.status, response.read()) == (206, full[:10])
+        assert response.getheader('Content-Range') == f'bytes 0-9/{len(full)}'
+    finally:
+        connection.close()
@@ -0,0 +1,142 @@
+"""UpstreamClient and AsyncUpstreamClient retry policy: only requests the upstream never acted on are sent again"""
+import asyncio
+import threading
+
+import pytest
+import requests
+
+import bench
+import server
+
+from conftest import MOCK_SETTINGS
+
+
+class CountingUpstream(bench.MockUpstream):
+    """The bench mock, recording each request; ``/drop`` reads the request and hangs up without answering"""
+
+    def do_POST(self):
+        self.server.hits.append(self.path)
+        if self.path == '/drop':
+            self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            self.close_connection = True
+            return
+        super().do_POST()
+
+    def do_GET(self):
+        self.server.hits.append(self.path)
+        if self.path == '/drop':
+            self.close_connection = True
+            return
+        super().do_GET()
+
+
+@pytest.fixture
+def upstream():
+    mock = bench.MockServer(('127.0.0.1', 0), CountingUpstream)
+    mock.settings = dict(MOCK_SETTINGS)
+    mock.hits = []
+    threading.Thread(target=mock.serve_forever, daemon=True).start()
+    yield mock
+    mock.shutdown()
+    mock.server_close()
+
+
+def make_sync_client(port, **kwargs):
+    kwargs = dict(dict(timeout=0.5, min_timeout=0.1, backoff=0.01, retries=2), **kwargs)
+    return server.UpstreamClient('test', f'http://127.0.0.1:{port}', **kwargs)
+
+
+def make_client(port, **kwargs):
+    return server.AsyncUpstreamClient(make_sync_client(port, **kwargs))
+
+
+def test_sync_retryable_status_is_retried(upstream):
+    upstream.settings['error_rate'] = 1.0
+    response = make_sync_client(upstream.server_port).post('/v1/orders', json={'amount': 100})
+    assert response.status_code == 503
+    assert len(upstream.hits) == 3
+
+
+def test_sync_post_dropped_after_sending_is_not_resent(upstream):
+    with pytest.raises(requests.ConnectionError):
+        make_sync_client(upstream.server_port).post('/drop', json={})
+    assert upstream.hits == ['/drop']
+
+
+def test_sync_get_dropped_is_retried(upstream):
+    with pytest.raises(requests.ConnectionError):
+        make_sync_client(upstream.server_port).get('/drop')
+    assert upstream.hits == ['/drop'] * 3
+
+
+def test_sync_read_timeout_is_not_retried(upstream):
+    upstream.settings['copy_latency'] = 1500
+    with pytest.raises(requests.ReadTimeout):
+        make_sync_client(upstream.server_port, timeout=0.3).post('/chat/completions', json={'messages': []})
+    assert upstream.hits == ['/chat/completions']
+
+
+def test_sync_refused_connection_is_retried(monkeypatch):
+    attempts = []
+
+    def backoff_delay(self, attempt, response=None):
+        attempts.append(attempt)
+        return 0
+
+    monkeypatch.setattr(server.UpstreamClient, 'backoff_delay', backoff_delay)
+    with pytest.raises(requests.ConnectionError):
+        make_sync_client(bench.free_port()).post('/v1/orders', json={})
+    assert attempts == [0, 1]
+
+
+def test_post_answered_is_returned(upstream):
+    client = make_client(upstream.server_port)
+    response = asyncio.run(client.post('/v1/orders', json_body={'amount': 100}))
+    assert response.status_code == 200
+    assert response.json()['amount'] == 100
+    assert upstream.hits == ['/v1/orders']
+
+
+def test_retryable_status_is_retried(upstream):
+    upstream.settings['error_rate'] = 1.0
+    client = make_client(upstream.server_port)
+    response = asyncio.run(client.post('/v1/orders', json_body={'amount': 100}))
+    assert response.status_code == 503
+    assert len(upstream.hits) == 3
+
+
+def test_post_dropped_after_sending_is_not_resent(upstream):
+    client = make_client(upstream.server_port)
+    with pytest.raises(server.ResponseLost):
+        asyncio.run(client.post('/drop', json_body={}))
+    assert upstream.hits == ['/drop']
+
+
+def test_get_dropped_is_retried(upstream):
+    client = make_client(upstream.server_port)
+    with pytest.raises(ConnectionError) as excinfo:
+        asyncio.run(client.request('GET', '/drop'))
+    assert not isinstance(excinfo.value, server.ResponseLost)
+    assert upstream.hits == ['/drop'] * 3
+
+
+def test_post_read_timeout_is_not_resent(upstream):
+    upstream.settings['copy_latency'] = 1500
+    client = make_client(upstream.server_port, timeout=0.3)
+    with pytest.raises(server.ResponseLost):
+        asyncio.run(client.post('/chat/completions', json_body={'messages': []}))
+    assert upstream.hits == ['/chat/completions']
+
+
+def test_get_read_timeout_is_not_retried(upstream):
+    upstream.settings['image_latency'] = 15000
+    client = make_client(upstream.server_port, timeout=0.3)
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(client.request('GET', '/img/slow.jpg'))
+    assert upstream.hits == ['/img/slow.jpg']
+
+
+def test_refused_connection_is_retried():
+    client = make_client(bench.free_port())
+    with pytest.raises(ConnectionRefusedError):
+        asyncio.run(client.post('/v1/orders', json_body={}))